@@ -1,18 +1,46 @@
-
 from kivy.core.window import Window
 from kivy.uix.boxlayout import BoxLayout
 
 # kivy.require('1.0.6')  # replace with your current kivy version !
 
 from kivy.app import App
+from kivy.uix.button import Button
 from kivy.uix.floatlayout import FloatLayout
+from kivy.uix.textinput import TextInput
+from os.path import abspath, dirname, join
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', 'os', 'lib'))
+from contacts_store import Contacts_Store
 
 
 class ContactsApp(App):
     def build(self):
         Window.size = (480, 800)
         Window.fullscreen = False
-        return FloatLayout()
+        self.store = Contacts_Store()
+        root = FloatLayout()
+        search = TextInput(hint_text='Search', multiline=False,
+            size=(480, 50), size_hint=(None, None), pos=(0, 720))
+        search.bind(text=lambda instance, text: self.show(text))
+        self.list = BoxLayout(orientation='vertical', size=(480, 640),
+            size_hint=(None, None), pos=(0, 70))
+        root.add_widget(search)
+        root.add_widget(self.list)
+        self.show('')
+        return root
+
+    def show(self, query):
+        # the store searches its in-memory index of the names, so the list
+        # can follow every key typed
+        self.list.clear_widgets()
+        for contact in self.store.search(query, limit=12):
+            number = contact.numbers[0][0] if contact.numbers else ''
+            self.list.add_widget(Button(text='%s\n%s' % (contact.name,
+                number)))
+
+    def on_stop(self):
+        self.store.close()
 
 if __name__ == '__main__':
     home = ContactsApp()
@@ -18,22 +18,22 @@ SMSs.
 
 At the time of the Raspberry Pi's boot, the operations of the mobile
 telephone (calling, messaging, UI appearance, notifications) must start.
-This script accomplishes this task by creating three threading.Lock
+This script accomplishes this task by creating two threading.Lock
 objects which will be used by each of the thread classes created in the
 core directory.
 
-The first thread lock is fona_lock which will control thread access to
-the FONA device serial port. This lock is required by all threads (call,
-sms, and signal) because each thread at some point will send a command
-to the shared FONA device.
+Access to the FONA device serial port needs no lock: the FONA_Driver
+run by the Driver_Thread is its only owner and every thread submits its
+commands to the driver.
 
-The next two are call_lock and sms_lock which limit one thread to write
+The locks are call_lock and sms_lock which limit one thread to write
 to a text file located either in the phone or message directory.
 
-When this script runs, three threads are created: one for polling the
-FONA for incoming calls, one for polling the FONA for incoming SMSs, and
+When this script runs, the signal thread is created, which is
 responsible for signalling to the UI of the OS that there is a phone
-call or SMS.
+call or SMS. It starts the threads running the FONA driver, listening
+for incoming calls, listening for incoming SMSs, sending the outbox and
+running the scheduled jobs.
 """
 
 # TODO: have a curenv variable for the current environment somewhere
@@ -55,4 +55,4 @@ if __name__ == '__main__':
     # TODO: create GUI base here and pass that in as parameter to Signal_Thread#
     ############################################################################
 
-    Signal_Thread(Lock(), Lock(), Lock()).start()
+    Signal_Thread(Lock(), Lock()).start()
@@ -13,6 +13,11 @@ from kivy.uix.label import Label
 from kivy.uix.listview import ListView
 from kivy.base import runTouchApp
 from kivy.uix.screenmanager import ScreenManager,Screen, SwapTransition, CardTransition
+from os.path import abspath, dirname, join
+import sys
+
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', 'os', 'lib'))
+from sms_store import SMS_Store
 class MessageApp(App):
     def build(self):
         root = FloatLayout()
@@ -43,6 +48,23 @@ class ScreenOne(Screen):
         button.opacity = 0.1
         image = Image(source='Home_Button.png', allow_stretch=False, pos=(0, -365))
         layout.add_widget(button)
+        self.show_inbox()
+
+    def show_inbox(self):
+        # the inbox is read from the summary of each conversation kept by
+        # the message store, so opening it does not go through the history
+        inbox = self.ids.inbox
+        inbox.clear_widgets()
+        store = SMS_Store()
+        try:
+            conversations = store.conversations(limit=12)
+        finally:
+            store.close()
+        for conversation in conversations:
+            text = '%s%s\n%s' % (conversation.name or conversation.thread,
+                ' (%d)' % conversation.unread if conversation.unread else '',
+                conversation.body[:40])
+            inbox.add_widget(Button(text=text, halign='left'))
 
 class ScreenTwo(Screen):
     def __init__(self, **kwargs):
@@ -1,5 +1,6 @@
 from glob import glob
-from os.path import dirname, join
+from os.path import abspath, dirname, join
+import sys
 
 import kivy
 from kivy.clock import mainthread
@@ -21,6 +22,9 @@ from apps.message.message import MessageApp,TestClass
 import multiprocessing
 from kivy.uix.screenmanager import ScreenManager, Screen,CardTransition, SlideTransition
 
+sys.path.append(join(dirname(abspath(__file__)), 'os', 'lib'))
+from scheduler import scheduler
+
 
 class ScreenManagement(ScreenManager):
     ScreenManager.transition = CardTransition(mode='push')
@@ -74,6 +78,9 @@ class HomeScreen(App):
         Window.size = (480, 800)
         Window.fullscreen = False
         # Window.borderless = True
+        # touches, key presses and the screen state tell the scheduler of
+        # the OS when to back its periodic jobs off
+        scheduler.watch(Window)
 
         # get any files into images directory
         # 75 from left, 160 between
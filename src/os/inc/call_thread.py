@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
-from fona_commands import phone_status
+from call_log import Call_Log
+from call_state import END_GRACE, RINGING, Call_State_Machine
+from contacts_store import Contacts_Store
+from queue import Empty, Queue
 from threading import Thread
-from time import sleep
+from urc import Call_Ended, Call_Status, Caller_ID, Ring, dispatcher
 
 import logging
 
@@ -11,76 +14,105 @@ __date__ = '2017-06-05'
 __version__ = '1.0'
 
 class Call_Thread(Thread):
-    """Thread to continually poll the FONA device for incoming phone calls.
-
-    Whenever the fona_commands.phone_status returns the string '3', this
-    indicates that the status of the phone is call incoming. Whenever this
-    occurs, the signal thread is signalled of this new call by writing to the
-    file call_signal.txt in the call application directory. Either True or False
-    exists in this file for the signal thread to check.
+    """Thread to follow the state of phone calls and signal whenever there is
+    an incoming phone call.
+
+    While a call is incoming, the FONA writes the URC RING to the serial port
+    every few seconds, followed by +CLIP: <number> when caller ID is enabled,
+    and with AT+CLCC=1 it writes +CLCC whenever the state of a call changes;
+    NO CARRIER, BUSY or NO ANSWER end a call. These are published as urc.Ring,
+    urc.Caller_ID, urc.Call_Status and urc.Call_Ended events, which this
+    thread feeds to a call state machine (see call_state.py). The machine
+    appends every call to the call log (see call_log.py) when it ends.
+    Whenever a call starts ringing, the signal thread is signalled of this new
+    call by writing to the file call_signal.txt in the call application
+    directory. Either True or False exists in this file for the signal thread
+    to check.
 
     Once the signal thread has finished acknowledging the incoming call, it will
     also write to the call_signal.txt file. It will write False to signal to
     itself that there are no incoming calls.
 
     Since two threads will be writing to the same resource, a lock is needed for
-    writing to call_signal.txt. Since the call thread calls methods in
-    fona_commands, it will be writing to the FONA device serial port.
-    Concurrently, the signal thread will most likely be writing to the FONA
-    various commands as a part of regular operation. Because of this, another
-    threading lock is required to maintain the shared FONA port resource.
-
-    Attribute:
-        INCOMING (str): string of the number 3. Whenever the AT+CPAS command is
-        written to the FONA serial port, the FONA will output the status of the
-        phone (reading, call in progress, call incoming, unknown). The value for
-        the call incoming state is 3, and the output of the FONA will be a
-        string. Whenever checking for an incoming call, the output of the FONA
-        is checked against the INCOMING constant. 
+    writing to call_signal.txt. This thread never writes to the FONA device, so
+    it does not need the FONA port lock.
+
+    The number of each caller is looked up in the contacts (see
+    contacts_store.py) as soon as it is known, which costs a dictionary
+    lookup, so the name is known before the signal thread shows the call.
+
+    Attributes:
+        calls (call_state.Call_State_Machine): state of the call in progress,
+        created by this thread when it starts
+        contacts (contacts_store.Contacts_Store): contacts, opened by this
+        thread when it starts
     """
 
-    INCOMING = '3'
-
-    def __init__(self, fona_lock, call_lock, delay=5):
+    def __init__(self, call_lock, notify=None):
         """Constructor for Call_Thread object.
 
         Class which inherits from threading.Thread. Constructor to setup class
-        variables and open call_signal.txt file for communication between the
-        Call_Thread and the Global_Thread classes.
-       
+        variables for communication between the Call_Thread and the
+        Signal_Thread classes.
+
         Args:
-            fona_lock (threading.Lock): lock in order to write commands to the
-            FONA port from this thread, the SMS thread, and the signal thread
             call_lock (threading.Lock): lock in order to write to the
             call_signal.txt file from Call_Thread and Signal_Thread
-            delay (float): amount of time to pass between checks (default is 5
-            seconds)
+            notify (threading.Event): event set after writing to the
+            call_signal.txt file so the signal thread wakes up immediately
+            (default is None)
         """
-        Thread.__init__(self)
-        self.fona_lock = fona_lock
+        Thread.__init__(self, daemon=True)
         self.call_lock = call_lock
-        self.delay = delay
+        self.notify = notify
+        self.calls = None
+        self.contacts = None
+        self.events = Queue()
         logging.basicConfig(level=logging.DEBUG,
             format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
             '%(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
         self.logger = logging.getLogger(__name__)
 
+    @property
+    def caller(self):
+        """Phone number of the most recent call, or None if the FONA has not
+        reported one."""
+        return self.calls.number if self.calls is not None else None
+
+    @property
+    def caller_name(self):
+        """Name of the contact of the most recent call, or None if the number
+        is not one of a contact."""
+        return self.calls.name if self.calls is not None else None
+
+    def _resolve(self, number):
+        """Return the name of the contact with a number, or None."""
+        contact = self.contacts.lookup(number)
+        return contact.name if contact is not None else None
+
+    def _signal(self, transition):
+        """Signal the signal thread when a call starts ringing."""
+        if transition.state != RINGING:
+            return
+        self.logger.info('Incoming call. Writing to signal file')
+        with self.call_lock:
+            with open('.call_signal.txt', 'w+') as signal:
+                signal.write('1')
+        if self.notify is not None:
+            self.notify.set()
+
     def run(self):
-        """Continually poll the FONA device to see if there are any incoming
-        calls.
+        """Wait for call events and feed them to the call state machine,
+        signalling each incoming call.
 
         Method which overrides the method run from threading.Thread. Called
-        whenever the method start is called on an instance of Call_Thread. 
-
-        Using the fona_commands.phone_status method, run checks to see if
-        sending the FONA command for outputting phone status outputs the string
-        '3' which indicates there is an incoming call. This method runs as soon
-        as the Raspberry Pi is powered on, and it will run for as long as it is
-        on.
+        whenever the method start is called on an instance of Call_Thread.
 
-        Every 'delay' seconds, the output phone_status is checked for '3'. Once
-        this occurs, this method signals the signal thread that the FONA has an
-        incoming call by writing to the call_signal.txt file the string True.
+        The thread subscribes to the events and blocks until one arrives, so an
+        incoming call is signalled as soon as the FONA reports it. When a call
+        starts ringing, this method signals the signal thread that the FONA has
+        an incoming call by writing to the call_signal.txt file the string
+        True.
 
         If the signal thread reads the call_signal.txt file for the phone
         application, it will see that it contains True if there is an incoming
@@ -90,14 +122,16 @@ class Call_Thread(Thread):
         call_signal.txt file and write the string False so that whenever it
         checks the call_signal.txt file again, it will be accurate.
         """
+        self.contacts = Contacts_Store()
+        self.calls = Call_State_Machine(self._resolve, Call_Log())
+        self.calls.subscribe(self._signal)
+        for event_type in (Ring, Caller_ID, Call_Status, Call_Ended):
+            dispatcher.subscribe(event_type, self.events.put)
         while True:
-            self.fona_lock.acquire()
-            self.logger.debug('Checking for call')
-            if get_phone_status() == INCOMING:
-                self.logger.info('Incoming call. Writing to signal file')
-                self.call_lock.acquire()
-                with open('.call_signal.txt', 'w+') as signal:
-                    signal.write('1')
-                self.call_lock.release()
-            self.fona_lock.release()
-            sleep(self.delay)
+            try:
+                event = self.events.get(
+                    timeout=END_GRACE if self.calls.settling else None)
+            except Empty:
+                self.calls.settle()
+                continue
+            self.calls.handle(event)
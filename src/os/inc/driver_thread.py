@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from fona_async import FONA_Driver
+from threading import Event, Thread
+
+import asyncio
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-19'
+__version__ = '1.0'
+
+class Driver_Thread(Thread):
+    """Thread to run the asyncio event loop of the FONA driver.
+
+    The FONA_Driver (see fona_async.py) is the single owner of the FONA device
+    serial port: it writes every command and reads every response and URC.
+    This thread gives the driver an event loop of its own, so the Kivy main
+    loop and the other threads of the OS can submit commands to it (directly,
+    or through fona.command and the fona_commands helpers) without anyone
+    holding a lock on the port.
+
+    Attributes:
+        driver (fona_async.FONA_Driver): driver which owns the FONA port
+        ready (threading.Event): set once the driver owns the port and
+        commands may be submitted, or once it failed to start
+        error (Exception): why the driver failed to start, or None
+    """
+
+    def __init__(self):
+        """Constructor for Driver_Thread object.
+
+        The thread is a daemon so that it does not keep the OS from exiting
+        while the driver waits on the serial port.
+        """
+        Thread.__init__(self, daemon=True)
+        self.driver = FONA_Driver()
+        self.ready = Event()
+        self.error = None
+        logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
+            '%(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        """Run the driver's event loop for as long as the OS is running."""
+        asyncio.run(self._main())
+
+    async def _main(self):
+        """Start the driver and keep its event loop running.
+
+        If the driver cannot start, e.g. because no FONA device answered,
+        the error is kept in error and ready is set all the same, so the
+        threads waiting for the driver do not wait forever.
+        """
+        try:
+            await self.driver.start()
+        except Exception as error:
+            self.logger.error('FONA driver did not start: %s' % error)
+            self.error = error
+            return
+        finally:
+            self.ready.set()
+        await asyncio.Event().wait()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+from fona import BACKGROUND, command_priority
+from registration import registration
+from sms_spool import SMS_Spool, pending
+from sms_store import SENT, SMS_Store
+from threading import Thread
+from time import time
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-19'
+__version__ = '1.0'
+
+class Outbox_Thread(Thread):
+    """Thread to send the SMSs put into the outbox (see sms_spool.py).
+
+    The UI enqueues an SMS with SMS_Spool.enqueue, which returns as soon as the
+    SMS is in the message database and wakes this thread up. The thread sends
+    every message which is due in batches (see SMS_Spool.send_batch) and then
+    sleeps until the next message is due, e.g. a retry after a failure, or
+    until another SMS is enqueued or the 'outbox' job of the scheduler (see
+    scheduler.py) wakes it up, in case another process enqueued one. While
+    the FONA is not registered on the network (see registration.py) the
+    outbox is held, so no message burns an attempt, and it is sent as soon
+    as the FONA is registered again. Each message sent is also stored in the
+    message history as a sent SMS of its conversation. Its commands have
+    background priority (see fona.command_priority), like the SMS thread's.
+
+    Attributes:
+        spool (sms_spool.SMS_Spool): outbox, opened by this thread when it
+        starts
+        store (sms_store.SMS_Store): message database, opened by this thread
+        when it starts
+    """
+
+    def __init__(self, longest_wait=None):
+        """Constructor for Outbox_Thread object.
+
+        Arg:
+            longest_wait (float): longest number of seconds to sleep before
+            checking the outbox again, in case a message was enqueued by
+            another process (default is None to rely on the scheduler)
+        """
+        Thread.__init__(self, daemon=True)
+        self.longest_wait = longest_wait
+        self.spool = None
+        self.store = None
+        logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
+            '%(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        """Send the messages of the outbox as they become due, for as long as
+        the OS is running."""
+        self.spool = SMS_Spool()
+        self.store = SMS_Store()
+        registration.subscribe(self._on_registration)
+        while True:
+            pending.clear()
+            if not registration.registered:
+                self.logger.info('FONA is offline, holding the outbox')
+                pending.wait()
+                continue
+            with command_priority(BACKGROUND):
+                sent = self.spool.send_batch()
+            for message, number, body in sent:
+                self.logger.info('SMS %d sent to %s' % (message, number))
+                self.store.add(number, body, direction=SENT, read=True)
+            if sent:
+                continue
+            due = self.spool.next_due()
+            wait = None if due is None else due - time()
+            if self.longest_wait is not None and (wait is None or
+                    wait > self.longest_wait):
+                wait = self.longest_wait
+            if wait is None or wait > 0:
+                pending.wait(wait)
+
+    def _on_registration(self, network, stat):
+        """Wake up to send the outbox when the FONA is registered again."""
+        if network == 'CREG' and registration.registered:
+            pending.set()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+from scheduler import scheduler
+from threading import Thread
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-31'
+__version__ = '1.0'
+
+class Scheduler_Thread(Thread):
+    """Thread to run the periodic jobs of the OS (see scheduler.py).
+
+    The jobs, e.g. sampling the telemetry of the FONA or checking the
+    outbox, are scheduled by the signal thread and run one after the other
+    in this thread, on as few wakeups as their intervals and slack allow.
+    A job should therefore not block for long; commands to the FONA should
+    be written with background priority (see fona.command_priority).
+
+    Attribute:
+        scheduler (scheduler.Scheduler): scheduler whose jobs this thread
+        runs
+    """
+
+    def __init__(self, jobs=scheduler):
+        """Constructor for Scheduler_Thread object.
+
+        Arg:
+            jobs (scheduler.Scheduler): scheduler whose jobs to run (default
+            is the scheduler of the OS)
+        """
+        Thread.__init__(self, daemon=True)
+        self.scheduler = jobs
+        logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
+            '%(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        """Run the jobs as they become due, for as long as the OS is
+        running."""
+        self.logger.info('Starting scheduler')
+        self.scheduler.run()
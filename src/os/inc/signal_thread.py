@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
 from call_thread import Call_Thread
+from driver_thread import Driver_Thread
+from fona import BACKGROUND, command_priority
+from fona_commands import enable_urcs
+from outbox_thread import Outbox_Thread
+from scheduler import scheduler
+from scheduler_thread import Scheduler_Thread
 from serial import SerialException
+from sms_spool import pending
 from sms_thread import SMS_Thread
-from threading import Thread
-from time import sleep
+from telemetry import FIELDS, RETRY_DELAY, telemetry
+from threading import Event, Thread
+from time import monotonic
 
 import logging
 import os
@@ -17,15 +25,22 @@ class Signal_Thread(Thread):
     """Thread class to run the Call_Thread and SMS_Thread simultaneously and
     inform the OS UI of any new calls or messages.
 
-    Whenever the Raspberry Pi is booted, it needs two threads to continually
-    poll the FONA device for calls and SMSs. Since both of these operations
-    require writing commands to the FONA device, a lock for the FONA device is
-    needed. Both of these threads also write to their own signal files. Because
-    this thread also writes to those files, locks are needed for both files.
+    Whenever the Raspberry Pi is booted, it needs two threads to listen for
+    the URCs the FONA device writes for calls and SMSs, a Driver_Thread
+    whose FONA_Driver owns the serial port and reads those URCs, an
+    Outbox_Thread which sends the SMSs the user writes and a
+    Scheduler_Thread which runs the periodic jobs of the OS (see
+    scheduler.py): sampling the signal, battery, network and time for the
+    status bar, checking the outbox and checking the signal files in case a
+    signal was missed. The call and SMS threads also write to their own
+    signal files. Because this thread also writes to those files, locks are
+    needed for both files. After writing to its file, each thread sets the
+    signal event so that this thread handles the call or SMS right away.
 
     Since this thread will also call methods defined in the fona_commands
-    library, it will also need to write commands to the FONA device, so it
-    should have a lock for the FONA.
+    library, it will also need to write commands to the FONA device. These are
+    submitted to the FONA_Driver, which is the only owner of the serial port,
+    so no lock for the FONA is needed.
 
     This class defines methods which act between the FONA device and elements of
     the UI: methods which check for output from the FONA to determine whether or
@@ -35,27 +50,29 @@ class Signal_Thread(Thread):
     messages.
     """
 
-    def __init__(self, fona_lock, call_lock, sms_lock, delay=5):
+    def __init__(self, call_lock, sms_lock, delay=5):
         """Constructor for Signal_Thread object.
 
         Args:
-            fona_lock (threading.Lock): lock used to make sure only one of the
-            thread classes defined in fona_processes directory writes to the
-            FONA serial port at a time
             call_lock (threading.Lock): lock used to make sure only one of
             either Signal_Thread or Call_Thread writes to the call_signal.txt
             file
             sms_lock (threading.Lock): lock used to make sure only one of either
             Signal_Thread or SMS_Thread writes to the sms_signal.txt file
-            delay (float): amount of time to delay between checking the
-            call_signal.txt and sms_signal.txt files (default is 5)
+            delay (float): interval of checking the call_signal.txt and
+            sms_signal.txt files if the signal event is not set, while the
+            user is active; the scheduler backs it off while the user is idle
+            or the battery is low (default is 5)
         """
         Thread.__init__(self)
-        self.fona_lock = fona_lock
         self.call_lock = call_lock
         self.sms_lock = sms_lock
-        self.sms_thread = SMS_Thread(self.fona_lock, self.sms_lock)
-        self.call_thread = Call_Thread(self.fona_lock, self.call_thread)
+        self.signal = Event()
+        self.driver_thread = Driver_Thread()
+        self.sms_thread = SMS_Thread(self.sms_lock, self.signal)
+        self.call_thread = Call_Thread(self.call_lock, self.signal)
+        self.outbox_thread = Outbox_Thread()
+        self.scheduler_thread = Scheduler_Thread()
         self.delay = delay
         logging.basicConfig(level=logging.DEBUG,
             format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
@@ -103,11 +120,14 @@ class Signal_Thread(Thread):
 
         If the call_signal.txt file contains True, the file will be updated to
         contain False, and UI should be notified to tell the user of the
-        incoming call; otherwise, nothing will happen.
+        incoming call; otherwise, nothing will happen. An incoming call is
+        activity of the user (see scheduler.activity), which brings the
+        periodic jobs back to their delays without the backoff.
         """
         if self._check_call_signal():
             self.logger.info('Call received, updating call signal')
             self._update_call_file()
+            scheduler.activity()
             self.logger.info('Updating UI for incoming call')
             #################### TODO ##########################
             # handle signalling GUI to handle an incoming call #
@@ -154,17 +174,47 @@ class Signal_Thread(Thread):
 
         If the sms_signal.txt file contains True, the file will be updated to
         contain False, and UI elements should be updated to tell the user of the
-        new SMSs. Otherwise, nothing will happen.
+        new SMSs. Otherwise, nothing will happen. A new SMS is activity of the
+        user, as an incoming call is.
         """
         if self._check_sms_signal():
             self.logger.info('SMS received, updating SMS signal')
             self._update_sms_file()
+            scheduler.activity()
             self.logger.info('Updating UI for incoming SMS')
             #################### TODO ##########################
             # handle signalling GUI to handle an incoming SMS  #
             # make sure this has a timer for how long it stays #
             ####################################################
 
+    def _sample_telemetry(self):
+        """Scheduled job sampling the telemetry of the FONA which is due.
+
+        Returns:
+            Float of the seconds until the next field is due
+        """
+        try:
+            with command_priority(BACKGROUND):
+                telemetry.sample()
+        except IOError as e:
+            self.logger.warn('Could not sample telemetry: %s' % e)
+            return RETRY_DELAY
+        return max(telemetry.next_due() - monotonic(), 0)
+
+    def _on_telemetry(self, name, value):
+        """Tell the scheduler the charge of the battery when it moves."""
+        if name == 'battery':
+            scheduler.battery(value.percent, value.charging)
+
+    def _schedule(self):
+        """Schedule the periodic jobs of the OS (see scheduler.py)."""
+        telemetry.subscribe(self._on_telemetry)
+        scheduler.schedule('telemetry', self._sample_telemetry,
+            FIELDS['signal'][1], delay=0)
+        scheduler.schedule('outbox', pending.set, 60, longest=900)
+        scheduler.schedule('signal', self.signal.set, self.delay,
+            longest=300)
+
     def run(self):
         """Method which will execute when this thread is started.
 
@@ -183,7 +233,9 @@ class Signal_Thread(Thread):
         file contents back to be False and signal the UI of this incoming SMS.
 
         This process of checking the files is repeated as long as the device is
-        powered on for every 'delay' seconds.
+        powered on, whenever the signal event is set: by the call and SMS
+        threads, or by the 'signal' job of the scheduler every 'delay' seconds
+        or, while the user is idle, less often.
 
         Thread methods are called within a try-except block because whenever the
         FONA device is disconnected anyway to the Raspberry Pi, attempting to
@@ -194,16 +246,30 @@ class Signal_Thread(Thread):
         ################## TODO ############################################################
         # probably don't do this immediately when Pi is turned on; give it a second or two #
         ####################################################################################
-        self.logger.info('Starting call and SMS threads')
+        self.logger.info('Starting FONA driver, call, SMS, outbox and '
+            'scheduler threads')
+        self.driver_thread.start()
+        self.driver_thread.ready.wait()
+        if self.driver_thread.error is not None:
+            self.logger.error('Running without the FONA driver, commands are '
+                'written to the serial port directly: %s'
+                % self.driver_thread.error)
         self.call_thread.start()
         self.sms_thread.start()
+        self.outbox_thread.start()
+        try:
+            enable_urcs()
+        except IOError as e:
+            self.logger.warn('Could not enable URCs: %s' % e)
+        self._schedule()
+        self.scheduler_thread.start()
 
         while True:
+            self.signal.clear()
             try:
                 self.logger.info('Checking for call')
                 self.check_call()
             except SerialException:
-                self.fona_lock.release()
                 self.logger.warn('Loss of connection to FONA device')
                 #########################################################
                 # TODO: handle loss of connection to FONA while running #
@@ -212,9 +278,8 @@ class Signal_Thread(Thread):
                 self.logger.info('Checking for SMS')
                 self.check_sms()
             except SerialException:
-                self.fona_lock.release()
                 self.logger.warn('Loss of connection to FONA device')
                 #########################################################
                 # TODO: handle loss of connection to FONA while running #
                 #########################################################
-            sleep(self.delay)
+            self.signal.wait()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+from asyncio import get_running_loop
+from functools import partial, wraps
+from inspect import getmembers, isfunction
+
+import fona_commands
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-19'
+__version__ = '1.0'
+
+"""Awaitable Equivalents of the fona_commands Library.
+
+For every public function of fona_commands, this library defines a
+coroutine function of the same name and arguments, e.g.
+    reception = await async_commands.get_reception()
+so that the UI can use the FONA device without blocking its event loop.
+
+The function itself runs on the event loop's default executor. Its
+commands go through fona.command, which submits them to the attached
+FONA_Driver (see fona_async.py) and waits in the executor thread, so the
+serial port stays owned by the driver and the event loop never blocks.
+"""
+
+def _awaitable(function):
+    """Wrap a fona_commands function in a coroutine function which runs
+    it on the running loop's default executor."""
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await get_running_loop().run_in_executor(None,
+            partial(function, *args, **kwargs))
+    return wrapper
+
+for _name, _function in getmembers(fona_commands, isfunction):
+    if (not _name.startswith('_') and
+            _function.__module__ == fona_commands.__name__):
+        globals()[_name] = _awaitable(_function)
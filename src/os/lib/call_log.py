@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+
+import os
+import sqlite3
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-26'
+__version__ = '1.0'
+
+"""Persistent Append-Only Log of Phone Calls.
+
+Every call which ends, incoming or outgoing, answered or not, is
+appended to the call log by the call state machine (see call_state.py)
+with the number and the name of the contact it resolved to, its outcome
+(answered, missed, busy, ...) and the time it started, was answered and
+ended. The transitions of its state (ringing, dialing, alerting, active,
+held, ended) are appended with it, each with its time and the latency
+from the URC which caused it to the transition, so the responsiveness of
+the phone can be studied after the fact.
+
+Nothing in the log is ever changed or deleted: triggers abort any UPDATE
+or DELETE of its tables, so the log is a faithful record of the calls.
+Each call and its transitions are written in one transaction.
+
+Each Call_Log object has its own connection and must only be used from
+the thread which created it.
+
+Attributes:
+    DATABASE (str): default path of the call log database
+"""
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'data', 'calls.db')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY,
+    number TEXT,
+    name TEXT,
+    direction INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    started REAL NOT NULL,
+    answered REAL,
+    ended REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calls_started ON calls (started);
+CREATE TABLE IF NOT EXISTS call_transitions (
+    call INTEGER NOT NULL REFERENCES calls (id),
+    state TEXT NOT NULL,
+    previous TEXT NOT NULL,
+    time REAL NOT NULL,
+    latency REAL,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS call_transitions_call ON call_transitions (call);
+CREATE TRIGGER IF NOT EXISTS calls_no_update BEFORE UPDATE ON calls BEGIN
+    SELECT RAISE(ABORT, 'the call log is append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS calls_no_delete BEFORE DELETE ON calls BEGIN
+    SELECT RAISE(ABORT, 'the call log is append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS call_transitions_no_update BEFORE UPDATE
+        ON call_transitions BEGIN
+    SELECT RAISE(ABORT, 'the call log is append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS call_transitions_no_delete BEFORE DELETE
+        ON call_transitions BEGIN
+    SELECT RAISE(ABORT, 'the call log is append-only');
+END;
+'''
+
+Logged_Call = namedtuple('Logged_Call',
+    'id number name direction outcome started answered ended')
+
+class Call_Log(object):
+    """Connection to the call log.
+
+    Attribute:
+        connection (sqlite3.Connection): connection to the database
+    """
+
+    def __init__(self, path=DATABASE):
+        """Constructor for Call_Log object.
+
+        Opens (creating if necessary) the call log at path in WAL mode.
+
+        Arg:
+            path (str): path of the database file (default is DATABASE)
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def append(self, call):
+        """Append a call which has ended and its transitions to the log.
+
+        Arg:
+            call (call_state.Call): record of the call
+
+        Returns:
+            Int of the id of the call in the log
+        """
+        with self.connection:
+            row = self.connection.execute('INSERT INTO calls (number, name, '
+                'direction, outcome, started, answered, ended) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)', (call.number, call.name,
+                call.direction, call.outcome, call.started, call.answered,
+                call.ended)).lastrowid
+            self.connection.executemany('INSERT INTO call_transitions (call, '
+                'state, previous, time, latency, reason) VALUES '
+                '(?, ?, ?, ?, ?, ?)', [(row, transition.state,
+                transition.previous, transition.time, transition.latency,
+                transition.reason) for transition in call.transitions])
+        return row
+
+    def recent(self, limit=50, before=None, outcome=None):
+        """Return the newest calls of the log.
+
+        Args:
+            limit (int): greatest number of calls to return (default 50)
+            before (float): only return calls which started before this
+            timestamp, for paging (default is None)
+            outcome (str): only return calls with this outcome, e.g.
+            missed (default is None for every call)
+
+        Returns:
+            List of Logged_Call named tuples (id, number, name, direction,
+            outcome, started, answered, ended), newest first
+        """
+        query = ('SELECT id, number, name, direction, outcome, started, '
+            'answered, ended FROM calls WHERE 1')
+        parameters = []
+        if before is not None:
+            query += ' AND started < ?'
+            parameters.append(before)
+        if outcome is not None:
+            query += ' AND outcome = ?'
+            parameters.append(outcome)
+        query += ' ORDER BY started DESC LIMIT ?'
+        parameters.append(limit)
+        return [Logged_Call(*row) for row in self.connection.execute(query,
+            parameters)]
+
+    def transitions(self, call):
+        """Return the (state, previous, time, latency, reason) tuples of
+        the transitions of a logged call, in order."""
+        return self.connection.execute('SELECT state, previous, time, '
+            'latency, reason FROM call_transitions WHERE call = ? ORDER BY '
+            'rowid', (call,)).fetchall()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from fona_stats import Histogram
+from time import monotonic, time
+from urc import Call_Ended, Call_Status, Caller_ID, Ring
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-26'
+__version__ = '1.0'
+
+"""State Machine of the Phone Calls of the FONA Device.
+
+The state of the call in progress is driven entirely by the URCs the
+FONA writes (see urc.py), with no polling of AT+CPAS or AT+CLCC:
+    RING and +CLIP announce an incoming call and its number;
+    +CLCC, which the FONA writes on every change of a call once AT+CLCC=1
+    is in effect (see fona_commands.enable_urcs), reports dialing,
+    alerting, active, held, incoming or waiting and disconnected;
+    NO CARRIER, BUSY and NO ANSWER end the call.
+Events which do not change the state, e.g. the RING repeated every few
+seconds, are ignored, so the same call may be reported by both RING and
++CLCC.
+
+A call goes from IDLE to RINGING (incoming) or DIALING and ALERTING
+(outgoing), then to ACTIVE and possibly HELD, and finally to ENDED,
+after which the machine is IDLE again. Every transition is timestamped
+with the wall clock, and its latency, from the moment the FONA's line
+was read from the serial port (the time of the event) to the moment the
+transition is made, is recorded in a histogram per state, so how fast
+the phone reacts to a call can be measured (see latency_summary).
+
+When a call ends its record, with the name of the caller resolved from
+the contacts and the outcome (answered, missed, busy, no answer or
+unanswered), is appended to the call log (see call_log.py). The FONA
+reports the end of an unanswered outgoing call with +CLCC before the
+BUSY or NO ANSWER which tells why, so such a call stays ENDED, with its
+record pending, until the next event or until settle is called (by the
+call thread when no event has come for END_GRACE seconds).
+
+Attributes:
+    IDLE, RINGING, DIALING, ALERTING, ACTIVE, HELD, ENDED (str): states
+    of the call
+    OUTGOING, INCOMING (int): directions of a call, as in +CLCC
+    CLCC_STATES (dict): state of each +CLCC state code
+    END_GRACE (float): seconds to wait for the reason an unanswered
+    outgoing call ended
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+IDLE = 'idle'
+RINGING = 'ringing'
+DIALING = 'dialing'
+ALERTING = 'alerting'
+ACTIVE = 'active'
+HELD = 'held'
+ENDED = 'ended'
+
+OUTGOING = 0
+INCOMING = 1
+
+# 0 active, 1 held, 2 dialing, 3 alerting, 4 incoming, 5 waiting, 6
+# disconnected
+CLCC_STATES = {0: ACTIVE, 1: HELD, 2: DIALING, 3: ALERTING, 4: RINGING,
+    5: RINGING, 6: ENDED}
+END_GRACE = 1.0
+
+Transition = namedtuple('Transition', 'state previous time latency reason')
+Call = namedtuple('Call', 'number name direction outcome started answered '
+    'ended transitions')
+
+logger = logging.getLogger(__name__)
+
+class Call_State_Machine(object):
+    """State of the call in progress, fed with URC events.
+
+    Attributes:
+        state (str): current state, one of IDLE to ENDED
+        number (str): number of the other party of the call in progress,
+        or None if it is not known (yet)
+        name (str): name of the contact of that number, or None
+        direction (int): OUTGOING or INCOMING, or None when IDLE
+        latency (dict): Histogram (see fona_stats.py) of the latency of
+        the transitions to each state
+    """
+
+    def __init__(self, resolve=None, log=None):
+        """Constructor for Call_State_Machine object.
+
+        Args:
+            resolve (callable): function of a number returning the name of
+            its contact, or None (default is None for no resolution)
+            log (call_log.Call_Log): log which every call is appended to
+            when it ends (default is None for no log)
+        """
+        self.resolve = resolve
+        self.log = log
+        self.state = IDLE
+        self.number = None
+        self.name = None
+        self.direction = None
+        self.latency = {}
+        self._listeners = []
+        self._reset()
+
+    def _reset(self):
+        self._started = None
+        self._answered = None
+        self._transitions = []
+        self._ending = None
+
+    @property
+    def settling(self):
+        """Whether a call has ended and its record waits for the reason
+        (see settle)."""
+        return self._ending is not None
+
+    def settle(self, event=None):
+        """Log the call which ended, if its record is pending, and return
+        to IDLE.
+
+        Arg:
+            event (named tuple): event which came after the end of the call,
+            whose reason is the reason of the end if it is a urc.Call_Ended
+            event, or None if no event came (default is None)
+        """
+        if self._ending is None:
+            return
+        transition = self._ending
+        self._ending = None
+        if event is None:
+            event = Call_Ended(None, monotonic())
+        if isinstance(event, Call_Ended) and event.reason is not None:
+            transition = transition._replace(reason=event.reason)
+            self._transitions[-1] = transition
+        self._end(transition, event)
+
+    def subscribe(self, callback):
+        """Call callback(transition) after every transition."""
+        self._listeners.append(callback)
+
+    def handle(self, event):
+        """Update the state with a URC event.
+
+        Arg:
+            event (named tuple): urc.Ring, urc.Caller_ID, urc.Call_Status
+            or urc.Call_Ended event; events of other types are ignored
+        """
+        if self._ending is not None:
+            self.settle(event)
+            if isinstance(event, Call_Ended):
+                return
+        if isinstance(event, Ring):
+            if self.state in (IDLE, ENDED):
+                self._begin(INCOMING, None)
+                self._transition(RINGING, event)
+        elif isinstance(event, Caller_ID):
+            if self.state in (IDLE, ENDED):
+                self._begin(INCOMING, event.number)
+                self._transition(RINGING, event)
+            elif self.number is None:
+                self._identify(event.number)
+        elif isinstance(event, Call_Status):
+            state = CLCC_STATES.get(event.state)
+            if state is None:
+                return
+            if self.state in (IDLE, ENDED):
+                if state == ENDED:
+                    return
+                self._begin(event.direction, event.number)
+            elif self.number is None and event.number:
+                self._identify(event.number)
+            self._transition(state, event)
+        elif isinstance(event, Call_Ended):
+            if self.state not in (IDLE, ENDED):
+                self._transition(ENDED, event, event.reason)
+
+    def _begin(self, direction, number):
+        """Start the record of a new call."""
+        self._reset()
+        self._started = time()
+        self.direction = direction
+        self.number = self.name = None
+        if number:
+            self._identify(number)
+
+    def _identify(self, number):
+        """Set the number of the call and resolve the name of its
+        contact."""
+        self.number = number
+        if self.resolve is not None:
+            try:
+                self.name = self.resolve(number)
+            except Exception:
+                logger.exception('Could not resolve caller %s' % number)
+
+    def _transition(self, state, event, reason=None):
+        """Move to a new state, unless already in it."""
+        if state == self.state:
+            return
+        latency = monotonic() - event.time
+        transition = Transition(state, self.state, time(), latency, reason)
+        self.state = state
+        self._transitions.append(transition)
+        self.latency.setdefault(state, Histogram()).add(latency)
+        if state == ACTIVE and self._answered is None:
+            self._answered = transition.time
+        logger.info('Call %s -> %s in %.1f ms' % (transition.previous, state,
+            latency * 1000))
+        for callback in self._listeners:
+            try:
+                callback(transition)
+            except Exception:
+                logger.exception('Call listener failed for %s'
+                    % (transition,))
+        if state == ENDED:
+            if reason is None and self.direction == OUTGOING and \
+                    self._answered is None:
+                self._ending = transition
+            else:
+                self._end(transition, event)
+
+    def _outcome(self, reason):
+        if self._answered is not None:
+            return 'answered'
+        if self.direction == INCOMING:
+            return 'missed'
+        if reason in ('BUSY', 'NO ANSWER'):
+            return reason.lower()
+        return 'unanswered'
+
+    def _end(self, transition, event):
+        """Append the call which ended to the log and return to IDLE."""
+        call = Call(self.number, self.name, self.direction,
+            self._outcome(transition.reason), self._started, self._answered,
+            transition.time, tuple(self._transitions))
+        if self.log is not None:
+            try:
+                self.log.append(call)
+            except Exception:
+                logger.exception('Could not log call %s' % (call,))
+        self._transition(IDLE, event)
+        self.direction = None
+        self._reset()
+
+    def latency_summary(self):
+        """Return a dict of the summary of the latency of the transitions
+        to each state (see fona_stats.Histogram.summary)."""
+        return {state: histogram.summary()
+            for state, histogram in self.latency.items()}
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from fona_commands import read_phonebook
+from sms_store import COUNTRY_CODE, normalize_number
+from unicodedata import combining, normalize
+
+import logging
+import os
+import quopri
+import re
+import sqlite3
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-24'
+__version__ = '1.0'
+
+"""Persistent Contacts Store with Caller ID and Dialer Indexes.
+
+Contacts, each a name with one or more labelled phone numbers, are kept
+in an SQLite database on the SD card. Three indexes of them are kept in
+memory by each Contacts_Store, built when it is opened:
+    a hash of the numbers in E.164 form (see sms_store.normalize_number)
+    to their contact, so that the name of a caller is found with one
+    dictionary lookup between RING and the first ring tone;
+    a trie of the words of the names, for the search of the contacts
+    application as the user types;
+    a trie of the keypad digits of the words of the names and of the
+    digits of the numbers, for T9 search in the dialer, where typing 526
+    finds Jan, Kamenar and +1 526 ....
+A store notices contacts written by another connection (e.g. the
+contacts application while the call thread waits for calls) by SQLite's
+data_version, which every lookup checks, and rebuilds its indexes then.
+
+Contacts are imported in bulk, one at a time as they are read so that a
+large address book is never held in memory, from vCard files (versions
+2.1, 3.0 and 4.0, as exported by phones and address books) with
+import_vcard, and from the SIM phonebook with import_sim, which reads it
+in ranges of indexes (see fona_commands.read_phonebook). Importing the
+same file or SIM twice does not duplicate contacts: a contact with the
+same name and a number in common, or from the same SIM index, is merged.
+
+Each Contacts_Store object has its own connection and must only be used
+from the thread which created it.
+
+Attributes:
+    DATABASE (str): default path of the contacts database
+    KEYPAD (dict): key of the phone keypad of each letter
+    BATCH (int): number of contacts imported per transaction
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'data', 'contacts.db')
+KEYPAD = {letter: key for key, letters in (('2', 'abc'), ('3', 'def'),
+    ('4', 'ghi'), ('5', 'jkl'), ('6', 'mno'), ('7', 'pqrs'), ('8', 'tuv'),
+    ('9', 'wxyz')) for letter in letters}
+BATCH = 100
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    sim_index INTEGER UNIQUE
+);
+CREATE TABLE IF NOT EXISTS numbers (
+    contact INTEGER NOT NULL REFERENCES contacts (id) ON DELETE CASCADE,
+    number TEXT NOT NULL,
+    label TEXT,
+    PRIMARY KEY (contact, number)
+);
+CREATE INDEX IF NOT EXISTS numbers_number ON numbers (number);
+'''
+_WORD = re.compile(r'\w+')
+_ESCAPE = re.compile(r'\\(.)')
+_IGNORED_TYPES = frozenset(('pref', 'voice', 'internet', 'quoted-printable'))
+
+Contact = namedtuple('Contact', 'id name numbers')
+
+logger = logging.getLogger(__name__)
+
+def name_words(name):
+    """Split a name into the lower case words it is searched by, without
+    diacritics, so that Šime is found by typing sime."""
+    name = ''.join(character for character in normalize('NFKD', name)
+        if not combining(character))
+    return _WORD.findall(name.lower())
+
+def keypad_digits(word):
+    """Return the keypad digits which spell a word, e.g. 526 for jan."""
+    return ''.join(KEYPAD.get(character, character)
+        for character in word if character in KEYPAD or character.isdigit())
+
+def _number_keys(number):
+    """Return the digit strings a number is found by in the dialer: its
+    digits with the country code and, for a number of the country of
+    the SIM, without it."""
+    digits = number.lstrip('+')
+    if number.startswith('+' + COUNTRY_CODE):
+        return (digits, digits[len(COUNTRY_CODE):])
+    return (digits,)
+
+class _Trie(object):
+    """Prefix tree from strings to sets of contact ids.
+
+    Attributes:
+        children (dict): subtree of each next character
+        ids (set): ids of the contacts with a string ending here
+    """
+
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = set()
+
+    def add(self, key, contact):
+        node = self
+        for character in key:
+            child = node.children.get(character)
+            if child is None:
+                child = node.children[character] = _Trie()
+            node = child
+        node.ids.add(contact)
+
+    def discard(self, key, contact):
+        """Remove a contact from a key, pruning the nodes left empty."""
+        path = [self]
+        for character in key:
+            node = path[-1].children.get(character)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].ids.discard(contact)
+        for depth in range(len(key), 0, -1):
+            if path[depth].ids or path[depth].children:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+
+    def find(self, prefix):
+        """Return the set of ids of the contacts with a key beginning with
+        prefix."""
+        node = self
+        for character in prefix:
+            node = node.children.get(character)
+            if node is None:
+                return set()
+        found = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            found.update(node.ids)
+            stack.extend(node.children.values())
+        return found
+
+def _unescape(value):
+    """Undo the backslash escapes of a vCard 3.0 or 4.0 value."""
+    return _ESCAPE.sub(lambda match: '\n' if match.group(1) in 'nN'
+        else match.group(1), value)
+
+def _properties(lines):
+    """Yield the (name, parameters, value) of each property of vCard
+    lines, unfolding continuation lines and decoding quoted-printable
+    values (vCard 2.1)."""
+    pending = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if pending is not None and line[:1] in (' ', '\t'):
+            pending += line[1:]
+            continue
+        if pending is not None and pending.endswith('=') and \
+                'QUOTED-PRINTABLE' in pending.split(':', 1)[0].upper():
+            pending = pending[:-1] + line
+            continue
+        if pending:
+            yield _property(pending)
+        pending = line
+    if pending:
+        yield _property(pending)
+
+def _property(line):
+    """Split one unfolded vCard line into its name, parameters and
+    value."""
+    head, _, value = line.partition(':')
+    name, *parameters = head.split(';')
+    name = name.rpartition('.')[2].upper()
+    parameters = [parameter.upper() for parameter in parameters]
+    if 'ENCODING=QUOTED-PRINTABLE' in parameters or \
+            'QUOTED-PRINTABLE' in parameters:
+        charset = next((parameter[8:] for parameter in parameters
+            if parameter.startswith('CHARSET=')), 'UTF-8')
+        try:
+            value = quopri.decodestring(value.encode('latin-1')).decode(
+                charset, 'replace')
+        except (LookupError, UnicodeEncodeError):
+            pass
+    return name, parameters, value
+
+def _label(parameters):
+    """Return the label of a TEL property, e.g. cell, from its TYPE
+    parameters (vCard 3.0 and 4.0) or bare parameters (vCard 2.1)."""
+    for parameter in parameters:
+        for value in parameter.split('=', 1)[-1].split(','):
+            value = value.strip('"').lower()
+            if '=' not in parameter or parameter.startswith('TYPE='):
+                if value and value not in _IGNORED_TYPES:
+                    return value
+    return None
+
+def read_vcards(lines):
+    """Yield the contacts of vCard lines, one card at a time.
+
+    Arg:
+        lines (iterable): lines of one or more vCards, e.g. an open file
+
+    Yields:
+        (name, numbers) tuples where numbers is a list of (number, label)
+        tuples; cards without a name or a number are skipped
+    """
+    name = structured = None
+    numbers = []
+    for key, parameters, value in _properties(lines):
+        if key == 'BEGIN':
+            name = structured = None
+            numbers = []
+        elif key == 'FN':
+            name = _unescape(value).strip()
+        elif key == 'N':
+            family, given, additional, prefix, suffix = ([_unescape(
+                part).strip() for part in re.split(r'(?<!\\);', value)]
+                + [''] * 5)[:5]
+            structured = ' '.join(part for part in (prefix, given,
+                additional, family, suffix) if part)
+        elif key == 'TEL':
+            number = value[4:] if value.lower().startswith('tel:') else value
+            numbers.append((number.strip(), _label(parameters)))
+        elif key == 'END':
+            name = name or structured
+            if name and numbers:
+                yield name, numbers
+            name = structured = None
+            numbers = []
+
+class Contacts_Store(object):
+    """Connection to the contacts database and its in-memory indexes.
+
+    Attribute:
+        connection (sqlite3.Connection): connection to the database
+    """
+
+    def __init__(self, path=DATABASE):
+        """Constructor for Contacts_Store object.
+
+        Opens (creating if necessary) the database at path in WAL mode
+        and builds the indexes of the contacts in it.
+
+        Arg:
+            path (str): path of the database file (default is DATABASE)
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(_SCHEMA)
+        self._data_version = None
+        self._refresh()
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def _refresh(self):
+        """Rebuild the indexes if another connection has changed the
+        database since they were built."""
+        version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+        self._contacts = {}
+        self._numbers = {}
+        self._names = _Trie()
+        self._keys = _Trie()
+        numbers = {}
+        for contact, number, label in self.connection.execute('SELECT '
+                'contact, number, label FROM numbers ORDER BY rowid'):
+            numbers.setdefault(contact, []).append((number, label))
+        for contact, name in self.connection.execute('SELECT id, name FROM '
+                'contacts'):
+            self._index(Contact(contact, name,
+                tuple(numbers.get(contact, ()))))
+
+    def _index(self, contact):
+        """Add a contact to the indexes."""
+        self._contacts[contact.id] = contact
+        for number, _ in contact.numbers:
+            self._numbers.setdefault(number, contact.id)
+            for key in _number_keys(number):
+                self._keys.add(key, contact.id)
+        for word in name_words(contact.name):
+            self._names.add(word, contact.id)
+            self._keys.add(keypad_digits(word), contact.id)
+
+    def _unindex(self, contact):
+        """Remove a contact from the indexes."""
+        del self._contacts[contact.id]
+        for number, _ in contact.numbers:
+            if self._numbers.get(number) == contact.id:
+                del self._numbers[number]
+                other = self.connection.execute('SELECT contact FROM numbers '
+                    'WHERE number = ? AND contact != ? LIMIT 1',
+                    (number, contact.id)).fetchone()
+                if other is not None:
+                    self._numbers[number] = other[0]
+            for key in _number_keys(number):
+                self._keys.discard(key, contact.id)
+        for word in name_words(contact.name):
+            self._names.discard(word, contact.id)
+            self._keys.discard(keypad_digits(word), contact.id)
+
+    def _write(self, contact, name, numbers, sim_index=None):
+        """Insert (contact None) or replace a contact and its numbers and
+        index it, without committing.
+
+        Returns:
+            Int of the id of the contact
+        """
+        if contact is None:
+            contact = self.connection.execute('INSERT INTO contacts (name, '
+                'sim_index) VALUES (?, ?)', (name, sim_index)).lastrowid
+        else:
+            self._unindex(self._contacts[contact])
+            self.connection.execute('UPDATE contacts SET name = ?, '
+                'sim_index = COALESCE(?, sim_index) WHERE id = ?',
+                (name, sim_index, contact))
+            self.connection.execute('DELETE FROM numbers WHERE contact = ?',
+                (contact,))
+        unique = []
+        for number, label in numbers:
+            if number and number not in [kept for kept, _ in unique]:
+                unique.append((number, label))
+        self.connection.executemany('INSERT INTO numbers (contact, number, '
+            'label) VALUES (?, ?, ?)', [(contact, number, label)
+            for number, label in unique])
+        self._index(Contact(contact, name, tuple(unique)))
+        return contact
+
+    def _commit(self):
+        """Commit the writes of this connection, which do not change its
+        data_version."""
+        self.connection.commit()
+        self._data_version = self.connection.execute(
+            'PRAGMA data_version').fetchone()[0]
+
+    def _rollback(self):
+        """Undo the writes since the last commit, and with them the
+        changes to the indexes."""
+        self.connection.rollback()
+        self._data_version = None
+        self._refresh()
+
+    def _normalize(self, numbers):
+        """Return (number, label) tuples with the numbers in E.164 form
+        from numbers given as strings or (number, label) tuples."""
+        return [(normalize_number(number), label) for number, label in
+            ((entry, None) if isinstance(entry, str) else entry
+            for entry in numbers)]
+
+    def _merge(self, name, numbers, sim_index=None):
+        """Add a contact, or merge it into the contact with the same SIM
+        index or the same name and a number in common, without
+        committing.
+
+        Returns:
+            Int of the id of the contact
+        """
+        contact = None
+        if sim_index is not None:
+            row = self.connection.execute('SELECT id FROM contacts WHERE '
+                'sim_index = ?', (sim_index,)).fetchone()
+            contact = row[0] if row is not None else None
+        if contact is None:
+            for number, _ in numbers:
+                found = self._contacts.get(self._numbers.get(number))
+                if found is not None and found.name.lower() == name.lower():
+                    contact = found.id
+                    break
+        if contact is not None:
+            numbers = list(self._contacts[contact].numbers) + numbers
+        return self._write(contact, name, numbers, sim_index)
+
+    def add(self, name, numbers):
+        """Store a new contact.
+
+        Args:
+            name (str): name of the contact
+            numbers (list): phone numbers of the contact, each a string or
+            a (number, label) tuple, e.g. ('+15551234567', 'cell')
+
+        Returns:
+            Int of the id of the new contact
+        """
+        self._refresh()
+        try:
+            contact = self._write(None, name, self._normalize(numbers))
+        except sqlite3.Error:
+            self._rollback()
+            raise
+        self._commit()
+        return contact
+
+    def update(self, contact, name, numbers):
+        """Replace the name and numbers of a contact.
+
+        Args:
+            contact (int): id of the contact
+            name (str): new name of the contact
+            numbers (list): new phone numbers, as for add
+
+        Raises:
+            KeyError if there is no contact with that id
+        """
+        self._refresh()
+        if contact not in self._contacts:
+            raise KeyError(contact)
+        try:
+            self._write(contact, name, self._normalize(numbers))
+        except sqlite3.Error:
+            self._rollback()
+            raise
+        self._commit()
+
+    def remove(self, contact):
+        """Delete a contact.
+
+        Returns:
+            True if there was a contact with that id; False otherwise
+        """
+        self._refresh()
+        if contact not in self._contacts:
+            return False
+        self.connection.execute('DELETE FROM contacts WHERE id = ?',
+            (contact,))
+        self._unindex(self._contacts[contact])
+        self._commit()
+        return True
+
+    def get(self, contact):
+        """Return the Contact named tuple (id, name, numbers) with an id,
+        or None if there is none."""
+        self._refresh()
+        return self._contacts.get(contact)
+
+    def lookup(self, number):
+        """Find the contact of a phone number, e.g. of a caller.
+
+        Arg:
+            number (str): phone number in any format (see
+            sms_store.normalize_number)
+
+        Returns:
+            Contact named tuple (id, name, numbers), or None if the number
+            is not one of a contact
+        """
+        self._refresh()
+        return self._contacts.get(self._numbers.get(normalize_number(number)))
+
+    def _sorted(self, ids, limit):
+        contacts = sorted((self._contacts[contact] for contact in ids),
+            key=lambda contact: contact.name.lower())
+        return contacts[:limit]
+
+    def search(self, query, limit=20):
+        """Find the contacts whose names contain a word beginning with
+        each word of a query, e.g. ma ko for Marko Kovač.
+
+        Returns:
+            List of Contact named tuples in order of name
+        """
+        self._refresh()
+        found = None
+        for word in name_words(query):
+            ids = self._names.find(word)
+            found = ids if found is None else found & ids
+            if not found:
+                return []
+        return self._sorted(found if found is not None else self._contacts,
+            limit)
+
+    def dial_search(self, digits, limit=20):
+        """Find the contacts matching keys typed on the dialer: those with
+        a word of the name spelt by the keys as the beginning of a T9
+        word (e.g. 526 for Jan) and those with a number beginning with
+        them, with or without the country code.
+
+        Returns:
+            List of Contact named tuples in order of name
+        """
+        self._refresh()
+        digits = re.sub(r'\D', '', digits)
+        if not digits:
+            return []
+        return self._sorted(self._keys.find(digits), limit)
+
+    def import_contacts(self, contacts, batch=BATCH):
+        """Merge contacts into the store from an iterable, committing every
+        batch of them.
+
+        Args:
+            contacts (iterable): (name, numbers) tuples, numbers as for add
+            batch (int): number of contacts per transaction (default is
+            BATCH)
+
+        Returns:
+            Int of the number of contacts imported
+        """
+        self._refresh()
+        imported = 0
+        try:
+            for name, numbers in contacts:
+                self._merge(name, self._normalize(numbers))
+                imported += 1
+                if imported % batch == 0:
+                    self._commit()
+        except Exception:
+            self._rollback()
+            raise
+        self._commit()
+        return imported
+
+    def import_vcard(self, path, batch=BATCH):
+        """Merge the contacts of a vCard file into the store, reading it
+        one card at a time.
+
+        Returns:
+            Int of the number of contacts imported
+        """
+        with open(path, encoding='utf-8', errors='replace') as lines:
+            imported = self.import_contacts(read_vcards(lines), batch)
+        logger.info('Imported %d contacts from %s' % (imported, path))
+        return imported
+
+    def import_sim(self, batch=BATCH):
+        """Merge the entries of the SIM phonebook into the store, reading
+        it in ranges of indexes (see fona_commands.read_phonebook).
+
+        An entry already imported from the same SIM index replaces its
+        contact's name and adds its number.
+
+        Returns:
+            Int of the number of entries imported
+        """
+        self._refresh()
+        imported = 0
+        try:
+            for entry in read_phonebook():
+                if not entry.name or not entry.number:
+                    continue
+                number = entry.number
+                if entry.type == 145 and not number.startswith('+'):
+                    number = '+' + number
+                self._merge(entry.name, [(normalize_number(number), None)],
+                    entry.index)
+                imported += 1
+                if imported % batch == 0:
+                    self._commit()
+        except Exception:
+            self._rollback()
+            raise
+        self._commit()
+        logger.info('Imported %d contacts from the SIM' % imported)
+        return imported
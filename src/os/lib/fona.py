@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 
+from contextlib import contextmanager
+from functools import lru_cache
+from glob import glob
+from queue import Queue
 from serial import Serial
-from time import sleep
+from threading import RLock, local
+from time import monotonic
+from registration import registration
+from urc import Modem_Ready, Power, dispatcher, parse_urc
 
+import json
 import logging
+import os
+import re
 
 __author__ = 'Nikola Istvanic'
 __date__ = '2017-05-24'
@@ -21,33 +31,308 @@ from the FONA device.
 In order to execute these instructions, the commands must be written to
 the FONA device through a serial port; this is done in the send_command
 method which is utilized by almost every other method. The serial port
-is opened in the /dev/ttyUSB0 port which is where the FONA device should
-be plugged for the purpose of this library. To check where the FONA
+is not opened when this library is imported but by connect, which is
+called on the first command. connect looks for the FONA by writing AT
+to each of the CANDIDATE_PORTS (USB converters such as /dev/ttyUSB0
+first) at each of the BAUD_RATES until one answers OK; the SIM800 is
+auto-bauding by default, so it answers at whichever rate it is spoken
+to. The link is then raised to TARGET_BAUD with AT+IPR, falling back to
+the rate which worked if the FONA does not answer at the new one, and
+the port and rate are saved in the SETTINGS file so that the next boot
+tries them first and connects with one probe. To check where the FONA
 device is connected if at all, use the Linux terminal command:
     dmesg | grep tty
 and search for usb 1-1.5: pl2303 converter now attached to ttyXXXX. If
-the XXXX is not USB0, change the serial port creation below to match. If
 such a string does not appear, check that the FONA device is connected
-to the Raspberry Pi and powered on.
+to the Raspberry Pi and powered on. The FONA_PORT environment variable
+restricts discovery to one port, e.g. to use the SIM800 emulator (see
+sim800_emulator.py) on a machine without a FONA device, and the
+FONA_SETTINGS environment variable overrides the path of the settings.
+
+Commands are answered by the FONA with zero or more information lines
+followed by a final result code (OK, ERROR, +CME ERROR: <n>, etc.).
+Rather than sleeping and waiting for the serial timeout to expire, the
+response reader below parses the incoming byte stream line by line and
+returns as soon as the final result code (or the > prompt of commands
+such as AT+CMGS) arrives, so a command costs only as long as the FONA
+takes to answer it. Each read has a deadline which defaults to
+DEFAULT_TIMEOUT and may be raised per command verb in COMMAND_TIMEOUTS.
+
+Unsolicited result codes (see urc.py) which the FONA writes between or
+in the middle of responses are taken out of the output and published to
+urc.dispatcher, so that incoming calls and SMSs are noticed as soon as
+their URC arrives instead of by polling.
+
+When the asyncio driver (see fona_async.py) is running it is the only
+owner of the serial port: attach_driver hands it the port and from then
+on command submits to the driver and blocks on the result, so the
+helpers in fona_commands work unchanged from any thread other than the
+driver's event loop.
+
+Several extended commands can share one command line, e.g.
+    AT+CSQ;+CBC;+CREG?
+which the FONA answers with the information lines of each command and a
+single final result code. command_batch writes such a line and splits
+the response back into one output per command, so that a set of queries
+costs one round trip instead of one each.
+
+Commands submitted to the driver have one of three priorities: CALL for
+call control, USER for what the user is waiting on (the default) and
+BACKGROUND for syncing and polling. The driver always writes the queued
+command with the highest priority next, so answering a call never waits
+behind more than the one background command already in flight. A
+thread can change the priority of all the commands it sends in a block
+with command_priority, e.g.
+    with command_priority(BACKGROUND):
+        store.sync(fona_commands)
 
 Attributes:
-    baud (int): baud rate for FONA device
     fona_port (serial.Serial): serial port where FONA commands are
-    written. In this case, the port is located at /dev/ttyUSB0. Since
-    this serial port must be written to by multiple threads (SMS_Thread,
+    written, or None until connect has found the FONA. Since this serial
+    port must be written to by multiple threads (SMS_Thread,
     Call_Thread, UI_Thread), there must be a thread lock to ensure only
-    one thread has access to this shared port. This port uses the
-    previously declared baud as its baud rate and a timeout of 1 second
+    one thread has access to this shared port
+    port_lock (threading.RLock): lock held for the whole exchange of a
+    command and its response when no driver is attached, so that no
+    other thread reads or writes the port in the middle of it
     logger (logging.logger): logging object to display diagnostic
     information
+    DEFAULT_TIMEOUT (float): seconds to wait for a final result code
+    before giving up on a response
+    COMMAND_TIMEOUTS (dict): per verb deadlines, in seconds, for
+    commands which the SIM800 manual lists as slow to answer
+    FINAL_RESULTS (tuple): lines which terminate a response
+    FINAL_PREFIXES (tuple): prefixes of lines which terminate a response
+    TCP_RESULTS (tuple): lines which terminate the response to a command
+    of the TCP stack (AT+CIPSEND, AT+CIPCLOSE, AT+CIPSHUT) instead of OK,
+    after the link number and a comma in multi-connection mode
+    MODE_REGISTERS (tuple): settings whose values are cached by
+    set_mode: echo (E), SMS format (+CMGF), SMS text mode header
+    (+CSDH), caller ID (+CLIP), extended errors (+CMEE), character
+    set (+CSCS), phonebook storage (+CPBS), slow clock (+CSCLK) and
+    multi-connection mode (+CIPMUX)
+    RESET_VERBS (tuple): verbs of commands which return the settings to
+    their defaults and so invalidate the cache
+    PAYLOAD_CHUNK (int): bytes of a payload written before waiting for
+    them to be sent
+    MAX_LINE (int): greatest number of characters the SIM800 accepts on
+    one command line, including the AT prefix
+    CANDIDATE_PORTS (tuple): glob patterns of the devices probed for the
+    FONA, in order
+    BAUD_RATES (tuple): baud rates probed on each device, in order
+    TARGET_BAUD (int): baud rate negotiated with AT+IPR once the FONA
+    is found
+    SETTINGS (str): path of the file the port and baud rate which worked
+    are saved in
+    CALL, USER, BACKGROUND (int): command priorities, highest first
+    PRIORITIES (tuple): names of the command priorities
 """
 
-baud = 9600
-fona_port = Serial('/dev/ttyUSB0', baud, timeout=1)
+fona_port = None
+port_lock = RLock()
+
+DEFAULT_TIMEOUT = 1
+COMMAND_TIMEOUTS = {
+    'ATD': 20,
+    'ATA': 20,
+    'ATH': 20,
+    'AT+CMGS': 60,
+    'AT+CMGSEX': 60,
+    'AT+CMGL': 20,
+    'AT+CMGD': 25,
+    'AT+CPBR': 10,
+    'AT+COPS': 120,
+    'AT+CIPGSMLOC': 60,
+    'AT+CIPSTART': 75,
+    'AT+CIPSEND': 60,
+    'AT+CIPRXGET': 10,
+    'AT+CIPCLOSE': 20,
+    'AT+CIPSHUT': 65,
+    'AT+CIICR': 85,
+    'AT+SAPBR': 85,
+    'AT+HTTPACTION': 120,
+}
+FINAL_RESULTS = ('OK', 'ERROR', 'NO CARRIER', 'BUSY', 'NO ANSWER',
+    'NO DIALTONE')
+FINAL_PREFIXES = ('+CME ERROR', '+CMS ERROR')
+TCP_RESULTS = ('SEND OK', 'SEND FAIL', 'CLOSE OK', 'SHUT OK')
+PROMPT = '>'
+PROMPTS = (PROMPT, 'DOWNLOAD')
+EOT = chr(26)
+PAYLOAD_CHUNK = 128
+MAX_LINE = 556
+CALL, USER, BACKGROUND = range(3)
+PRIORITIES = ('call', 'user', 'background')
+CANDIDATE_PORTS = ('/dev/ttyUSB*', '/dev/serial0', '/dev/ttyAMA0',
+    '/dev/ttyS0')
+BAUD_RATES = (115200, 9600, 57600, 38400, 19200)
+TARGET_BAUD = 115200
+SETTINGS = os.environ.get('FONA_SETTINGS', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'data', 'fona.json'))
+
+MODE_REGISTERS = ('E', '+CMGF', '+CSDH', '+CLIP', '+CMEE', '+CSCS',
+    '+CPBS', '+CSCLK', '+CIPMUX')
+RESET_VERBS = ('ATZ', 'AT&F', 'AT+CFUN', 'AT+CPOWD', 'AT+IPR')
+
+_VERB = re.compile(r'AT(?:[+#$%&*][A-Z]+|[A-Z])?', re.IGNORECASE)
+_TCP_RESULT = re.compile(r'(?:\d, )?(%s)$' % '|'.join(TCP_RESULTS))
+_MODE_COMMAND = re.compile(r'AT(E|\+[A-Z]+=)"?([^";]*)"?$', re.IGNORECASE)
+_buffer = bytearray()
+_driver = None
+_modes = {}
+_local = local()
+
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s '
     '%(module)s::%(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
 logger = logging.getLogger(__name__)
 
+def _load_settings():
+    """Return the saved link settings, or an empty dict if none."""
+    try:
+        with open(SETTINGS) as settings:
+            return json.load(settings)
+    except (OSError, ValueError):
+        return {}
+
+def _save_settings(settings):
+    """Save the link settings, replacing the file atomically."""
+    directory = os.path.dirname(SETTINGS)
+    try:
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(SETTINGS + '.tmp', 'w') as temporary:
+            json.dump(settings, temporary)
+        os.replace(SETTINGS + '.tmp', SETTINGS)
+    except OSError:
+        logger.warning('Could not save FONA settings to %s' % SETTINGS)
+
+def _candidates(saved):
+    """Return the device paths to probe for the FONA, in order."""
+    if 'FONA_PORT' in os.environ:
+        return [os.environ['FONA_PORT']]
+    ports = [saved['port']] if 'port' in saved else []
+    for pattern in CANDIDATE_PORTS:
+        ports.extend(sorted(glob(pattern)))
+    return [port for index, port in enumerate(ports)
+        if port not in ports[:index] and os.path.exists(port)]
+
+def _probe(serial_port, attempts=2):
+    """Determine if the FONA answers AT with OK at the port's baud rate.
+
+    An auto-bauding SIM800 may miss the first AT while it locks onto the
+    rate, so the probe is repeated.
+
+    Args:
+        serial_port (serial.Serial): open serial port
+        attempts (int): number of times to write AT (default is 2)
+
+    Returns:
+        True if the FONA answered OK; False otherwise
+    """
+    for _ in range(attempts):
+        serial_port.reset_input_buffer()
+        serial_port.write(b'AT\r')
+        if _answer(serial_port, 0.3) == 'OK':
+            return True
+    return False
+
+def _answer(serial_port, timeout):
+    """Read from the port until OK or ERROR, returning which one, or
+    None if neither arrived in time."""
+    response = bytearray()
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        serial_port.timeout = max(deadline - monotonic(), 0)
+        response.extend(serial_port.read(serial_port.in_waiting or 1))
+        for result in (b'\r\nOK\r\n', b'\r\nERROR\r\n'):
+            if result in response:
+                return result.strip().decode()
+    return None
+
+def _find_baud(serial_port, rates):
+    """Set the port to the first of rates at which the FONA answers.
+
+    Returns:
+        True if the FONA answered at one of the rates; False otherwise
+    """
+    for rate in rates:
+        serial_port.baudrate = rate
+        if _probe(serial_port):
+            return True
+    return False
+
+def _negotiate(serial_port):
+    """Raise the link to TARGET_BAUD with AT+IPR.
+
+    The FONA answers OK at the old rate and then switches. If it does
+    not answer at the new rate, the port goes back to looking for the
+    rate it does answer at.
+
+    Returns:
+        True if the FONA still answers; False if it was lost
+    """
+    previous = serial_port.baudrate
+    if previous == TARGET_BAUD:
+        return True
+    serial_port.reset_input_buffer()
+    serial_port.write(('AT+IPR=%d\r' % TARGET_BAUD).encode('utf-8'))
+    if _answer(serial_port, 1) == 'OK':
+        serial_port.baudrate = TARGET_BAUD
+        if _probe(serial_port):
+            logger.info('FONA link raised from %d to %d baud'
+                % (previous, TARGET_BAUD))
+            return True
+    logger.warning('FONA did not answer at %d baud, staying at %d'
+        % (TARGET_BAUD, previous))
+    return _find_baud(serial_port, (previous,) + BAUD_RATES)
+
+def connect():
+    """Return the open serial port of the FONA device, finding the FONA
+    and negotiating the baud rate first if the port is not open yet.
+
+    The saved port and baud rate (see SETTINGS) are tried first, then
+    every other device matching CANDIDATE_PORTS at every one of the
+    BAUD_RATES. Once the FONA answers, the link is raised to
+    TARGET_BAUD and the settings which worked are saved. The cache of
+    mode settings is cleared (see invalidate_modes), since the FONA may
+    have been reset while the port was closed.
+
+    Raises:
+        IOError if no candidate port answers AT
+
+    Returns:
+        serial.Serial of the FONA device
+    """
+    global fona_port
+    with port_lock:
+        if fona_port is not None and fona_port.is_open:
+            return fona_port
+        saved = _load_settings()
+        rates = [saved['baud']] if 'baud' in saved else []
+        rates += [rate for rate in BAUD_RATES if rate not in rates]
+        ports = _candidates(saved)
+        for port in ports:
+            try:
+                serial_port = Serial(port, rates[0], timeout=1)
+            except OSError:
+                continue
+            if _find_baud(serial_port, rates) and _negotiate(serial_port):
+                break
+            serial_port.close()
+        else:
+            raise IOError('No FONA device answered on %s' % (ports,))
+        serial_port.reset_input_buffer()
+        serial_port.timeout = 1
+        logger.info('Connected to FONA device on %s at %d baud'
+            % (serial_port.name, serial_port.baudrate))
+        if saved != {'port': serial_port.name, 'baud': serial_port.baudrate}:
+            _save_settings({'port': serial_port.name,
+                'baud': serial_port.baudrate})
+        _buffer.clear()
+        invalidate_modes()
+        fona_port = serial_port
+        return fona_port
+
 def send_command(data):
     """Write string command to serial port for the FONA device. See
     README.md for list of commands and their expected outputs/functions.
@@ -65,18 +350,17 @@ def send_command(data):
     calling this method should have the thread lock for writing to the
     FONA device serial port.
 
-    NOTE: allow for Raspberry Pi to sleep for at least 0.2 seconds
-    between calls of this method to allow for complete write of the data
-    parameter. Without a time.sleep(0.2) between calls, data is written
-    to the serial port too fast for the FONA to successfully read from.
+    This method does not wait for the FONA to answer. Callers should
+    read the response with get_output (or use the command method which
+    does both) before writing the next command, otherwise data is
+    written to the serial port faster than the FONA can read it.
 
     Arg:
         data (str): string command. NOTE: \r is appended to commands
     """
     # TODO: fix this so that it tries multiple times to communicate with serial port if unsuccessful the first time
     logger.info('Sending data %s to FONA device' % data)
-    fona_port.write((data + '\r').encode('utf-8'))
-    sleep(0.2)
+    connect().write((data + '\r').encode('utf-8'))
 
 def send_eot():
     """Send the signal for CTRL-Z to the FONA device serial port which
@@ -93,28 +377,568 @@ def send_eot():
     method, but the signal for CTRL-Z must be sent by its character
     representation (ASCII character value of 26).
     """
-    send_command(chr(26))
+    send_command(EOT)
+
+def send_payload(payload):
+    """Write data to the FONA device serial port as it is, without the
+    \r which terminates commands.
+
+    Used to write the body of an SMS, email, or TCP packet once the FONA
+    has prompted for it. The payload is written PAYLOAD_CHUNK bytes at a
+    time, waiting for each chunk to leave the UART before writing the
+    next, so a long payload never overruns the FONA's receive buffer.
+
+    Arg:
+        payload (str or bytes): data to write, encoded in UTF-8 if a
+        string
+    """
+    logger.info('Sending %d byte payload to FONA device' % len(payload))
+    serial_port = connect()
+    data = _payload_bytes(payload)
+    for start in range(0, len(data), PAYLOAD_CHUNK):
+        serial_port.write(data[start:start + PAYLOAD_CHUNK])
+        serial_port.flush()
+
+def _payload_bytes(payload):
+    """Return a payload as bytes, e.g. a TCP segment as it is and the
+    body of an SMS encoded in UTF-8."""
+    return payload if isinstance(payload, bytes) else payload.encode('utf-8')
+
+def get_verb(data):
+    """Return the verb of an AT command, i.e. the command without its
+    parameters, in upper case. For example AT+CMGR=3 has the verb
+    AT+CMGR and ATD5551234; has the verb ATD.
+
+    Arg:
+        data (str): string command
+
+    Returns:
+        String of the command verb, or the empty string if data is not
+        an AT command
+    """
+    match = _VERB.match(data.lstrip())
+    return match.group(0).upper() if match else ''
+
+def is_final(line):
+    """Determine if a line of FONA output is a final result code which
+    terminates the response to a command.
+
+    Arg:
+        line (str): line of output with its line terminator removed
+
+    Returns:
+        True if the line is OK, ERROR, +CME ERROR: <n>, +CMS ERROR: <n>,
+        one of the final result codes of ATD or one of the TCP_RESULTS;
+        False otherwise
+    """
+    return (line in FINAL_RESULTS or line.startswith(FINAL_PREFIXES) or
+        line.endswith(TCP_RESULTS) and _TCP_RESULT.match(line) is not None)
+
+def _next_line(deadline, prompt):
+    """Return the next complete line of FONA output, reading from the
+    serial port only as much as is needed.
+
+    Bytes which arrive after the returned line are kept in the module
+    buffer for the next call. If prompt is True, the > prompt (which is
+    not followed by a line terminator) is returned as its own line.
+
+    Args:
+        deadline (float): time.monotonic value after which to give up
+        prompt (bool): whether the > prompt is expected
+
+    Returns:
+        String of the line with trailing whitespace removed, or None if
+        the deadline passed before a complete line arrived
+    """
+    while True:
+        index = _buffer.find(b'\n')
+        if index >= 0:
+            line = _buffer[:index].decode('utf-8', 'replace').rstrip()
+            del _buffer[:index + 1]
+            return line
+        if prompt and _buffer.lstrip(b'\r').startswith(PROMPT.encode()):
+            _buffer.clear()
+            return PROMPT
+        remaining = deadline - monotonic()
+        serial_port = connect()
+        waiting = serial_port.in_waiting
+        if remaining <= 0 and not waiting:
+            return None
+        serial_port.timeout = max(remaining, 0)
+        _buffer.extend(serial_port.read(max(1, waiting)))
+
+@lru_cache(maxsize=256)
+def response_prefixes(data):
+    """Return the information prefixes of the response to a command.
+
+    A line of concatenated commands (see command_batch) is answered with
+    the information lines of each of its commands, so for example
+    AT+CSQ;+CBC;+CREG? has the prefixes ('+CSQ:', '+CBC:', '+CREG:').
+    Quoted parameters are skipped, so a ; inside them does not start a
+    command.
+
+    Arg:
+        data (str): string command
+
+    Returns:
+        Tuple of the prefixes, with their colons, in upper case
+    """
+    data = re.sub(r'"[^"]*"', '""', data.strip())
+    if data[:2].upper() != 'AT':
+        return ()
+    return tuple(match.upper() + ':' for match in
+        re.findall(r'(?:^AT|;)\s*(\+[A-Z]+)', data, re.IGNORECASE))
+
+def publish_urc(line, data=''):
+    """Publish a line of output as an event if it is a URC.
+
+    A line which begins with the information prefix of the command in
+    flight (e.g. +CREG: 0,1 in the response to AT+CREG? or to
+    AT+CSQ;+CREG?) is part of the response, not a URC, even though the
+    FONA uses the same prefix for both.
+
+    Args:
+        line (str): line of output with its line terminator removed
+        data (str): command in flight (default is none)
+
+    Returns:
+        True if the line was a URC and has been published; False if it
+        belongs to the response
+    """
+    if line.startswith(response_prefixes(data)):
+        return False
+    event = parse_urc(line)
+    if event is None:
+        return False
+    logger.debug('URC %s' % line)
+    dispatcher.publish(event)
+    return True
+
+def read_unsolicited(timeout=0):
+    """Read and publish the URCs waiting on the serial port.
+
+    Called between commands, every complete line on the port is
+    unsolicited; the ones which are URCs are published to
+    urc.dispatcher and the others (stray echoes, blank lines) are
+    dropped.
+
+    Arg:
+        timeout (float): seconds to keep reading for (default is 0, only
+        read what has already arrived)
+    """
+    with port_lock:
+        deadline = monotonic() + timeout
+        while True:
+            line = _next_line(deadline, False)
+            if line is None:
+                return
+            publish_urc(line)
 
-def get_output():
+def iter_output(timeout=DEFAULT_TIMEOUT, prompt=False, data=''):
+    """Yield the lines of output of the FONA device as they arrive
+    until the final result code of the response.
+
+    Unlike reading until the serial port times out, this generator
+    stops as soon as a final result code (see is_final) is read, or the
+    > prompt if prompt is True, so the caller never waits longer than
+    the FONA takes to answer. Lines are yielded in the same form as the
+    legacy output: the command echo, information lines, the empty lines
+    between them and finally the result code. URCs are published to
+    urc.dispatcher instead of being yielded.
+
+    Args:
+        timeout (float): seconds after which to stop waiting for the
+        final result code (default is DEFAULT_TIMEOUT)
+        prompt (bool): whether the response ends with the > prompt
+        instead of a final result code (default is False)
+        data (str): command whose response is being read, used to tell
+        its information lines from URCs (default is none)
+
+    Yields:
+        String of each line of output with its line terminator removed
+    """
+    deadline = monotonic() + timeout
+    while True:
+        line = _next_line(deadline, prompt)
+        if line is None:
+            logger.warning('No final result code after %s seconds' % timeout)
+            return
+        if is_final(line) or (prompt and line in PROMPTS):
+            yield line
+            return
+        if not publish_urc(line, data):
+            yield line
+
+def get_output(timeout=DEFAULT_TIMEOUT, prompt=False, data=''):
     """Obtain and return the output of the FONA device after entering a
     command.
 
     When sending a command to the FONA device through the command line,
-    after a short delay, the device prints to the terminal line(s) of
-    output depending on the command entered. This method returns a
-    string array of the output of the FONA device after writing a
-    desired command.
+    the device prints to the terminal line(s) of output depending on the
+    command entered followed by a final result code. This method returns
+    a string array of the output of the FONA device after writing a
+    desired command as soon as the final result code arrives.
+
+    Args:
+        timeout (float): seconds after which to stop waiting for the
+        final result code (default is DEFAULT_TIMEOUT)
+        prompt (bool): whether the response ends with the > prompt
+        (default is False)
+        data (str): command whose response is being read (default is
+        none)
 
     Returns:
         String array of output from the FONA device
     """
-    output = fona_port.readlines()
-    for i in range(len(output)):
-        output[i] = output[i].rstrip()
-    logger.info('Flushing serial port contents:\n%s' % output)
+    output = list(iter_output(timeout, prompt, data))
+    logger.debug('FONA output:\n%s', output)
     return output
 
+def get_timeout(data):
+    """Return the deadline, in seconds, for the response to a command.
+
+    Arg:
+        data (str): string command
+
+    Returns:
+        Float of the seconds in COMMAND_TIMEOUTS for the command verb,
+        or DEFAULT_TIMEOUT if the verb is not listed
+    """
+    return COMMAND_TIMEOUTS.get(get_verb(data), DEFAULT_TIMEOUT)
+
+def attach_driver(driver):
+    """Route every command through the asyncio driver which owns the
+    serial port, or back to direct reads and writes.
+
+    Arg:
+        driver (fona_async.FONA_Driver): running driver, or None to
+        detach it
+    """
+    global _driver
+    _driver = driver
+
+def driver_attached():
+    """Return whether an asyncio driver owns the serial port, reading
+    URCs as they arrive; without one, URCs are only read between
+    commands or by read_unsolicited."""
+    return _driver is not None
+
+def get_priority():
+    """Return the priority of the commands sent by the calling thread
+    which do not give one (USER unless changed by command_priority)."""
+    return getattr(_local, 'priority', USER)
+
+@contextmanager
+def command_priority(priority):
+    """Give every command sent by the calling thread in a with block the
+    given priority, e.g. BACKGROUND for a sync.
+
+    Arg:
+        priority (int): CALL, USER or BACKGROUND
+    """
+    previous = get_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def command(data, timeout=None, prompt=False, payload=None, priority=None):
+    """Write a command to the FONA device and return its output.
+
+    The output is read until the final result code of the response, so
+    this method returns as soon as the FONA has answered. Any command
+    written after this method returns is guaranteed not to overlap with
+    the response to this one. URCs which arrived right behind the
+    response are published before this method returns.
+
+    If payload is given, the command must make the FONA prompt for data
+    (with > or DOWNLOAD); the payload is written as soon as the prompt
+    arrives and the output of both is returned. The whole exchange
+    happens without any other command in between.
+
+    If an asyncio driver is attached (see attach_driver), the command is
+    submitted to it with the given priority and this method blocks until
+    the driver has the response; it must then not be called from the
+    driver's event loop.
+
+    Args:
+        data (str): string command
+        timeout (float): seconds to wait for the final result code
+        (default is the deadline for the command verb, see get_timeout)
+        prompt (bool): whether the response ends with the > prompt
+        (default is False)
+        payload (str or bytes): data to write once prompted (default is
+        None)
+        priority (int): CALL, USER or BACKGROUND (default is the
+        priority of the calling thread, see command_priority)
+
+    Raises:
+        RuntimeError if called from the event loop of the attached driver
+        registration.Offline_Error if the command needs the network and
+        the FONA is not registered (see registration.py)
+
+    Returns:
+        String array of output from the FONA device
+    """
+    registration.check(get_verb(data), data)
+    if timeout is None:
+        timeout = get_timeout(data)
+    if _driver is not None:
+        if priority is None:
+            priority = get_priority()
+        output = _driver.submit(data, timeout, prompt, payload,
+            priority=priority).result()
+    else:
+        with port_lock:
+            send_command(data)
+            output = get_output(timeout, prompt or payload is not None, data)
+            if payload is not None and output[-1:] and output[-1] in PROMPTS:
+                send_payload(payload)
+                output += get_output(timeout, False, data)
+            read_unsolicited()
+    _track_modes(data, output)
+    return output
+
+def _track_modes(data, output):
+    """Update the cache of mode settings after a command.
+
+    A successful write of one of the MODE_REGISTERS records its value; a
+    failed one forgets it, since the FONA may or may not have applied
+    it. A successful command with one of the RESET_VERBS forgets all.
+
+    Args:
+        data (str): string command which was written
+        output (str list): output of the FONA device for the command
+    """
+    succeeded = output[-1:] == ['OK']
+    if get_verb(data) in RESET_VERBS:
+        if succeeded:
+            invalidate_modes()
+        return
+    match = _MODE_COMMAND.match(data.strip())
+    if match is None:
+        return
+    name = match.group(1).rstrip('=').upper()
+    if name not in MODE_REGISTERS:
+        return
+    if succeeded:
+        _modes[name] = match.group(2).upper()
+    else:
+        _modes.pop(name, None)
+
+def invalidate_modes(event=None):
+    """Forget every cached mode setting.
+
+    Called whenever the FONA may have returned to its default settings:
+    after a reset command, when the FONA reports that it has (re)started
+    or lost power (urc.Modem_Ready and urc.Power events), and whenever
+    the serial port is (re)opened.
+
+    Arg:
+        event (namedtuple): URC event which caused the invalidation, if
+        any (default is None)
+    """
+    if _modes:
+        logger.info('Forgetting cached FONA settings %s' % _modes)
+    _modes.clear()
+
+def set_mode(name, value):
+    """Change one of the FONA mode settings unless it already has the
+    value.
+
+    The SMS helpers need PDU mode (AT+CMGF=0) before every operation,
+    but it only changes when the FONA resets. The values last written
+    successfully are cached, so repeating a setting costs nothing
+    instead of a round trip.
+
+    Args:
+        name (str): one of the MODE_REGISTERS, e.g. +CMGF or E
+        value (str or int): value of the setting, e.g. 1 or GSM
+
+    Raises:
+        ValueError if name is not one of the MODE_REGISTERS
+
+    Returns:
+        String array of output from the FONA device, or an empty array
+        if the FONA already had the setting
+    """
+    name = name.upper()
+    if name not in MODE_REGISTERS:
+        raise ValueError('%s is not a cached mode setting' % name)
+    value = str(value).upper()
+    if _modes.get(name) == value:
+        return []
+    if name == 'E':
+        return command('ATE' + value)
+    if name in ('+CSCS', '+CPBS'):
+        return command('AT%s="%s"' % (name, value))
+    return command('AT%s=%s' % (name, value))
+
+def get_mode(name):
+    """Return the cached value of a mode setting, or None if unknown."""
+    return _modes.get(name.upper())
+
+dispatcher.subscribe(Modem_Ready, invalidate_modes)
+dispatcher.subscribe(Power, invalidate_modes)
+
+def iter_command(data, timeout=None):
+    """Write a command to the FONA device and yield the lines of its
+    output as they arrive.
+
+    Long responses such as the listing of every SMS on the SIM can be
+    processed while the FONA is still writing them. The generator must
+    be consumed in the thread that created it; if it is closed before
+    the final result code, the rest of the response is read and dropped
+    so that the next command starts on a clean line.
+
+    Args:
+        data (str): string command
+        timeout (float): seconds to wait for the final result code
+        (default is the deadline for the command verb, see get_timeout)
+
+    Yields:
+        String of each line of output, as in the array command returns
+    """
+    if timeout is None:
+        timeout = get_timeout(data)
+    if _driver is not None:
+        lines = Queue()
+        future = _driver.submit(data, timeout, sink=lines.put,
+            priority=get_priority())
+        future.add_done_callback(lambda future: lines.put(None))
+        while True:
+            line = lines.get()
+            if line is None:
+                future.result()
+                return
+            yield line
+    with port_lock:
+        send_command(data)
+        output = iter_output(timeout, False, data)
+        try:
+            for line in output:
+                yield line
+        finally:
+            for line in output:
+                pass
+            read_unsolicited()
+
+def _batchable(commands):
+    """Determine if commands can be concatenated on one command line."""
+    return (len(commands) > 1 and
+        all(data.upper().startswith('AT+') and ';' not in data
+            for data in commands) and
+        len(commands[0]) + sum(len(data) - 1 for data in commands[1:])
+            <= MAX_LINE)
+
+def split_batch(commands, output):
+    """Split the output of a line of concatenated commands into the
+    output of each command.
+
+    Information lines are assigned to the command whose prefix they
+    begin with (the FONA answers the commands in order), lines without a
+    known prefix to the command answered last, and the final result code
+    is appended to the output of every command. The command echo and
+    empty lines are dropped.
+
+    Args:
+        commands (str list): string commands in the order they were
+        concatenated
+        output (str list): output of the FONA device for the line
+
+    Returns:
+        List of one string array of output per command
+    """
+    prefixes = [response_prefixes(data) for data in commands]
+    results = [[] for _ in commands]
+    current = 0
+    for line in output:
+        if not line or line.upper().startswith('AT'):
+            continue
+        if is_final(line):
+            for result in results:
+                result.append(line)
+            break
+        for index in range(current, len(commands)):
+            if prefixes[index] and line.startswith(prefixes[index]):
+                current = index
+                break
+        results[current].append(line)
+    return results
+
+def command_burst(commands):
+    """Write several commands back to back and return the output of
+    each.
+
+    With an asyncio driver attached every command is queued at once, so
+    the driver writes each one as soon as the previous one is answered
+    without waiting for this thread in between; a command with a higher
+    priority queued meanwhile is still written before the rest of the
+    burst. Otherwise the commands are written one after the other while
+    holding the port lock, so no other thread's command comes between
+    them.
+
+    Arg:
+        commands (str list): string commands
+
+    Returns:
+        List of one string array of output per command
+    """
+    commands = list(commands)
+    if _driver is None:
+        with port_lock:
+            return [command(data) for data in commands]
+    priority = get_priority()
+    futures = [_driver.submit(data, get_timeout(data), priority=priority)
+        for data in commands]
+    outputs = [future.result() for future in futures]
+    for data, output in zip(commands, outputs):
+        _track_modes(data, output)
+    return outputs
+
+def command_batch(commands):
+    """Write several commands in as few round trips as possible and
+    return the output of each.
+
+    Extended commands (AT+...) are concatenated on one command line,
+    e.g. AT+CSQ;+CBC;+CREG?, and the response is split back into the
+    output of each command (see split_batch). The FONA stops at the
+    first command of a line which fails, without saying which one it
+    was, so a failed line is written again as a burst (see
+    command_burst) to give every command its own result; batches should
+    therefore only contain queries and settings, which may safely be
+    repeated. Commands which cannot share a line (basic commands such
+    as ATE0, or too many to fit in MAX_LINE) are written as a burst as
+    well. Commands which prompt for data cannot be batched.
+
+    Arg:
+        commands (str list): string commands, each with its AT prefix
+
+    Returns:
+        List of one string array of output per command, each ending with
+        the final result code as in the array command returns
+    """
+    commands = list(commands)
+    if not _batchable(commands):
+        return command_burst(commands)
+    line = commands[0] + ''.join(';' + data[2:] for data in commands[1:])
+    output = command(line, sum(get_timeout(data) for data in commands))
+    if output[-1:] != ['OK']:
+        logger.info('Batch %s failed, writing its commands one by one'
+            % line)
+        return command_burst(commands)
+    results = split_batch(commands, output)
+    for data, result in zip(commands, results):
+        _track_modes(data, result)
+    return results
+
 def close():
-    """Close the serial port."""
-    logger.info('Closing FONA serial port')
-    fona_port.close()
+    """Close the serial port. The next command connects again."""
+    global fona_port
+    with port_lock:
+        if fona_port is None:
+            return
+        logger.info('Closing FONA serial port')
+        fona_port.close()
+        fona_port = None
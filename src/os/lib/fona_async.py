@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+from fona import (BACKGROUND, PAYLOAD_CHUNK, PRIORITIES, PROMPT, PROMPTS,
+    USER, _payload_bytes, _track_modes, attach_driver, connect, get_mode,
+    get_timeout, get_verb, is_final, publish_urc)
+from itertools import count
+from fona_stats import Histogram, stats
+from registration import registration
+from time import monotonic
+
+import asyncio
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-19'
+__version__ = '1.0'
+
+"""asyncio Driver for the 2G FONA Device.
+
+The FONA device has one serial port, and a command and its response
+must not be interleaved with any other command. Instead of every thread
+taking a lock around its exchange with the port, the driver in this
+library is the single owner of the port: one task writes the queued
+commands one at a time and the event loop's reader callback parses the
+bytes the FONA writes back, completing the future of the command in
+flight when its final result code arrives and publishing URCs (see
+urc.py) as soon as they are read.
+
+Callers submit commands and await the future of their response:
+    output = await driver.command('AT+CSQ')
+The queue is ordered by priority (fona.CALL, USER, BACKGROUND) and then
+by arrival, so a call control command is written as soon as the command
+in flight is answered, ahead of any queued background traffic.
+Threads other than the event loop's use driver.submit (or simply the
+fona.command method, which submits to the attached driver), and the
+fona_commands helpers have awaitable equivalents in async_commands.py.
+
+While fona_stats.stats is enabled, the driver records the queue wait,
+time to first byte, time to final result code, bytes and errors of every
+command, and the queue wait of each priority (see fona_stats.py).
+
+The driver lets the FONA sleep: once its queue has been empty for
+sleep_after seconds, it puts the SIM800 in slow clock mode 2
+(AT+CSCLK=2), in which the SIM800 sleeps whenever its serial port has
+been silent for MODEM_IDLE seconds, still receiving calls and SMSs and
+waking up to write their URCs. A sleeping SIM800 drops the bytes which
+wake it up, so before writing a command after such a silence the driver
+wakes the FONA with AT, repeated until it answers, and a command which
+still got no answer at all is written once more after waking the FONA
+again. The SIM800 does not say when it sleeps, so the driver estimates
+the time it slept from the silences of the port longer than MODEM_IDLE;
+the residency and the latency of the wakeups are returned by
+sleep_summary.
+
+Attributes:
+    SLEEP_AFTER (float): default seconds the queue must be empty before
+    the driver enables slow clock mode
+    MODEM_IDLE (float): seconds of silence on the serial port after which
+    the SIM800 sleeps in slow clock mode 2
+    WAKE_TIMEOUT (float): seconds to wait for the answer to each AT which
+    wakes the FONA
+    WAKE_ATTEMPTS (int): greatest number of AT written to wake the FONA
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+SLEEP_AFTER = 5.0
+MODEM_IDLE = 5.0
+WAKE_TIMEOUT = 0.2
+WAKE_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+class _Job(object):
+    """A command waiting for or being given its response."""
+
+    __slots__ = ('data', 'verb', 'timeout', 'prompt', 'payload', 'output',
+        'future', 'sink', 'priority', 'queued', 'written', 'first_byte',
+        'finished', 'bytes_written', 'bytes_read')
+
+    def __init__(self, data, timeout, prompt, payload, future, sink=None,
+            priority=USER):
+        self.data = data
+        self.verb = get_verb(data)
+        self.timeout = get_timeout(data) if timeout is None else timeout
+        self.prompt = prompt or payload is not None
+        self.payload = payload
+        self.output = []
+        self.future = future
+        self.sink = sink
+        self.priority = priority
+        self.queued = monotonic() if stats.enabled else None
+        self.written = self.first_byte = self.finished = None
+        self.bytes_written = self.bytes_read = 0
+
+    def append(self, line):
+        """Add a line to the output and hand it to the sink, if any."""
+        self.output.append(line)
+        if self.sink is not None:
+            self.sink(line)
+
+    def record(self):
+        """Record the statistics of the finished command, if enabled."""
+        if self.queued is None or self.written is None:
+            return
+        final = self.output[-1] if self.finished is not None else None
+        stats.record(self.verb, self.queued, self.written, self.first_byte,
+            self.finished, self.bytes_written, self.bytes_read, final,
+            PRIORITIES[self.priority])
+
+class FONA_Driver(object):
+    """Owner of the FONA serial port running on an asyncio event loop.
+
+    Attributes:
+        port (serial.Serial): serial port of the FONA device, set by start
+        if not given
+        loop (asyncio.AbstractEventLoop): event loop the driver runs on,
+        set by start
+        sleep_after (float): seconds the queue must be empty before slow
+        clock mode is enabled, or None to keep the FONA awake
+        wake_latency (fona_stats.Histogram): seconds taken by each wakeup
+        of the FONA
+    """
+
+    def __init__(self, port=None, sleep_after=SLEEP_AFTER):
+        """Constructor for FONA_Driver object.
+
+        Args:
+            port (serial.Serial): open serial port of the FONA device
+            (default is the port found by fona.connect when the driver
+            starts)
+            sleep_after (float): seconds the queue must be empty before slow
+            clock mode is enabled, or None to keep the FONA awake (default
+            is SLEEP_AFTER)
+        """
+        self.port = port
+        self.sleep_after = sleep_after
+        self.loop = None
+        self._queue = None
+        self._job = None
+        self._task = None
+        self._order = count()
+        self._buffer = bytearray()
+        self.wake_latency = Histogram()
+        self._active = self._read = monotonic()
+        self._slow_clock = None
+        self._asleep = 0.0
+        self._sleeps = 0
+        self._retries = 0
+
+    async def start(self):
+        """Take ownership of the serial port on the running event loop.
+
+        From this point on fona.command submits to this driver.
+        """
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        if self.port is None:
+            self.port = await self.loop.run_in_executor(None, connect)
+        self.loop.add_reader(self.port.fileno(), self._on_readable)
+        self._task = self.loop.create_task(self._run())
+        attach_driver(self)
+        logger.info('FONA driver started on %s' % self.port.name)
+
+    async def stop(self):
+        """Release the serial port. Commands still queued fail with
+        ConnectionError."""
+        attach_driver(None)
+        if self.port.is_open:
+            self.loop.remove_reader(self.port.fileno())
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        if self._job is not None:
+            self._put(self._job)
+        while not self._queue.empty():
+            job = self._queue.get_nowait()[2]
+            if not job.future.done():
+                job.future.set_exception(
+                    ConnectionError('FONA driver stopped'))
+        logger.info('FONA driver stopped')
+
+    def _put(self, job):
+        self._queue.put_nowait((job.priority, next(self._order), job))
+
+    async def command(self, data, timeout=None, prompt=False, payload=None,
+            sink=None, priority=USER):
+        """Queue a command for the FONA device and await its output.
+
+        Args:
+            data (str): string command
+            timeout (float): seconds to wait for the final result code
+            once the command is written (default is the deadline for the
+            command verb, see fona.get_timeout)
+            prompt (bool): whether the response ends with the > prompt
+            (default is False)
+            payload (str or bytes): data to write once the FONA prompts for
+            it (default is None)
+            sink (callable): function called with each line of output as
+            soon as it is read, for streaming long responses (default is
+            None)
+            priority (int): fona.CALL, USER or BACKGROUND (default is
+            USER)
+
+        Returns:
+            String array of output from the FONA device, in the same form
+            as fona.command
+
+        Raises:
+            registration.Offline_Error if the command needs the network and
+            the FONA is not registered (see registration.py)
+        """
+        registration.check(get_verb(data), data)
+        job = _Job(data, timeout, prompt, payload, self.loop.create_future(),
+            sink, priority)
+        self._put(job)
+        return await job.future
+
+    def submit(self, data, timeout=None, prompt=False, payload=None,
+            sink=None, priority=USER):
+        """Queue a command from a thread other than the event loop's.
+
+        Args are as for the command method.
+
+        Raises:
+            RuntimeError if called from the driver's event loop, where
+            blocking on the result would deadlock
+
+        Returns:
+            concurrent.futures.Future of the output of the command
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            raise RuntimeError('Await FONA_Driver.command on the event loop')
+        return asyncio.run_coroutine_threadsafe(
+            self.command(data, timeout, prompt, payload, sink, priority),
+            self.loop)
+
+    async def _run(self):
+        """Write queued commands one at a time, highest priority first,
+        each once the previous one has its final result code or has timed
+        out."""
+        while True:
+            try:
+                item = await asyncio.wait_for(self._queue.get(),
+                    None if self._slow_clock_on() else self.sleep_after)
+            except asyncio.TimeoutError:
+                await self._enable_slow_clock()
+                continue
+            job = item[2]
+            if job.future.done():
+                continue
+            if not self.port.is_open:
+                try:
+                    await self._reconnect()
+                except OSError as error:
+                    job.future.set_exception(ConnectionError(str(error)))
+                    continue
+            if self._may_sleep():
+                await self._wake()
+            written = monotonic()
+            await self._exchange(job)
+            if (not job.future.done() and self._read < written and
+                    self._slow_clock_on()):
+                logger.info('No answer to %s, waking FONA and writing it '
+                    'again' % job.data)
+                self._retries += 1
+                await self._wake()
+                await self._exchange(job)
+            if not job.future.done():
+                logger.warning('No final result code for %s after %s seconds'
+                    % (job.data, job.timeout))
+                job.future.set_result(job.output)
+            job.record()
+
+    async def _exchange(self, job):
+        """Write a command and wait for its final result code or its
+        timeout.
+
+        Returns:
+            False if the port was lost writing the command, which then
+            fails with ConnectionError; True otherwise
+        """
+        self._job = job
+        logger.info('Sending data %s to FONA device' % job.data)
+        data = (job.data + '\r').encode('utf-8')
+        if job.queued is not None:
+            job.written = monotonic()
+            job.bytes_written = len(data)
+        self._touch()
+        try:
+            self.port.write(data)
+        except (OSError, ValueError) as error:
+            self._job = None
+            self._lose_port()
+            job.future.set_exception(ConnectionError(str(error)))
+            return False
+        await asyncio.wait([job.future], timeout=job.timeout)
+        self._job = None
+        return True
+
+    def _slow_clock_on(self):
+        """Whether slow clock mode 2 is known to be in effect, or the
+        driver keeps the FONA awake."""
+        return self.sleep_after is None or get_mode('+CSCLK') == '2'
+
+    def _may_sleep(self):
+        """Whether the FONA may be asleep and must be woken up."""
+        return (self.sleep_after is not None and get_mode('+CSCLK') == '2'
+            and monotonic() - self._active >= MODEM_IDLE)
+
+    async def _enable_slow_clock(self):
+        """Put the FONA in slow clock mode 2 while the queue is empty."""
+        if not self.port.is_open:
+            return
+        job = _Job('AT+CSCLK=2', None, False, None, self.loop.create_future(),
+            priority=BACKGROUND)
+        if not await self._exchange(job):
+            job.future.exception()
+            return
+        _track_modes(job.data, job.output)
+        if job.output[-1:] == ['OK']:
+            logger.info('FONA slow clock enabled')
+            if self._slow_clock is None:
+                self._slow_clock = monotonic()
+        elif job.future.done():
+            logger.warning('FONA refused slow clock, keeping it awake: %s'
+                % job.output)
+            self.sleep_after = None
+
+    async def _wake(self):
+        """Write AT until the FONA answers, recording how long it took.
+
+        Returns:
+            True if the FONA answered
+        """
+        start = monotonic()
+        for _ in range(WAKE_ATTEMPTS):
+            job = _Job('AT', WAKE_TIMEOUT, False, None,
+                self.loop.create_future(), priority=BACKGROUND)
+            if not await self._exchange(job):
+                job.future.exception()
+                return False
+            if job.future.done():
+                self.wake_latency.add(monotonic() - start)
+                return True
+        logger.warning('FONA did not wake up after %d attempts'
+            % WAKE_ATTEMPTS)
+        return False
+
+    def _touch(self):
+        """Record traffic on the serial port, counting the silence since
+        the last traffic beyond MODEM_IDLE as sleep."""
+        now = monotonic()
+        silence = now - self._active - MODEM_IDLE
+        if silence > 0 and self._slow_clock is not None and \
+                get_mode('+CSCLK') == '2':
+            self._asleep += silence
+            self._sleeps += 1
+        self._active = now
+
+    def sleep_summary(self):
+        """Return a dict of the estimated sleep of the FONA: whether slow
+        clock mode is on, the seconds asleep, the residency (fraction of the
+        time since slow clock mode was first enabled spent asleep), the
+        number of sleeps, of commands written again after no answer and the
+        summary of the wake latency (see fona_stats.Histogram.summary)."""
+        now = monotonic()
+        asleep = self._asleep
+        enabled = get_mode('+CSCLK') == '2'
+        if enabled and self._slow_clock is not None:
+            asleep += max(now - self._active - MODEM_IDLE, 0)
+        elapsed = now - self._slow_clock if self._slow_clock else 0
+        return {
+            'enabled': enabled,
+            'asleep': asleep,
+            'residency': asleep / elapsed if elapsed else 0.0,
+            'sleeps': self._sleeps,
+            'retries': self._retries,
+            'wake_latency': self.wake_latency.summary(),
+        }
+
+    async def _write_payload(self, payload):
+        """Write a payload PAYLOAD_CHUNK bytes at a time, waiting for each
+        chunk to leave the UART (off the event loop) before the next."""
+        try:
+            for start in range(0, len(payload), PAYLOAD_CHUNK):
+                self.port.write(payload[start:start + PAYLOAD_CHUNK])
+                await self.loop.run_in_executor(None, self.port.flush)
+        except (OSError, ValueError):
+            logger.warning('Loss of connection to FONA device')
+
+    def _lose_port(self):
+        """Close the port after an error, so the next job finds the FONA
+        again (see _reconnect)."""
+        logger.warning('Loss of connection to FONA device')
+        if self.port.is_open:
+            self.loop.remove_reader(self.port.fileno())
+            self.port.close()
+
+    async def _reconnect(self):
+        """Find the FONA again after the port was lost (see fona.connect)."""
+        self._buffer.clear()
+        self.port = await self.loop.run_in_executor(None, connect)
+        self.loop.add_reader(self.port.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        """Read whatever the FONA has written and handle complete lines."""
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except (OSError, ValueError):
+            self._lose_port()
+            return
+        self._read = monotonic()
+        self._touch()
+        job = self._job
+        if job is not None and job.written is not None:
+            if job.first_byte is None:
+                job.first_byte = monotonic()
+            job.bytes_read += len(data)
+        self._buffer.extend(data)
+        while True:
+            index = self._buffer.find(b'\n')
+            if index < 0:
+                break
+            line = self._buffer[:index].decode('utf-8', 'replace').rstrip()
+            del self._buffer[:index + 1]
+            self._on_line(line)
+        job = self._job
+        if (job is not None and job.prompt and
+                self._buffer.lstrip(b'\r').startswith(PROMPT.encode())):
+            self._buffer.clear()
+            self._on_line(PROMPT)
+
+    def _on_line(self, line):
+        """Add a line to the response in flight or publish it as a URC."""
+        job = self._job
+        if job is None or job.future.done():
+            publish_urc(line)
+        elif is_final(line):
+            job.append(line)
+            if job.written is not None:
+                job.finished = monotonic()
+            job.future.set_result(job.output)
+        elif job.prompt and line in PROMPTS:
+            job.append(line)
+            if job.payload is None:
+                job.future.set_result(job.output)
+            else:
+                job.prompt = False
+                logger.info('Sending %d byte payload to FONA device'
+                    % len(job.payload))
+                payload = _payload_bytes(job.payload)
+                job.bytes_written += len(payload)
+                self.loop.create_task(self._write_payload(payload))
+        elif not publish_urc(line, job.data):
+            job.append(line)
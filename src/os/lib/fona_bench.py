@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from sim800_emulator import SIM800_Emulator
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+import asyncio
+import logging
+import os
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-26'
+__version__ = '1.0'
+
+"""Benchmark of the FONA Libraries Against the SIM800 Emulator.
+
+Starts a SIM800_Emulator, points the fona library at it through the
+FONA_PORT environment variable and times a set of fona_commands helpers.
+Run it before and after a change to the modem layer to measure the
+change, e.g.
+    python3 fona_bench.py --latency 0.02 --baud 9600 --messages 30
+The emulator latency stands in for the time the SIM800 takes to answer a
+command and the baud rate for the speed of the UART. The fona library
+raises the link to --target-baud with AT+IPR when it connects; pass the
+same rate as --baud to measure without the negotiation. With --driver
+the commands go through the asyncio FONA_Driver, and --stats writes its
+per verb statistics (see fona_stats.py) to a file.
+"""
+
+def _time(function, repeat):
+    """Return the mean seconds per call of function over repeat calls."""
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat
+
+def benchmarks(fona_commands):
+    """Return (name, function) pairs of the operations to benchmark."""
+    return [
+        ('AT round trip', lambda: fona_commands.command('AT')),
+        ('get_reception', fona_commands.get_reception),
+        ('get_battery_percentage', fona_commands.get_battery_percentage),
+        ('network_registration', fona_commands.network_registration),
+        ('get_status', fona_commands.get_status),
+        ('get_all_sms', fona_commands.get_all_sms),
+    ]
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark fona_commands')
+    parser.add_argument('--latency', type=float, default=0.02,
+        help='seconds the emulated SIM800 takes to answer')
+    parser.add_argument('--baud', type=int, default=9600,
+        help='baud rate of the emulated UART (0 for no throttling)')
+    parser.add_argument('--target-baud', type=int, default=115200,
+        help='baud rate the fona library negotiates with AT+IPR')
+    parser.add_argument('--messages', type=int, default=30,
+        help='number of SMSs on the emulated SIM')
+    parser.add_argument('--driver', action='store_true',
+        help='send the commands through the asyncio FONA_Driver')
+    parser.add_argument('--stats', metavar='PATH',
+        help='record driver statistics and write them to PATH')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of times to run each operation')
+    arguments = parser.parse_args()
+
+    emulator = SIM800_Emulator(arguments.latency, arguments.baud).start()
+    for i in range(arguments.messages):
+        emulator.add_sms('+1555000%04d' % i, 'Message number %d' % i,
+            read=True, notify=False)
+    os.environ['FONA_PORT'] = emulator.port_name
+    os.environ['FONA_SETTINGS'] = os.path.join(mkdtemp(), 'fona.json')
+    logging.disable(logging.INFO)
+    import fona
+    import fona_commands
+    fona.TARGET_BAUD = arguments.target_baud
+    fona.connect()
+    if arguments.driver or arguments.stats:
+        from fona_async import FONA_Driver
+        from fona_stats import stats
+        if arguments.stats:
+            stats.enable()
+        loop = asyncio.new_event_loop()
+        Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(FONA_Driver().start(), loop).result()
+
+    for name, function in benchmarks(fona_commands):
+        print('%-24s %9.1f ms' % (name,
+            1000 * _time(function, arguments.repeat)))
+    if arguments.stats:
+        stats.dump(arguments.stats)
+    emulator.stop()
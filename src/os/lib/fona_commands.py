@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
-from time import sleep
+from collections import deque, namedtuple
+from csv import reader
+from itertools import count, islice
+from time import monotonic
 
-from fona import get_output, send_command, send_eot
+from fona import (CALL, EOT, PROMPT, command, command_batch, is_final,
+    iter_command, set_mode)
+from pdu import Reassembly, decode, encode_submit
+from registration import registration
+from responses import (SMS, find_line, parse, parse_ciprxget, parse_cmgl_pdu,
+    parse_cmgr_pdu, parse_cpbr, parse_cpbr_range)
+
+import os
 
 __author__ = 'Nikola Istvanic'
 __date__ = '2017-05-28'
@@ -21,6 +31,7 @@ defines methods in the following order:
     Time & Location
     Phone Functionality
     Short Message Service
+    SIM Phonebook
     Audio
     Email
     Networking
@@ -32,6 +43,45 @@ MIMNUM = 0
 FULL = 1
 DISABLE = 4
 
+PHONEBOOK_CHUNK = 25
+MAX_SEND = 1460
+RX_CHUNK = 730
+
+APN = os.environ.get('FONA_APN', '')
+BEARER = 1
+BEARER_OPEN = 1
+
+STATUSES = ('REC UNREAD', 'REC READ', 'STO UNSENT', 'STO SENT', 'ALL')
+
+Status = namedtuple('Status', 'reception battery registration carrier')
+Sent = namedtuple('Sent', 'references seconds')
+
+_concatenation = count(1)
+
+def _info(output, prefix):
+    """Return the value of the first information line of FONA output
+    which begins with the given prefix.
+
+    Information lines are in the format +CMD: value, for example
+    +CSQ: 20,0; searching for the line (see responses.find_line) rather
+    than indexing into the output keeps parsing correct whether or not
+    echo is on and whether or not other lines come before it.
+
+    Args:
+        output (str list): string array of FONA output
+        prefix (str): prefix of the information line, e.g. +CSQ
+
+    Raises:
+        ValueError if no line of the output begins with the prefix
+
+    Returns:
+        String of the line after the prefix and its colon, stripped
+    """
+    line = find_line(output, prefix)
+    if line is None:
+        raise ValueError('No %s line in FONA output %s' % (prefix, output))
+    return line[len(prefix) + 1:].strip()
+
 ########################################################################
 #                       DIAGNOSTIC INFORMATION                         #
 ########################################################################
@@ -47,8 +97,7 @@ def get_model():
     Returns:
         String of FONA model and revision
     """
-    send_command('ATI')
-    return get_output()
+    return command('ATI')
 
 def get_simcard_number():
     """Send AT+CCID command to output the SIM card identifier (outputs
@@ -61,8 +110,7 @@ def get_simcard_number():
     Returns:
         String of SIM card identifier
     """
-    send_command('AT+CCID')
-    return get_output()
+    return command('AT+CCID')
 
 def get_carrier_name():
     """Send AT+CSPN command to output the name of the carrier.
@@ -78,8 +126,7 @@ def get_carrier_name():
     Returns:
         String of carrier name
     """
-    send_command('AT+CSPN')
-    return get_output()
+    return command('AT+CSPN')
 
 def get_reception():
     """Send AT+CSQ command to output the reception of the FONA.
@@ -93,12 +140,16 @@ def get_reception():
     number means a stronger reception. If a successful connection was
     not obtained, the method raises the IOError to the caller.
 
+    Raises:
+        ValueError if the FONA did not answer with a +CSQ line
+
     Returns:
-        String of reception
+        Int of reception, from 0 to 31 or 99 if unknown
     """
-    send_command('AT+CSQ')
-    return get_output()[1].split(',')[0].split(' ')[1]
-
+    signal = parse(command('AT+CSQ'), '+CSQ')
+    if signal is None:
+        raise ValueError('FONA did not report the reception')
+    return signal.rssi
 
 def get_battery_percentage():
     """Send AT+CBC command to output the battery percentage of the FONA
@@ -106,34 +157,59 @@ def get_battery_percentage():
 
     First this method checks the connection from the FONA device to the
     Raspberry Pi. Then this device sends the command to output the
-    battery percentage of the FONA device which is then returned as a
-    string array.
+    battery percentage of the FONA device, which answers in the form:
+        ['AT+CBC', '+CBC: 0,100,4220', '', 'OK']
+    where the percentage is the number between the 0 and 4220 (in this
+    case, the FONA device is 100% charged).
+
+    Raises:
+        ValueError if the FONA did not answer with a +CBC line
 
     Returns:
-        Battery percentage of the FONA device in a string array in the
-        form:
-            ['AT+CBC', '+CBC: 0,100,4220', '', 'OK']
-        where the percentage is the number between the 0 and 4220 (in
-        this case, the FONA device is 100% charged)
+        Int of the battery percentage of the FONA device
     """
-    send_command('AT+CBC')
-    return get_output()
+    battery = parse(command('AT+CBC'), '+CBC')
+    if battery is None:
+        raise ValueError('FONA did not report the battery')
+    return battery.percent
+
+def get_status():
+    """Obtain everything the status bar shows in one round trip.
+
+    The reception (AT+CSQ), battery (AT+CBC), network registration
+    (AT+CREG?) and carrier (AT+CSPN?) queries are written on a single
+    command line, so refreshing the status bar costs the same as any one
+    of get_reception, get_battery_percentage, network_registration and
+    get_carrier_name.
+
+    Returns:
+        Status named tuple of the reception (as get_reception), battery
+        percentage, registration status (e.g. 1 for registered, home
+        network, 5 for roaming) and carrier name; each field is None if
+        its command failed
+    """
+    csq, cbc, creg, cspn = command_batch(['AT+CSQ', 'AT+CBC', 'AT+CREG?',
+        'AT+CSPN?'])
+    signal, battery = parse(csq, '+CSQ'), parse(cbc, '+CBC')
+    network = parse(creg, '+CREG')
+    try:
+        carrier = next(reader([_info(cspn, '+CSPN')]))[0]
+    except (IndexError, ValueError):
+        carrier = None
+    return Status(signal and signal.rssi, battery and battery.percent,
+        network and network.stat, carrier)
 
 def echo_on():
-    send_command('ATE1')
-    get_output()
+    set_mode('E', 1)
 
 def echo_off():
-    send_command('ATE0')
-    get_output()
+    set_mode('E', 0)
 
 def factory_reset():
-    send_command('AT&F0')
-    get_output()
+    command('AT&F0')
 
 def power_off():
-    send_command('AT+CPOWD=1')
-    get_output()
+    command('AT+CPOWD=1')
 
 ########################################################################
 #                          TIME & LOCATION                             #
@@ -141,33 +217,80 @@ def power_off():
 def get_local_timestamp():
     """
     """
-    send_command('AT+CLTS?')
-    return get_output()
+    return command('AT+CLTS?')
 
 def get_time():
     """
     """
-    send_command('AT+CIPGSMLOC=1,1')
-    return get_output()
+    return command('AT+CIPGSMLOC=1,1')
 
-def gsm_location():
-    send_command('AT+CIPGSMLOC=1')
-    return get_output()
+def bearer_status(cid=BEARER):
+    """Return the responses.Bearer named tuple of the GPRS bearer
+    profile, or None if the FONA did not report it."""
+    return parse(command('AT+SAPBR=2,%d' % cid), '+SAPBR')
 
-def get_lat_long():
+def open_bearer(apn=APN, cid=BEARER):
+    """Open the GPRS bearer profile which GSM location (and HTTP) go
+    over, unless it is already open.
+
+    Args:
+        apn (str): access point name of the carrier (default is APN)
+        cid (int): bearer profile (default is BEARER)
+
+    Raises:
+        IOError if the bearer could not be opened
+
+    Returns:
+        True if the bearer was opened, False if it already was
     """
+    status = bearer_status(cid)
+    if status is not None and status.status == BEARER_OPEN:
+        return False
+    command_batch(['AT+SAPBR=3,%d,"Contype","GPRS"' % cid,
+        'AT+SAPBR=3,%d,"APN","%s"' % (cid, apn)])
+    if command('AT+SAPBR=1,%d' % cid)[-1:] != ['OK']:
+        raise IOError('Could not open GPRS bearer %d' % cid)
+    return True
+
+def close_bearer(cid=BEARER):
+    """Close the GPRS bearer profile."""
+    command('AT+SAPBR=0,%d' % cid)
+
+def gsm_location(cid=BEARER):
+    """Look the location of the FONA up from its serving cell over an
+    open bearer (see open_bearer). This takes seconds, up to the deadline
+    of AT+CIPGSMLOC; see location.py for a cached lookup which does not
+    block.
+
+    Arg:
+        cid (int): bearer profile (default is BEARER)
+
+    Returns:
+        responses.Location named tuple (whose code is 0 on success), or
+        None if the FONA did not report a location
     """
-    send_command('AT+CIPGSMLOC=1,1')
-    return get_output()
+    return parse(command('AT+CIPGSMLOC=1,%d' % cid), '+CIPGSMLOC')
+
+def get_lat_long():
+    """Return the latitude and longitude of the FONA from its serving
+    cell, opening the bearer for the lookup if needed, or None if the
+    lookup failed."""
+    opened = open_bearer()
+    try:
+        fix = gsm_location()
+    finally:
+        if opened:
+            close_bearer()
+    if fix is None or fix.code != 0:
+        return None
+    return fix.latitude, fix.longitude
 
 def get_time():
-    send_command('AT+CCLK?')
-    return get_output()[1]
+    return _info(command('AT+CCLK?'), '+CCLK')
 
 def set_time(time):
     """Time is in format yy/MM/dd,hh:mm:ss+-zz."""
-    send_command('AT+CCLK="%s"' % time)
-    get_output() # TODO: possibly do error checking on output or have method that does that
+    command('AT+CCLK="%s"' % time) # TODO: possibly do error checking on output or have method that does that
 
 ########################################################################
 #                         PHONE FUNCTIONALITY                          #
@@ -196,8 +319,7 @@ def get_phone_status():
         String of the current status of phone activity. Values can only
         be 0, 2, 3, or 4
     """
-    send_command('AT+CPAS')
-    return get_output()[1].split(' ')[1]
+    return _info(command('AT+CPAS'), '+CPAS')
 
 def set_phone_functionality(func):
     """Sets phone functionality.
@@ -208,7 +330,7 @@ def set_phone_functionality(func):
     """
     if func != MIMNUM or func != FULL or func != DISABLE:
         raise ValueError('Invalid value for functionality')
-    send_command('AT+CFUN=%s' % func)
+    command('AT+CFUN=%s' % func)
 
 def call_number(number):
     """Call the phone number parameter.
@@ -221,8 +343,7 @@ def call_number(number):
         number (str): string of the phone number to call. NOTE: this
         phone number should contain an international code
     """
-    send_command('ATD%s;' % number)
-    get_output()
+    command('ATD%s;' % number, priority=CALL)
 
 def answer_call():
     """Answer incoming call to this FONA device.
@@ -230,8 +351,7 @@ def answer_call():
     If a call is incoming, this method will send the ATA command which
     instructs the FONA device to answer that call.
     """
-    send_command('ATA')
-    get_output()
+    command('ATA', priority=CALL)
 
 def end_call():
     """Ends any current call in process.
@@ -239,8 +359,7 @@ def end_call():
     Ends call in process by sending the ATH command. Since this method
     should be called whenever a call is in process, this method does not
     check for successful connection with the FONA device."""
-    send_command('ATH')
-    get_output()
+    command('ATH', priority=CALL)
 
 def mute_call():
     """Mutes any call in process.
@@ -248,8 +367,7 @@ def mute_call():
     Turns on muting for the current call in process. This method will
     only mute a call if a call is in process.
     """
-    send_command('AT+CMUT=1')
-    get_output()
+    command('AT+CMUT=1', priority=CALL)
 
 def unmute_call():
     """Turns off mute setting for a current call in process.
@@ -257,48 +375,87 @@ def unmute_call():
     This method will only turn off the mute setting for a call that is
     in process and will not do anything otherwise.
     """
-    send_command('AT+CMUT=0')
-    get_output()
+    command('AT+CMUT=0', priority=CALL)
 
 def set_ringtone_volume(volume):
     if volume < 0 or volume > 100:
         raise ValueError('Out of range value for volume')
-    send_command('AT+CRSL=%d' % volume)
-    get_output()
+    command('AT+CRSL=%d' % volume)
 
 def open_microphone():
-    send_command('AT+CEXTERN=0')
-    get_output()
+    command('AT+CEXTERN=0')
 
 def close_microphone():
-    send_command('AT+CEXTERN=1')
-    get_output()
+    command('AT+CEXTERN=1')
 
 def enable_caller_id():
-    send_command('AT+CLIP=1')
-    get_output()
+    set_mode('+CLIP', 1)
 
 def disable_caller_id():
-    send_command('AT+CLIP=0')
-    get_output()
+    set_mode('+CLIP', 0)
+
+def enable_urcs():
+    """Turn on the unsolicited result codes which the OS relies on
+    instead of polling.
+
+    AT+CLIP=1 adds +CLIP: <number> after every RING of an incoming call,
+    and AT+CLCC=1 reports every change of state of a call with +CLCC
+    (see call_state.py). AT+CNMI=2,1,0,1,0 makes the FONA report each
+    SMS stored on the SIM with +CMTI: <storage>,<index> and each stored
+    delivery report with +CDSI. AT+CREG=2 and AT+CGREG=2 report
+    registration and cell changes of the network and of GPRS with +CREG
+    and +CGREG, and the registration watcher (see registration.py) is
+    given the current registration to start from.
+    """
+    set_mode('+CLIP', 1)
+    command('AT+CLCC=1')
+    command('AT+CNMI=2,1,0,1,0')
+    command('AT+CREG=2')
+    command('AT+CGREG=2')
+    for network, output in zip(('CREG', 'CGREG'),
+            command_batch(['AT+CREG?', 'AT+CGREG?'])):
+        status = parse(output, '+' + network)
+        if status is not None:
+            registration.observe(network, status.stat)
 
 ########################################################################
 #                       SHORT MESSAGE SERVICE                          #
 ########################################################################
+def _send_part(length, pdu):
+    """Write one AT+CMGS command and the PDU of one part.
+
+    Returns:
+        Int of the message reference of the part
+
+    Raises:
+        IOError if the FONA did not prompt for the PDU or did not send it
+    """
+    output = command('AT+CMGS=%d' % length, payload=pdu + EOT)
+    if PROMPT not in output:
+        raise IOError('FONA did not prompt for the SMS message')
+    reference = parse(output, '+CMGS')
+    if output[-1:] != ['OK'] or reference is None:
+        raise IOError('FONA did not send the SMS: %s' % output[-1:])
+    return reference
+
 def send_sms(number, message):
     """Send an SMS to the phone number which is given by the string
     parameter number.
 
-    To send an SMS, first the connection with the FONA is checked. If
-    successful, the AT command for changing the message type (AT+CMGF)
-    is written to the FONA device. When entering this command in the
-    FONA terminal, this allows the text directly typed in the terminal
-    to be used as the SMS to be sent. The command for setting the phone
-    number to be texted is written, using the number parameter, followed
-    by writing the message to the FONA device; this is why changing the
-    text type was required. Finally the CTRL-Z signal is sent, escaping
-    the direct message entry and sending the message to the desired
-    recipient.
+    The SMS message format is set to PDU (AT+CMGF=0), so that what is
+    written after the command is the SMS-SUBMIT PDU of the message,
+    encoded by pdu.encode_submit: in the GSM 7-bit alphabet if every
+    character of the message is in it and in UCS2 otherwise. AT+CMGS is
+    given the length of the PDU, and the PDU is written in hex as soon
+    as the FONA prompts for it with > (in chunks, see fona.send_payload),
+    followed by the CTRL-Z signal which ends the message. The FONA
+    answers +CMGS: <mr> with the message reference the network gave the
+    SMS once it is sent.
+
+    A message which does not fit in one PDU (160 GSM or 70 UCS2
+    characters) is sent as a concatenated SMS: each part carries a user
+    data header with the same reference and its part number, so that
+    the receiving phone shows the parts as one message.
 
     Args:
         number (str): string of the phone number to send the message to.
@@ -306,204 +463,181 @@ def send_sms(number, message):
         appropriate international code
         message (str): the message part of the SMS to be sent to the
         phone number
+
+    Raises:
+        IOError if the FONA did not send the message (or one of its parts)
+
+    Returns:
+        Sent named tuple of the list of message references, one per part,
+        and the seconds the whole send took
     """
-    send_command('AT+CMGF=1')
-    send_command('AT+CMGS="%s"' % number)
-    send_command(message)
-    send_eot()
-    get_output()
+    start = monotonic()
+    set_mode('+CMGF', 0)
+    references = [_send_part(length, data) for data, length in
+        encode_submit(number, message, next(_concatenation) % 256)]
+    return Sent(references, monotonic() - start)
 
 def sms_received():
     """Determines if any new SMSs have been sent to the FONA device.
 
-    To determine if any new SMS has been received, this method first
-    checks FONA connection. If successful, it writes to the FONA serial
-    port the AT command which outputs the number of total SMSs received.
-    The get_output method will return a string array whose second index
-    contains the number of received SMSs.
-
-    This value is the total number of SMSs received, according to the
-    FONA device; however, it is not the total number of SMSs accounted
-    for (or recorded). To save the number of SMSs accounted for
-    (non-new), we save the current value of SMSs received to a file (if
-    it's greater than the number of recorded SMSs). Initially, this file
-    will be empty, so the value for this variable is assumed to be zero.
-
-    At any point in calling this method, the number of SMSs received
-    will always be greater than or equal to the number of SMSs recorded.
-    If the number of SMSs received by the FONA is greater than the
-    number of SMSs recorded, then new SMSs have been received. This is
-    why the max of number of SMSs received and number recorded is the
-    new value for number of SMSs recorded.
-
-    This method returns the difference between number of SMSs received
-    by the FONA and number of SMSs recorded. If no new SMSs have been
-    received, the number of SMSs received and the number of SMSs
-    recorded will be equal, meaning this method will return zero to
-    indicate no new SMSs; otherwise this method will return the number
-    of new SMSs.
+    The SMS store (see sms_store.py) copies every SMS from the SIM card
+    to the local message database and then deletes it from the SIM, so
+    every SMS still on the SIM card is one which has not been accounted
+    for yet. The number of them is the used count of the first memory of
+    the +CPMS line of the output of AT+CPMS?.
+
+    Raises:
+        ValueError if the FONA did not answer with a +CPMS line
 
     Returns:
         If any new SMSs have been received, this method returns non zero
         (the number of new SMSs unaccounted for); otherwise it returns
         zero
     """
-    send_command('AT+CPMS?')
-    sms_received = int(get_output()[1].split(',')[1])
-    f = open('sms_record.txt', 'r')
-    try:
-        sms_recorded = int(f.readline())
-    except ValueError:
-        """empty file"""
-        sms_recorded = 0
-    with open('sms_record.txt', 'w+') as record:
-        record.write(str(max(sms_received, sms_recorded)))
-    return sms_received - sms_recorded
-
-def _parse_message(output):
-    """Parses the message payload from the FONA device output after
-    sending it its command for outputting the full details of an SMS
-    received.
-
-    In order to tell when the message begins, this method must begin
-    iterating over the output parameter given. Since any number of
-    commands at least one could have been written to the FONA before
-    this method has been called, the only way to determine where the
-    message begins is the iterate until the string denoting message
-    status type (string beginning with +CMGR:) is found; the next string
-    is the beginning of the message.
-
-    The output parameter could have the format:
-        [AT+CMGR=2', '+CMGR: "REC READ", "+XXXXXXXXXXX","","17/05/28,
-        14:33:14-16",145,4,0,0,"+12063130055", 145,5', 'Hello', '',
-        'OK']
-    where elements are indicated by single quotes and the X's make up
-    the phone number of the sender. Here, the SMS begins in the second
-    array entry and ends at the third to last, with empty entries
-    indicating a new line within the message. The OK string is a signal
-    from the FONA device that the command has successfully finished.
+    storages = parse(command('AT+CPMS?'), '+CPMS')
+    if not storages:
+        raise ValueError('FONA did not report the SMS storage')
+    return storages[0].used
+
+def read_sms(index):
+    """Read the SMS stored at an index of the SIM card with AT+CMGR.
+
+    Used when the FONA reports a single new SMS with +CMTI, where
+    listing the whole SIM card would be wasted work. The SMS is read in
+    PDU mode (AT+CMGF=0) and decoded with pdu.decode.
+
+    Arg:
+        index (int): index of the SMS on the SIM card (starting at 1)
+
+    Returns:
+        SMS named tuple of the message, or None if the index is empty or
+        holds one part of a concatenated message, which can only be read
+        together with its other parts (see list_sms)
+    """
+    set_mode('+CMGF', 0)
+    header = None
+    for line in command('AT+CMGR=%d' % index):
+        if is_final(line):
+            break
+        if header is None:
+            header = parse_cmgr_pdu(line)
+        else:
+            try:
+                message = decode(line)
+            except ValueError:
+                return None
+            if message.total > 1:
+                return None
+            return _sms([index], header.status, message)
+    return None
+
+def delete_sms(index):
+    """Delete the SMS stored at an index of the SIM card with AT+CMGD.
 
     Arg:
-        output (str list): string array outputted from the FONA device
-        serial port and given by the get_output method
+        index (int): index of the SMS on the SIM card (starting at 1)
+
+    Returns:
+        True if the FONA deleted the SMS; False otherwise
+    """
+    return command('AT+CMGD=%d' % index)[-1:] == ['OK']
+
+def _sms(indexes, status, message):
+    """Build the SMS record of a decoded message.
+
+    Args:
+        indexes (int list): SIM indexes of the parts of the message
+        status (int): status of its first part, 0 (REC UNREAD) to 3
+        message (pdu.PDU): decoded message, with the text of every part
 
     Returns:
-        The SMS received in one string as it was sent
+        SMS named tuple of the message; the number keeps its +, without
+        which an international number cannot be told from a national one
+        (see sms_store.normalize_number)
     """
-    message = ""
-    message_reached = False
-    for string in output:
-        if message_reached and string != 'OK':
-            message += string + '\n'
-        if '+CMGR:' in string:
-            message_reached = True
-    return message[:-2]
+    return SMS(indexes[0], STATUSES[status], message.number,
+        message.timestamp, message.text, tuple(indexes))
+
+def list_sms(status='ALL'):
+    """Yield every SMS on the SIM card with the given status using one
+    AT+CMGL command.
+
+    Instead of one AT+CMGR round trip per message, the FONA lists all of
+    the messages in a single response. In PDU mode (AT+CMGF=0) every
+    message is a +CMGL: <index>,<stat>,,<length> header followed by one
+    line of the PDU in hex, so there is no quoted text to parse and a
+    message can never be mistaken for a header. The response is parsed
+    as it streams in from the serial port: a message of one part is
+    yielded as soon as its PDU has arrived, and a concatenated message
+    as soon as its last part has. Parts of a concatenated message whose
+    other parts are not on the SIM card yet are left where they are.
+
+    NOTE: listing marks the REC UNREAD messages as REC READ, as reading
+    them with AT+CMGR does.
+
+    Arg:
+        status (str): one of REC UNREAD, REC READ, STO UNSENT, STO SENT
+        or ALL (default is ALL)
+
+    Yields:
+        SMS named tuples (index, status, number, timestamp, message,
+        parts) where index is the index of the first part and parts the
+        indexes of every part
+    """
+    set_mode('+CMGF', 0)
+    reassembly = Reassembly()
+    header = None
+    for line in iter_command('AT+CMGL=%d' % STATUSES.index(status)):
+        if line.startswith('+CMGL:'):
+            header = parse_cmgl_pdu(line)
+        elif header is not None and line:
+            # the line after a header is its PDU, never a result code
+            try:
+                complete = reassembly.add(header, decode(line))
+            except ValueError:
+                complete = None
+            if complete is not None:
+                headers, message = complete
+                yield _sms([part.index for part in headers],
+                    headers[0].status, message)
+            header = None
+        elif is_final(line):
+            break
 
 def get_all_sms():
     """Returns array of number, timestamp, message tuples for all SMSs
     received by the FONA device with successful connection to Raspberry
     Pi.
 
-    In order to get any SMS received with useful metadata, first two
-    commands must be sent to the FONA device: AT+CMGF=1 which sets SMS
-    message format to text and AT+CSDH=1 which shows SMS text mode
-    metadata (timestamp received, sender phone number, message contents,
-    etc.).
-
-    With this setup, the AT+CPMS command is sent which outputs the total
-    number of SMSs received which is used to iterate through each SMS
-    received. To output metadata about the ith SMS received, the
-    AT+CMGR=i command is sent, and with the first two commands sent, the
-    FONA device outputs clear metadata about the ith SMS which is
-    appended to the tuple array to be returned.
-
-    In this method, the total number of SMSs received is indexed as the
-    fifth element of the get_output string array because before the
-    AT+CPMS? command was entered, two other commands were entered which
-    each take two indices in the array. NOTE: the FONA device does not
-    use zero-indexing when outputting SMSs received.
+    All of the SMSs are read in one round trip with list_sms, which sets
+    the SMS message format to PDU (AT+CMGF=0) before listing them and
+    joins the parts of concatenated messages.
 
     Returns:
-        Array of sender phone number, SMS timestamp, and message tuples
-        of all SMSs received by the FONA device
-    """
-    send_command('AT+CMGF=1')
-    send_command('AT+CSDH=1')
-    send_command('AT+CPMS?')
-    sms_received = int(get_output()[5].split(',')[1])
-    messages = {'number':[], 'timestamp': [], 'message': []}
-    for i in range(1, sms_received + 1):
-        send_command('AT+CMGR=' + str(i))
-        output = get_output()
-        messages['number'].append(output[1].split('"')[3].replace('+',''))
-        messages['timestamp'].append(output[1].split('"')[7])
-        messages['message'].append(_parse_message(output))
-    return messages
+        Array of SMS named tuples (index, status, number, timestamp,
+        message, parts) of all SMSs received by the FONA device
+    """
+    return list(list_sms())
 
 def get_new_sms():
     """Returns array of number, timestamp, message tuples for all SMSs
-    which have been recently received by the FONA which have just been
-    accounted for in the sms_received method.
-
-    This method first calls the sms_received method which ensures a
-    successful connection exists between the FONA device and the
-    Raspberry Pi as well as find out how many SMSs have been marked as
-    'new'. After this, the method writes the AT+CMGF=1 command to set
-    the SMS message format to text to make message output legible. Next
-    it writes the AT+CSDH=1 command which makes the FONA console output
-    more detailed metadata about SMSs received.
-
-    The command to output the total number of SMSs received is then
-    entered to only grab the newest received to return. This value is
-    obtained by indexing into the fifth element of the get_output
-    string array because it's the output of the third command entered;
-    since each command requires two indices of the get_output array (one
-    for the command and one for its output), it's the sixth place (5
-    when zero-indexed).
-
-    Now the method iterates through the new SMSs received and appends
-    those to the array to be returned with metadata phone number of
-    sender, timestamp of message, and message contents. NOTE: the FONA
-    does not zero-index SMSs received, so 1 is added to the lower and
-    upper bound of the for loop.
+    which have been received by the FONA but not read yet.
+
+    The SMSs with the status REC UNREAD are listed in one round trip
+    with list_sms. NOTE: listing them marks them as REC READ, so each
+    new SMS is returned once.
 
     Returns:
-        Array of sender phone number, message timestamp, and message
-        contents tuples for new SMSs received
-    """
-    new_received = message_received()
-    send_command('AT+CMGF=1')
-    send_command('AT+CSDH=1')
-    send_command('AT+CPMS?')
-    sms_received = int(get_output()[5].split(',')[1])
-    messages = {'number':[], 'timestamp': [], 'message': []}
-    for i in range(sms_received - new_received + 1, sms_received + 1):
-        send_command('AT+CMGR=' + str(i))
-        output = get_output()
-        messages['number'].append(output[1].split('"')[3].replace('+', ''))
-        messages['timestamp'].append(output[1].split('"')[7])
-        messages['message'].append(_parse_message(output))
-    return messages
+        Array of SMS named tuples for new SMSs received
+    """
+    return list(list_sms('REC UNREAD'))
 
 def get_n_newest_sms(n):
     """Returns array of sender phone number, timestamp, and message
     content tuples of the n newest received SMSs.
 
-    This is accomplished by first checking for an existing connection
-    between the Raspberry Pi and the FONA device. This method then
-    writes the AT+CPMS? command to output the total number of SMSs
-    received in order to error check the n argument. After this,
-    commands for setting SMS message format and output detailed SMS
-    metadata are entered (AT+CMGF=1 and AT+CSDH=1, respectively).
-    Because the output from these two commands are not necessary, this
-    method calls the get_output method in order to flush the FONA
-    serial port's output.
-
-    Now the method iterates through the n newest SMSs and appends their
-    sender phone number, message timestamp, and message contents to the
-    array it will return. NOTE: the FONA does not zero-index SMSs
-    received, so 1 is added to the lower and upper bounds of the for
-    loop.
+    All of the SMSs are listed in one round trip with list_sms, keeping
+    only the last n of them as they stream in.
 
     Arg:
         n (int): the number of newest SMSs to return
@@ -513,44 +647,23 @@ def get_n_newest_sms(n):
         number of SMSs received
 
     Returns:
-        Array of sender phone number, message timestamp, and message
-        contents tuples for newest SMSs received
+        Array of SMS named tuples for newest SMSs received
     """
-    send_command('AT+CPMS?')
-    sms_received = int(get_output()[1].split(',')[1])
-    if n > sms_received or n < 1:
+    if n < 1:
         raise ValueError('\n***\n*** Out of range value for n\n***\n')
-    send_command('AT+CMGF=1')
-    send_command('AT+CSDH=1')
-    get_output()
-    messages = {'number':[], 'timestamp': [], 'message': []}
-    for i in range(sms_received - n + 1, sms_received + 1):
-        send_command('AT+CMGR=' + str(i))
-        output = get_output()
-        messages['number'].append(output[1].split('"')[3].replace('+',''))
-        messages['timestamp'].append(output[1].split('"')[7])
-        messages['message'].append(_parse_message(output))
-    return messages
+    messages = deque(list_sms(), n)
+    if len(messages) < n:
+        raise ValueError('\n***\n*** Out of range value for n\n***\n')
+    return list(messages)
 
 def get_n_oldest_sms(n):
     """Returns array of sender phone number, timestamp, and message
     content tuples of the n oldest received SMSs.
 
-    This is accomplished by first checking for an existing connection
-    between the Raspberry Pi and the FONA device. This method then
-    writes the AT+CPMS? command to output the total number of SMSs
-    received in order to error check the n argument. After this,
-    commands for setting SMS message format and output detailed SMS
-    metadata are entered (AT+CMGF=1 and AT+CSDH=1, respectively).
-    Because the output from these two commands are not necessary, this
-    method calls the get_output method in order to flush the FONA serial
-    port's output.
-
-    Now the method iterates through the n oldest SMSs and appends their
-    sender phone number, message timestamp, and message contents to the
-    array it will return. NOTE: the FONA does not zero-index SMSs
-    received, so 1 is added to the lower and upper bounds of the for
-    loop.
+    The SMSs are listed with list_sms, which yields them in order of
+    index (a concatenated message at the index of its last part), so
+    only the first n of them are decoded; the rest of the listing is
+    read and dropped.
 
     Arg:
         n (int): the number of oldest SMSs to return
@@ -560,25 +673,72 @@ def get_n_oldest_sms(n):
         number of SMSs received
 
     Returns:
-        Array of sender phone number, message timestamp, and message
-        contents tuples for oldest SMSs received
+        Array of SMS named tuples for oldest SMSs received
     """
-    send_command('AT+CPMS?')
-    sms_received = int(get_output()[1].split(',')[1])
-    if n > sms_received or n < 1:
+    if n < 1:
+        raise ValueError('\n***\n*** Out of range value for n\n***\n')
+    listing = list_sms()
+    messages = list(islice(listing, n))
+    listing.close()
+    if len(messages) < n:
         raise ValueError('\n***\n*** Out of range value for n\n***\n')
-    send_command('AT+CMGF=1')
-    send_command('AT+CSDH=1')
-    get_output()
-    messages = {'number':[], 'timestamp': [], 'message': []}
-    for i in range(1, n + 1):
-        send_command('AT+CMGR=' + str(i))
-        output = get_output()
-        messages['number'].append(output[1].split('"')[3].replace('+',''))
-        messages['timestamp'].append(output[1].split('"')[7])
-        messages['message'].append(_parse_message(output))
     return messages
 
+########################################################################
+#                            SIM PHONEBOOK                             #
+########################################################################
+def phonebook_range():
+    """Return the range of indexes of the SIM phonebook.
+
+    Returns:
+        Phonebook_Range named tuple of the first and last index and the
+        greatest lengths of a number and of a name, or None if the FONA
+        did not answer AT+CPBR=?
+    """
+    set_mode('+CPBS', 'SM')
+    line = find_line(command('AT+CPBR=?'), '+CPBR')
+    return None if line is None else parse_cpbr_range(line)
+
+def read_phonebook(first=None, last=None, chunk=PHONEBOOK_CHUNK):
+    """Yield the entries of the SIM phonebook.
+
+    The phonebook is read with one AT+CPBR=<first>,<last> per chunk of
+    indexes rather than in one command, since the SIM takes a few
+    milliseconds per slot and a few hundred slots would hold the FONA
+    for seconds: between two chunks, a command of higher priority (see
+    fona.command_priority) such as answering a call gets its turn.
+    Entries are yielded as each line arrives, so they can be stored
+    while the rest of the phonebook is read. Names are in the character
+    set of AT+CSCS (GSM by default).
+
+    Args:
+        first (int): first index to read (default is the first of the
+        phonebook)
+        last (int): last index to read (default is the last of the
+        phonebook)
+        chunk (int): number of indexes read per command (default is
+        PHONEBOOK_CHUNK)
+
+    Yields:
+        Phonebook_Entry named tuples (index, number, type, name) of the
+        slots which are not empty, in order of index
+    """
+    if first is None or last is None:
+        bounds = phonebook_range()
+        if bounds is None:
+            return
+        first = bounds.first if first is None else first
+        last = bounds.last if last is None else last
+    set_mode('+CPBS', 'SM')
+    for start in range(first, last + 1, chunk):
+        for line in iter_command('AT+CPBR=%d,%d'
+                % (start, min(start + chunk - 1, last))):
+            if is_final(line):
+                break
+            entry = parse_cpbr(line)
+            if entry is not None:
+                yield entry
+
 ########################################################################
 #                                AUDIO                                 #
 ########################################################################
@@ -601,8 +761,7 @@ def start_audio(file_path):
     Arg:
         file_path (str): location of the audio file to be played
     """
-    send_command('AT+CMEDPLAY=1,%s,0,50' % file_path)
-    get_output()
+    command('AT+CMEDPLAY=1,%s,0,50' % file_path)
 
 def stop_audio(file_path):
     """Stop playing any audio file currently playing.
@@ -615,8 +774,7 @@ def stop_audio(file_path):
     Arg:
         file_path (str): location of the audio file to be played
     """
-    send_command('AT+CMEDPLAY=0,%s,0,50' % file_path)
-    get_output()
+    command('AT+CMEDPLAY=0,%s,0,50' % file_path)
 
 def pause_audio(file_path):
     """Pause a playing audio file currently playing.
@@ -629,8 +787,7 @@ def pause_audio(file_path):
     Arg:
         file_path (str): location of the audio file to be played
     """
-    send_command('AT+CMEDPLAY=2,%s,0,50' % file_path)
-    get_output()
+    command('AT+CMEDPLAY=2,%s,0,50' % file_path)
 
 def play_audio(file_path):
     """Continue playing an audio file wherever it has been left off.
@@ -644,8 +801,7 @@ def play_audio(file_path):
     Arg:
         file_path (str): location of the audio file to be played
     """
-    send_command('AT+CMEDPLAY=3,%s,0,50' % file_path)
-    get_output()
+    command('AT+CMEDPLAY=3,%s,0,50' % file_path)
 
 def set_audio_file_volume(volume):
     """Sets the volume for playing an audio file only.
@@ -663,14 +819,13 @@ def set_audio_file_volume(volume):
     """
     if volume < 0 or volume > 100:
         raise ValueError('Out of range value for volume')
-    send_command('AT+CMEDIAVOL=%d' % volume)
-    get_output()
+    command('AT+CMEDIAVOL=%d' % volume)
 
 def start_voice_recording():
     """
     """
     # format: AT+CREC=1, file_path, 1 (for WAV format), 0 (use int value for how long you want the recording to be), 0 (for FAT format), 3 (highest quality), 0 (MIC1)
-    send_command('AT+CREC=1')
+    command('AT+CREC=1')
 
 def set_speaker_volume(volume):
     """Set volume for Raspberry Pi speakers.
@@ -688,86 +843,185 @@ def set_speaker_volume(volume):
     """
     if volume < 0 or volume > 9:
         raise ValueError('\n***\n*** Out of range value for volume\n***')
-    send_command('ATL%d' % volume)
-    get_output()
+    command('ATL%d' % volume)
 
 ########################################################################
 #                                EMAIL                                 #
 ########################################################################
 def set_sender_address(address, name):
-    send_command('AT+SMTPFROM=%s,%s' % (address, name))
-    get_output()
+    command('AT+SMTPFROM=%s,%s' % (address, name))
 
 def set_recipient_address(address, name):
-    send_command('AT+SMTPRCPT=%s,%s' % (address, name))
-    get_output()
+    command('AT+SMTPRCPT=%s,%s' % (address, name))
 
 def set_email_subject(subject):
-    send_command('AT+SMTPSUB=%s' % subject)
-    get_output()
+    command('AT+SMTPSUB=%s' % subject)
 
 def set_email_body(body):
-    send_command('AT+SMTPBODY=%s' % str(len(body)))
-    send_command(body)
-    get_output()
+    command('AT+SMTPBODY=%s' % str(len(body)), payload=body)
 
 def email_txt_file(file_name, length):
     # NOTE: length is the maximum length of a TXT file name
-    send_command('AT+SMTPFILE=1,' + file_name + ',' + length + ',0')
-    get_output()
+    command('AT+SMTPFILE=1,' + file_name + ',' + length + ',0')
 
 def send_email():
-    send_command('AT+SMTPSEND')
-    get_output()
+    command('AT+SMTPSEND')
 
 def set_pop3_server_account(server, user, password):
-    send_command('AT+POP3SRV=' + server + ',' + user + ',' + password)
-    get_output()
+    command('AT+POP3SRV=' + server + ',' + user + ',' + password)
 
 def pop_log_in():
-    send_command('AT+POP3IN')
-    get_output()
+    command('AT+POP3IN')
 
 def get_email_num_size():
-    send_command('AT+POP3NUM')
-    get_output()
+    command('AT+POP3NUM')
 
 def get_email_size(number):
-    send_command('AT+POP3LIST=' + number)
-    get_output()
+    command('AT+POP3LIST=' + number)
 
 def set_delete_email(number):
-    send_command('AT+POP3DEL=' + number)
-    get_output()
+    command('AT+POP3DEL=' + number)
 
 def pop_log_out():
-    send_command('AT+POP3OUT')
-    get_output()
+    command('AT+POP3OUT')
 
 ########################################################################
 #                              NETWORKING                              #
 ########################################################################
-def initiate_tcp_connection(ip_address):
-    send_command('AT+CIPSTART=2')
-    get_output()
+def _link(link):
+    """Return the link parameter of a TCP command: the link number and
+    a comma in multi-connection mode, nothing otherwise."""
+    return '' if link is None else '%d,' % link
+
+def start_gprs(apn=APN, mux=True):
+    """Bring the TCP stack of the FONA up over GPRS.
+
+    Any connection is shut first, as multi-connection mode can only be
+    changed while the stack is down. Received data is kept by the FONA
+    until read with receive_from_tcp (AT+CIPRXGET=1), which reports it
+    with the +CIPRXGET: 1 URC (see urc.Data_Available).
 
-def send_through_tcp(ip_address):
-    send_command('AT+CIPSEND=2')
-    get_output()
+    Args:
+        apn (str): access point name of the carrier (default is APN)
+        mux (bool): whether to use multi-connection mode, in which every
+        TCP command takes a link number (default is True)
+
+    Raises:
+        IOError if the GPRS connection could not be brought up
+
+    Returns:
+        String of the local IP address
+    """
+    command('AT+CIPSHUT')
+    set_mode('+CIPMUX', int(mux))
+    command_batch(['AT+CIPRXGET=1', 'AT+CSTT="%s"' % apn])
+    if command('AT+CIICR')[-1:] != ['OK']:
+        raise IOError('Could not bring up the GPRS connection')
+    return get_local_ip()
 
-def close_connection():
-    send_command('AT+CIPCLOSE=0')
-    get_output()
+def shut_gprs():
+    """Close every TCP connection and bring the GPRS connection down."""
+    return command('AT+CIPSHUT')[-1:] == ['SHUT OK']
 
 def get_local_ip():
-    send_command('AT+CIFSR')
-    get_output()
+    """Return the local IP address of the GPRS connection."""
+    return _info(command('AT+CIFSREX'), '+CIFSREX')
+
+def initiate_tcp_connection(host, port, link=None):
+    """Start opening a TCP connection. The FONA answers OK at once and
+    reports the connection later with a CONNECT OK or CONNECT FAIL URC
+    (see urc.Connection).
+
+    Args:
+        host (str): domain name or IP address of the server
+        port (int): port of the server
+        link (int): link number in multi-connection mode, or None
+
+    Raises:
+        IOError if the FONA refused to open the connection
+    """
+    output = command('AT+CIPSTART=%s"TCP","%s",%d' % (_link(link), host,
+        port))
+    if output[-1:] != ['OK']:
+        raise IOError('FONA refused to connect to %s:%d: %s' % (host, port,
+            output[-1:]))
+
+def max_send_size(link=None, default=MAX_SEND):
+    """Return the greatest number of bytes send_through_tcp can send at
+    once on a connection, or default if the FONA did not report it."""
+    for line in command('AT+CIPSEND?'):
+        if not line.startswith('+CIPSEND:'):
+            continue
+        fields = [int(field) for field in
+            line.partition(':')[2].split(',') if field.strip().isdigit()]
+        if len(fields) == 1 and link is None:
+            return fields[0]
+        if len(fields) == 2 and fields[0] == link:
+            return fields[1]
+    return default
+
+def send_through_tcp(data, link=None):
+    """Send data on a TCP connection with one AT+CIPSEND.
+
+    Args:
+        data (bytes): data to send, at most max_send_size bytes
+        link (int): link number in multi-connection mode, or None
+
+    Raises:
+        IOError if the FONA did not answer SEND OK
+    """
+    output = command('AT+CIPSEND=%s%d' % (_link(link), len(data)),
+        payload=data)
+    if not output or not output[-1].endswith('SEND OK'):
+        raise IOError('FONA could not send %d bytes: %s' % (len(data),
+            output[-1:]))
+
+def receive_from_tcp(length=RX_CHUNK, link=None):
+    """Read data the FONA received on a TCP connection (see start_gprs)
+    with one AT+CIPRXGET, in hex so that any byte survives the lines of
+    the response.
+
+    Args:
+        length (int): greatest number of bytes to read, at most RX_CHUNK
+        (default is RX_CHUNK)
+        link (int): link number in multi-connection mode, or None
+
+    Raises:
+        IOError if the FONA has no such connection
+
+    Returns:
+        Tuple of the bytes read and the number of bytes left to read
+    """
+    output = command('AT+CIPRXGET=3,%s%d' % (_link(link), length))
+    for index, line in enumerate(output):
+        header = parse_ciprxget(line)
+        if header is not None and header.mode == 3:
+            data = output[index + 1] if header.length else ''
+            return bytes.fromhex(data), header.remaining
+    raise IOError('FONA could not read from link %s: %s' % (link,
+        output[-1:]))
+
+def close_connection(link=None):
+    """Close a TCP connection.
+
+    Arg:
+        link (int): link number in multi-connection mode, or None
+
+    Returns:
+        True if the FONA closed it, False if it was not open
+    """
+    output = command('AT+CIPCLOSE' + ('' if link is None else '=%d' % link))
+    return bool(output) and output[-1].endswith('CLOSE OK')
 
 def pin_required():
     """Check to see if the PIN is required to be entered."""
-    send_command('AT+CPIN?')
-    return get_output()[1].split(':')[1]
+    return _info(command('AT+CPIN?'), '+CPIN')
 
 def network_registration():
-    send_command('AT+CREG?')
-    return get_output()
+    """Return the responses.Network named tuple of the network
+    registration, or None if the FONA did not report it. The registration
+    watcher (see registration.py) is updated with it."""
+    status = parse(command('AT+CREG?'), '+CREG')
+    if status is not None:
+        registration.observe('CREG', status.stat)
+    return status
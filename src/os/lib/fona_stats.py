@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+from threading import Lock
+
+import json
+import os
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-12'
+__version__ = '1.0'
+
+"""Instrumentation of the Serial Link to the FONA Device.
+
+The FONA driver (see fona_async.py) records, for every command it
+writes, how long the command waited in the queue, how long the FONA took
+to write the first byte of its answer and to write the final result
+code, the bytes written and read, whether the command timed out and
+which error code it failed with. The figures are aggregated per AT verb
+in histograms of fixed size, so recording costs the same no matter how
+long the OS runs. The queue wait is also aggregated per command priority
+(call, user, background), to show how long each class of command waits
+for the port.
+
+Recording is off unless the FONA_STATS environment variable is set or
+stats.enable() is called; while it is off the driver does not even read
+the clock for it. The figures can be read at runtime with
+stats.snapshot() or written to a file with stats.dump(path), e.g. from
+a Python shell attached to the running OS.
+
+Attributes:
+    BOUNDS (tuple): upper bounds in seconds of the histogram buckets,
+    doubling from 1 ms to about 2 minutes; a last bucket counts the
+    longer times
+    stats (Stats): statistics the driver records into
+"""
+
+BOUNDS = tuple(0.001 * 2 ** i for i in range(18))
+
+class Histogram(object):
+    """Counts of durations in the buckets of BOUNDS."""
+
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        """Count a duration."""
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the given
+        fraction (e.g. 0.99) of the durations, capped at the maximum,
+        or None if there are none."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(BOUNDS):
+                    return self.maximum
+                return min(BOUNDS[index], self.maximum)
+        return self.maximum
+
+    def summary(self):
+        """Return a dict of the count, mean, median, 99th percentile,
+        maximum and the non-empty buckets by upper bound."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.maximum,
+            'buckets': {('%g' % BOUNDS[index] if index < len(BOUNDS) else
+                'inf'): count for index, count in enumerate(self.counts)
+                if count},
+        }
+
+class Verb_Stats(object):
+    """Statistics of the commands with one AT verb."""
+
+    __slots__ = ('queue_wait', 'first_byte', 'final', 'commands',
+        'bytes_written', 'bytes_read', 'timeouts', 'errors')
+
+    def __init__(self):
+        self.queue_wait = Histogram()
+        self.first_byte = Histogram()
+        self.final = Histogram()
+        self.commands = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.timeouts = 0
+        self.errors = {}
+
+    def summary(self):
+        """Return a dict of the statistics."""
+        return {
+            'commands': self.commands,
+            'queue_wait': self.queue_wait.summary(),
+            'first_byte': self.first_byte.summary(),
+            'final': self.final.summary(),
+            'bytes_written': self.bytes_written,
+            'bytes_read': self.bytes_read,
+            'timeouts': self.timeouts,
+            'errors': dict(self.errors),
+        }
+
+class Stats(object):
+    """Per verb statistics of the commands written to the FONA.
+
+    Attribute:
+        enabled (bool): whether the driver records into this object
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._verbs = {}
+        self._priorities = {}
+        self._lock = Lock()
+
+    def enable(self):
+        """Start recording."""
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording; what was recorded is kept."""
+        self.enabled = False
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._verbs.clear()
+            self._priorities.clear()
+
+    def record(self, verb, queued, written, first_byte, finished,
+            bytes_written, bytes_read, final, priority=None):
+        """Record one command.
+
+        Args:
+            verb (str): verb of the command, e.g. AT+CSQ
+            queued (float): time.monotonic value when it was queued
+            written (float): time.monotonic value when it was written
+            first_byte (float): time.monotonic value when the first byte
+            of the answer arrived, or None if nothing arrived
+            finished (float): time.monotonic value when the final result
+            code arrived, or None if the command timed out
+            bytes_written (int): bytes of the command and its payload
+            bytes_read (int): bytes read while it was in flight
+            final (str): final result code, or None if it timed out
+            priority (str): name of the priority of the command, if any
+        """
+        with self._lock:
+            stats = self._verbs.get(verb)
+            if stats is None:
+                stats = self._verbs[verb] = Verb_Stats()
+            stats.commands += 1
+            stats.queue_wait.add(written - queued)
+            if priority is not None:
+                wait = self._priorities.get(priority)
+                if wait is None:
+                    wait = self._priorities[priority] = Histogram()
+                wait.add(written - queued)
+            if first_byte is not None:
+                stats.first_byte.add(first_byte - written)
+            if finished is None:
+                stats.timeouts += 1
+            else:
+                stats.final.add(finished - written)
+            stats.bytes_written += bytes_written
+            stats.bytes_read += bytes_read
+            if final is not None and final != 'OK':
+                stats.errors[final] = stats.errors.get(final, 0) + 1
+
+    def snapshot(self):
+        """Return a dict of the statistics of each verb recorded under
+        'verbs' and of the queue wait of each priority under
+        'priorities'."""
+        with self._lock:
+            return {
+                'verbs': {verb: stats.summary()
+                    for verb, stats in sorted(self._verbs.items())},
+                'priorities': {priority: wait.summary()
+                    for priority, wait in sorted(self._priorities.items())},
+            }
+
+    def dump(self, path):
+        """Write the snapshot to a file as JSON."""
+        with open(path, 'w') as output:
+            json.dump(self.snapshot(), output, indent=2, sort_keys=True)
+
+stats = Stats(bool(os.environ.get('FONA_STATS')))
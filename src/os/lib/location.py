@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from fona import BACKGROUND, command_priority
+from fona_commands import close_bearer, gsm_location, open_bearer
+from registration import REGISTERED, registration
+from telemetry import telemetry
+from threading import Lock, Thread
+from time import monotonic
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-08-04'
+__version__ = '1.0'
+
+"""Cached GSM Location of the FONA Device.
+
+The SIM800 has no GPS; AT+CIPGSMLOC looks the location up from the
+serving cell, by asking a server of SIMCom over a GPRS bearer (see
+fona_commands.open_bearer). The lookup takes seconds, up to the
+deadline of AT+CIPGSMLOC in fona.COMMAND_TIMEOUTS, needs the FONA to be
+attached to GPRS, and costs the battery a bearer and a round trip over
+the network. Yet it can only answer the location of the serving cell, so
+its answer does not change until the FONA moves to another cell.
+
+The location service therefore caches the fix of each cell, keyed by the
+location area code and cell ID of the serving cell as reported by +CREG
+(see telemetry.py), for TTL seconds, and:
+    get hands the fix of the serving cell to the caller at once, without
+    talking to the FONA, and starts a lookup in the background if the
+    serving cell has no fresh fix, meanwhile returning the last fix of
+    any cell;
+    lookups run on a thread of their own at BACKGROUND priority, so
+    commands of the user and calls go first, and are deferred until the
+    FONA is attached to GPRS (see registration.submit); only one runs at
+    a time, and every caller asking meanwhile gets the same
+    concurrent.futures.Future;
+    the bearer is opened for the lookup and closed after it, unless it
+    was already open;
+    subscribers are handed each new fix, and while there are any, a move
+    to a cell without a fresh fix starts a lookup by itself; without
+    subscribers nothing is looked up until asked for.
+A failed lookup is not retried for the same cell until RETRY_DELAY
+later.
+
+Attributes:
+    TTL (float): seconds a fix of a cell is fresh
+    RETRY_DELAY (float): seconds before looking up the location of a
+    cell again after a failed lookup
+    MAX_CELLS (int): greatest number of cells whose fix is cached, the
+    least recently used being forgotten first
+    location (Location_Service): GSM location of the FONA
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+TTL = 6 * 3600.0
+RETRY_DELAY = 60.0
+MAX_CELLS = 32
+
+Fix = namedtuple('Fix', 'latitude longitude cell date time')
+
+logger = logging.getLogger(__name__)
+
+def serving_cell():
+    """Return the (location area code, cell ID) of the serving cell from
+    the telemetry, or None if the FONA is not registered or did not
+    report its cell."""
+    network = telemetry.get('registration')
+    if network is None or network.stat not in REGISTERED or not network.ci:
+        return None
+    return (network.lac, network.ci)
+
+class Location_Service(object):
+    """Fixes of the cells the FONA was served by, looked up in the
+    background.
+
+    Attributes:
+        ttl (float): seconds a fix of a cell is fresh
+        hits (int): number of calls of get answered by a fresh fix
+        misses (int): number of calls of get which were not
+        lookups (int): number of lookups which found a fix
+        failures (int): number of lookups which did not
+        lookup_time (float): total seconds spent in lookups
+    """
+
+    def __init__(self, ttl=TTL, cells=MAX_CELLS):
+        """Constructor for Location_Service object.
+
+        Args:
+            ttl (float): seconds a fix of a cell is fresh (default is TTL)
+            cells (int): greatest number of cells whose fix is cached
+            (default is MAX_CELLS)
+        """
+        self.ttl = ttl
+        self.cells = cells
+        self.hits = self.misses = self.lookups = self.failures = 0
+        self.lookup_time = 0.0
+        self._lock = Lock()
+        self._fixes = OrderedDict()
+        self._failed = {}
+        self._last = None
+        self._pending = None
+        self._listeners = []
+        telemetry.subscribe(self._on_telemetry)
+
+    def subscribe(self, callback):
+        """Call callback(fix) with every new Fix, and follow the
+        serving cell from now on.
+
+        Callbacks run on the thread of the lookup, so they should hand the
+        fix to the UI rather than draw it themselves.
+        """
+        self._listeners.append(callback)
+        self.refresh()
+
+    def cached(self, cell):
+        """Return the fresh fix of a cell, or None if there is none."""
+        with self._lock:
+            entry = self._fixes.get(cell)
+            if entry is None or monotonic() - entry[1] >= self.ttl:
+                return None
+            self._fixes.move_to_end(cell)
+            return entry[0]
+
+    def get(self):
+        """Return the fix of the serving cell, or while it is looked up in
+        the background, the last fix of any cell (None if there never was
+        one). Never talks to the FONA.
+
+        Returns:
+            Fix named tuple of the latitude, longitude, cell, and date and
+            time (UTC) of the lookup, or None
+        """
+        fix = self.cached(serving_cell())
+        if fix is not None:
+            self.hits += 1
+            return fix
+        self.misses += 1
+        self.refresh()
+        return self._last
+
+    def refresh(self, force=False):
+        """Look the location of the serving cell up in the background,
+        unless it has a fresh fix, a lookup is running or the last one
+        failed less than RETRY_DELAY ago.
+
+        Arg:
+            force (bool): whether to look up a cell which has a fresh fix
+            or just failed (default is False)
+
+        Returns:
+            concurrent.futures.Future of the fix of the serving cell (None
+            if the lookup did not find one)
+        """
+        cell = serving_cell()
+        fix = None if force else self.cached(cell)
+        with self._lock:
+            if self._pending is not None:
+                return self._pending
+            failed = self._failed.get(cell)
+            if fix is not None or (not force and failed is not None
+                    and monotonic() - failed < RETRY_DELAY):
+                future = Future()
+                future.set_result(fix)
+                return future
+            future = self._pending = Future()
+        Thread(target=self._submit, name='Location_Lookup',
+            daemon=True).start()
+        return future
+
+    def locate(self, timeout=None):
+        """Return the fix of the serving cell, looking it up if needed and
+        blocking until it is found.
+
+        Arg:
+            timeout (float): greatest number of seconds to wait (default is
+            None to wait for as long as it takes)
+
+        Raises:
+            concurrent.futures.TimeoutError if the timeout expired
+            IOError if the lookup failed
+
+        Returns:
+            Fix named tuple, or None if the lookup did not find one
+        """
+        return self.refresh().result(timeout)
+
+    def summary(self):
+        """Return a dict of the hits and misses of get, the number of
+        cached cells and the lookups, their failures and mean seconds."""
+        return {'hits': self.hits, 'misses': self.misses,
+            'cells': len(self._fixes), 'lookups': self.lookups,
+            'failures': self.failures, 'mean_lookup': self.lookup_time
+            / (self.lookups + self.failures or 1)}
+
+    def _submit(self):
+        """Run a lookup as soon as the FONA is attached to GPRS."""
+        registration.submit(self._lookup,
+            gprs=True).add_done_callback(self._finish)
+
+    def _lookup(self):
+        """Look the location of the serving cell up over the bearer. The
+        cell is taken when the lookup runs, as it may have been deferred
+        while the FONA was offline.
+
+        Returns:
+            Tuple of the cell and its Fix named tuple (None if the FONA did
+            not find a location)
+        """
+        cell = serving_cell()
+        started = monotonic()
+        try:
+            with command_priority(BACKGROUND):
+                opened = open_bearer()
+                try:
+                    found = gsm_location()
+                finally:
+                    if opened:
+                        close_bearer()
+        finally:
+            self.lookup_time += monotonic() - started
+        if found is None or found.code != 0:
+            logger.warn('No GSM location for cell %s (code %s)' % (cell,
+                None if found is None else found.code))
+            return cell, None
+        return cell, Fix(found.latitude, found.longitude, cell, found.date,
+            found.time)
+
+    def _finish(self, lookup):
+        """Cache and publish the fix of a lookup and resolve the future of
+        its callers."""
+        error = lookup.exception()
+        if error is not None:
+            cell, fix = serving_cell(), None
+        else:
+            cell, fix = lookup.result()
+        with self._lock:
+            future, self._pending = self._pending, None
+            if fix is None:
+                self.failures += 1
+                self._failed[cell] = monotonic()
+            else:
+                self.lookups += 1
+                self._failed.pop(cell, None)
+                self._fixes[cell] = (fix, monotonic())
+                self._fixes.move_to_end(cell)
+                while len(self._fixes) > self.cells:
+                    self._fixes.popitem(last=False)
+                self._last = fix
+        if error is not None:
+            logger.warn('GSM location lookup failed: %s' % error)
+            future.set_exception(error)
+        else:
+            future.set_result(fix)
+        if fix is None:
+            return
+        for callback in self._listeners:
+            try:
+                callback(fix)
+            except Exception:
+                logger.exception('Location listener failed for %s'
+                    % (fix,))
+        if cell != serving_cell():
+            self._follow()
+
+    def _follow(self):
+        """Look the serving cell up if anyone follows the location."""
+        if self._listeners:
+            self.refresh()
+
+    def _on_telemetry(self, name, value):
+        """Follow moves to another cell."""
+        if name == 'registration':
+            self._follow()
+
+location = Location_Service()
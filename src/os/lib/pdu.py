@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+from codecs import charmap_decode, charmap_encode
+from collections import namedtuple
+from functools import lru_cache
+
+import re
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-17'
+__version__ = '1.0'
+
+"""Codec for SMS Protocol Data Units (3GPP TS 23.040).
+
+In PDU mode (AT+CMGF=0) the FONA reads and writes SMSs as hexadecimal
+TPDUs instead of text, which keeps what text mode loses: UCS2 messages,
+the user data header (UDH) which numbers the parts of a concatenated
+message, and the alphabet and originator details of every message. This
+library encodes SMS-SUBMIT PDUs for AT+CMGS and decodes the SMS-DELIVER
+(received) and SMS-SUBMIT (stored) PDUs listed by AT+CMGL and AT+CMGR.
+
+Text is sent in the GSM 03.38 default alphabet, 7 bits per character,
+whenever every character is in it (with the extension table for
+characters such as { and the euro sign), and as UCS2 otherwise. No
+character is handled by a Python loop: septets are mapped to and from
+characters with a charmap codec, and a whole message is packed or
+unpacked at once as one integer, whose 7 bit fields are moved to or
+from byte boundaries by three mask and shift steps over every block of
+eight septets (seven octets) together.
+
+Messages longer than one PDU are split into parts with a concatenation
+UDH (8-bit reference), and Reassembly puts received parts back together
+as they are listed.
+
+Attributes:
+    GSM, BINARY, UCS2 (int): alphabets of the data coding scheme
+    SINGLE_SEPTETS, PART_SEPTETS (int): characters of a GSM message in
+    one PDU, alone and as part of a concatenated message
+    SINGLE_OCTETS, PART_OCTETS (int): octets of a UCS2 or 8-bit message
+    in one PDU, alone and as part of a concatenated message
+"""
+
+GSM, BINARY, UCS2 = 0, 1, 2
+SINGLE_SEPTETS = 160
+PART_SEPTETS = 153
+SINGLE_OCTETS = 140
+PART_OCTETS = 134
+DELIVER, SUBMIT = 0, 1
+
+PDU = namedtuple('PDU', 'type number timestamp text reference part total')
+
+ESCAPE = 0x1b
+_BASIC = ('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;'
+    '<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+_EXTENSION = {0x0a: '\x0c', 0x14: '^', 0x28: '{', 0x29: '}', 0x2f: '\\',
+    0x3c: '[', 0x3d: '~', 0x3e: ']', 0x40: '|', 0x65: '€'}
+_ENCODE = dict((ord(char), septet) for septet, char in enumerate(_BASIC)
+    if septet != ESCAPE)
+_ENCODE.update((ord(char), bytes((ESCAPE, septet)))
+    for septet, char in _EXTENSION.items())
+_DECODE = _BASIC + '\ufffe' * 128
+_CHARACTERS = frozenset(chr(code) for code in _ENCODE)
+_SCTS = re.compile(r'(\d\d)/(\d\d)/(\d\d),(\d\d):(\d\d):(\d\d)([+-])(\d+)')
+
+# Masks of the fields of a block of 8 septets in 64 bits: the septets
+# are 7 bit fields of the low 56 bits when packed and the low 7 bits of
+# each byte when unpacked, and pack and unpack move them between the two
+# in three steps of halving fields (28, 14 and 7 bits), on every block of
+# a message at once
+_MASKS = (0x000000000fffffff, 0x00fffffff0000000, 0x00003fff00003fff,
+    0x0fffc0000fffc000, 0x007f007f007f007f, 0x3f803f803f803f80)
+_BLOCKS = (SINGLE_OCTETS + 6) // 7
+_ZONES = tuple('%s%02d' % ('-' if zone & 0x08 else '+', (zone & 0x07) * 10 +
+    (zone >> 4)) for zone in range(256))
+_SWAP = bytes((value >> 4 | value << 4) & 0xff for value in range(256))
+
+########################################################################
+#                          GSM 7-BIT ALPHABET                          #
+########################################################################
+def is_gsm(text):
+    """Determine if every character of text is in the GSM alphabet."""
+    return not set(text) - _CHARACTERS
+
+def encode_gsm(text):
+    """Map text to GSM septets (one byte each, extension characters as
+    an escape and a septet).
+
+    Raises:
+        ValueError if a character is not in the GSM alphabet
+    """
+    try:
+        return charmap_encode(text, 'strict', _ENCODE)[0]
+    except UnicodeEncodeError:
+        raise ValueError('Text is not in the GSM alphabet')
+
+def decode_gsm(septets):
+    """Map GSM septets back to text."""
+    if ESCAPE not in septets:
+        return charmap_decode(septets, 'replace', _DECODE)[0]
+    first, *escaped = septets.split(bytes((ESCAPE,)))
+    characters = [charmap_decode(first, 'replace', _DECODE)[0]]
+    for chunk in escaped:
+        if chunk:
+            characters.append(_EXTENSION.get(chunk[0], _BASIC[chunk[0]]))
+            characters.append(charmap_decode(chunk[1:], 'replace',
+                _DECODE)[0])
+    return ''.join(characters)
+
+@lru_cache(maxsize=32)
+def _masks(blocks):
+    """Return the masks of the low and high halves of the 28, 14 and 7
+    bit fields of a number of 64 bit blocks."""
+    return tuple(int.from_bytes(mask.to_bytes(8, 'little') * blocks, 'little')
+        for mask in _MASKS)
+
+def pack(septets, fill=0):
+    """Pack septets into octets, least significant bit first.
+
+    Args:
+        septets (bytes): values below 128
+        fill (int): zero bits before the first septet, which align the
+        septets after a user data header (default is 0)
+
+    Returns:
+        bytes of the packed septets
+    """
+    length = (len(septets) * 7 + fill + 7) // 8
+    blocks = (len(septets) + 7) // 8
+    low28, high28, low14, high14, low7, high7 = _masks(max(blocks, _BLOCKS))
+    value = int.from_bytes(septets, 'little')
+    value = value & low7 | value >> 1 & high7
+    value = value & low14 | value >> 2 & high14
+    value = value & low28 | value >> 4 & high28
+    spread = value.to_bytes(blocks * 8, 'little')
+    packed = b''.join([spread[start:start + 7]
+        for start in range(0, len(spread), 8)])
+    if fill:
+        packed = (int.from_bytes(packed, 'little') << fill).to_bytes(
+            len(packed) + 1, 'little')
+    return packed[:length]
+
+def unpack(octets, count):
+    """Unpack count septets from octets packed by pack."""
+    blocks = (len(octets) + 6) // 7
+    low28, high28, low14, high14, low7, high7 = _masks(max(blocks, _BLOCKS))
+    value = int.from_bytes(bytes.fromhex(octets.hex(' ', -7).replace(' ',
+        '00')), 'little')
+    value = value & low28 | (value & high28) << 4
+    value = value & low14 | (value & high14) << 2
+    value = value & low7 | (value & high7) << 1
+    return value.to_bytes(blocks * 8, 'little')[:count]
+
+########################################################################
+#                               FIELDS                                 #
+########################################################################
+def _semi_octets(digits):
+    """Swap the nibbles of a string of decimal digits, padding with F."""
+    if len(digits) % 2:
+        digits += 'F'
+    return ''.join(digits[index + 1] + digits[index]
+        for index in range(0, len(digits), 2))
+
+def _digits(octets):
+    """Read semi-octet digits, dropping the F padding."""
+    return octets.translate(_SWAP).hex().rstrip('f')
+
+def encode_address(number):
+    """Encode a phone number as a TP-DA address field in hex."""
+    digits = re.sub(r'\D', '', number)
+    kind = 0x91 if number.startswith('+') else 0x81
+    return '%02X%02X%s' % (len(digits), kind, _semi_octets(digits))
+
+def _decode_address(data, position):
+    """Decode the address field at position.
+
+    Returns:
+        Tuple of the number (with + if international, or the name of an
+        alphanumeric sender) and the position after the field
+    """
+    length, kind = data[position], data[position + 1]
+    octets = data[position + 2:position + 2 + (length + 1) // 2]
+    if kind & 0x70 == 0x50:
+        number = decode_gsm(unpack(octets, length * 4 // 7))
+    else:
+        number = ('+' if kind & 0x70 == 0x10 else '') + _digits(octets)
+    return number, position + 2 + (length + 1) // 2
+
+def _decode_timestamp(octets):
+    """Format a TP-SCTS as the FONA does in text mode:
+    yy/MM/dd,hh:mm:ss+zz with zz in quarters of an hour."""
+    digits = octets[:6].translate(_SWAP).hex('/')
+    return digits[:8] + ',' + digits[9:].replace('/', ':') + _ZONES[octets[6]]
+
+def _encode_timestamp(timestamp):
+    """Encode a yy/MM/dd,hh:mm:ss+zz timestamp as a TP-SCTS in hex."""
+    match = _SCTS.match(timestamp)
+    if match is None:
+        raise ValueError('Bad timestamp %s' % timestamp)
+    fields = ''.join(_semi_octets(field) for field in match.groups()[:6])
+    quarters = int(match.group(8))
+    zone = (quarters % 10) << 4 | quarters // 10
+    if match.group(7) == '-':
+        zone |= 0x08
+    return fields + '%02X' % zone
+
+def _alphabet(scheme):
+    """Return the alphabet of a TP-DCS."""
+    if scheme & 0xc0 == 0:
+        return (scheme >> 2) & 3
+    if scheme & 0xf0 == 0xf0:
+        return BINARY if scheme & 0x04 else GSM
+    if scheme & 0xf0 == 0xe0:
+        return UCS2
+    return GSM
+
+_ALPHABETS = tuple(_alphabet(scheme) for scheme in range(256))
+
+########################################################################
+#                               ENCODING                               #
+########################################################################
+def split_text(text):
+    """Split a message into the texts of the parts it is sent as.
+
+    Returns:
+        Tuple of the alphabet (GSM or UCS2) and the list of the encoded
+        user data of each part: septets for GSM, UTF-16 octets for UCS2
+    """
+    try:
+        septets = encode_gsm(text)
+    except ValueError:
+        septets = None
+    if septets is not None:
+        if len(septets) <= SINGLE_SEPTETS:
+            return GSM, [septets]
+        parts = []
+        while septets:
+            end = PART_SEPTETS
+            if len(septets) > end and septets[end - 1] == ESCAPE:
+                end -= 1
+            parts.append(septets[:end])
+            septets = septets[end:]
+        return GSM, parts
+    octets = text.encode('utf-16-be')
+    if len(octets) <= SINGLE_OCTETS:
+        return UCS2, [octets]
+    parts = []
+    while octets:
+        end = PART_OCTETS
+        if len(octets) > end and 0xd8 <= octets[end - 2] <= 0xdb:
+            end -= 2
+        parts.append(octets[:end])
+        octets = octets[end:]
+    return UCS2, parts
+
+def _user_data(alphabet, data, header):
+    """Return the TP-UDL and TP-UD in hex of one part."""
+    if alphabet == GSM:
+        bits = len(header) * 8
+        header_septets = (bits + 6) // 7
+        return '%02X' % (header_septets + len(data)) + (header + pack(data,
+            header_septets * 7 - bits)).hex().upper()
+    return '%02X' % (len(header) + len(data)) + (header + data).hex().upper()
+
+def _concatenation(reference, part, total):
+    """Return the UDH numbering one part of a concatenated message."""
+    if total == 1:
+        return b''
+    return bytes((5, 0, 3, reference % 256, total, part))
+
+def encode_submit(number, text, reference=0, status_report=False):
+    """Encode a message as the SMS-SUBMIT PDUs of its parts.
+
+    Args:
+        number (str): phone number of the recipient, with + and country
+        code if international
+        text (str): message contents of any length
+        reference (int): concatenation reference, the same for every
+        part and different from the recent messages (default is 0)
+        status_report (bool): whether to ask for a status report
+        (default is False)
+
+    Returns:
+        List of (pdu, length) tuples, one per part, where pdu is the hex
+        to write after the AT+CMGS=<length> prompt (without CTRL-Z) and
+        length the TPDU length in octets, i.e. without the service
+        centre address
+    """
+    alphabet, parts = split_text(text)
+    first = 0x11 | (0x20 if status_report else 0) | (
+        0x40 if len(parts) > 1 else 0)
+    address = encode_address(number)
+    scheme = 0x08 if alphabet == UCS2 else 0x00
+    pdus = []
+    for part, data in enumerate(parts, 1):
+        tpdu = '%02X00%s00%02XAA%s' % (first, address, scheme,
+            _user_data(alphabet, data, _concatenation(reference, part,
+            len(parts))))
+        pdus.append(('00' + tpdu, len(tpdu) // 2))
+    return pdus
+
+def encode_deliver(number, timestamp, text, reference=0, part=1, total=1):
+    """Encode one part of a received message as an SMS-DELIVER PDU, as
+    the SIM stores it; the SIM800 emulator lists messages with it.
+
+    Args:
+        number (str): phone number of the sender
+        timestamp (str): yy/MM/dd,hh:mm:ss+zz timestamp
+        text (str): text of this part
+        reference, part, total (int): concatenation of the part (default
+        is a message of one part)
+
+    Returns:
+        String of the PDU in hex, with an empty service centre address
+    """
+    header = _concatenation(reference, part, total)
+    try:
+        alphabet, data, scheme = GSM, encode_gsm(text), 0x00
+    except ValueError:
+        alphabet, data, scheme = UCS2, text.encode('utf-16-be'), 0x08
+    return '00%02X%s00%02X%s%s' % (0x44 if header else 0x04,
+        encode_address(number), scheme, _encode_timestamp(timestamp),
+        _user_data(alphabet, data, header))
+
+########################################################################
+#                               DECODING                               #
+########################################################################
+def _header(data):
+    """Return the (reference, part, total) of a concatenation UDH, or
+    None if the header does not have one."""
+    position, end = 1, 1 + data[0]
+    while position + 1 < end:
+        element, length = data[position], data[position + 1]
+        value = data[position + 2:position + 2 + length]
+        if element == 0 and length == 3:
+            return value[0], value[2], value[1]
+        if element == 8 and length == 4:
+            return value[0] << 8 | value[1], value[3], value[2]
+        position += 2 + length
+    return None
+
+@lru_cache(maxsize=256)
+def decode(pdu):
+    """Decode an SMS-DELIVER or SMS-SUBMIT PDU as listed by the FONA.
+
+    The PDUs decoded last are remembered, so the messages which are still
+    on the SIM card when it is listed again (by get_all_sms, or by a sync
+    which does not delete them, or waiting for the rest of their parts)
+    are only decoded once.
+
+    Arg:
+        pdu (str): hex of the PDU, with its service centre address
+
+    Raises:
+        ValueError if the PDU is not valid hex or is truncated
+
+    Returns:
+        PDU named tuple of the type (DELIVER or SUBMIT), number of the
+        sender or recipient, timestamp (None for SUBMIT), text, and the
+        concatenation reference, part and total (None, 1, 1 if the
+        message has one part)
+    """
+    data = bytes.fromhex(pdu)
+    try:
+        position = 1 + data[0]
+        first = data[position]
+        kind = SUBMIT if first & 0x03 == 1 else DELIVER
+        number, position = _decode_address(data, position + 1 + kind)
+        scheme = data[position + 1]
+        if kind == DELIVER:
+            timestamp = _decode_timestamp(data[position + 2:position + 9])
+            position += 9
+        else:
+            timestamp = None
+            position += 2 + (0, 7, 1, 7)[first >> 3 & 3]
+        length = data[position]
+        user_data = data[position + 1:]
+    except IndexError:
+        raise ValueError('Truncated PDU %s' % pdu)
+    alphabet = _ALPHABETS[scheme]
+    concatenation = None
+    header_length = 0
+    if first & 0x40 and user_data:
+        header_length = 1 + user_data[0]
+        concatenation = _header(user_data)
+    if alphabet == GSM:
+        text = decode_gsm(unpack(user_data, length)[
+            (header_length * 8 + 6) // 7:])
+    elif alphabet == UCS2:
+        text = user_data[header_length:length].decode('utf-16-be', 'replace')
+    else:
+        text = user_data[header_length:length].decode('latin-1')
+    if concatenation is None:
+        return PDU(kind, number, timestamp, text, None, 1, 1)
+    return PDU(kind, number, timestamp, text, *concatenation)
+
+class Reassembly(object):
+    """Parts of concatenated messages waiting for the rest of their parts.
+
+    Parts are grouped by sender, concatenation reference and number of
+    parts, so that messages with the same reference from different
+    senders are not mixed up.
+    """
+
+    def __init__(self):
+        self._messages = {}
+
+    def add(self, key, part):
+        """Add a decoded part.
+
+        Args:
+            key: whatever identifies where the part is stored, e.g. its
+            SIM index
+            part (PDU): decoded part
+
+        Returns:
+            Tuple of the list of the keys of every part and a PDU named
+            tuple with their texts joined, if this was the last part
+            missing; otherwise None
+        """
+        if part.total == 1:
+            return [key], part
+        group = (part.number, part.reference, part.total)
+        received = self._messages.setdefault(group, {})
+        received[part.part] = (key, part)
+        if len(received) < part.total or not all(number in received
+                for number in range(1, part.total + 1)):
+            return None
+        del self._messages[group]
+        ordered = [received[number] for number in range(1, part.total + 1)]
+        return [key for key, _ in ordered], ordered[0][1]._replace(
+            text=''.join(part.text for _, part in ordered))
+
+    def incomplete(self):
+        """Return the (key, PDU) tuples of the parts still waiting."""
+        return [value for received in self._messages.values()
+            for _, value in sorted(received.items())]
+
+def reassemble(parts):
+    """Put the parts of concatenated messages listed together back
+    together.
+
+    Arg:
+        parts (iterable): (key, PDU) tuples, see Reassembly.add
+
+    Returns:
+        Tuple of the list of (keys, PDU) tuples of the complete messages,
+        in the order their last part was listed, and the list of (key,
+        PDU) tuples of the parts of incomplete messages
+    """
+    reassembly = Reassembly()
+    complete = [message for message in (reassembly.add(key, part)
+        for key, part in parts) if message is not None]
+    return complete, reassembly.incomplete()
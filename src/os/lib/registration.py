@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from urc import Modem_Ready, Registration, dispatcher
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-08-02'
+__version__ = '1.0'
+
+"""Network Registration of the FONA Device.
+
+Calling, sending an SMS and anything over GPRS (the CIP and HTTP
+commands, GSM location) only work while the FONA is registered on the
+network. Written while it is not, such a command waits out its whole
+deadline, up to two minutes, before failing. The registration watcher
+follows the registration instead, from the +CREG (network) and +CGREG
+(GPRS) URCs, which the FONA writes on every change once AT+CREG=2 and
+AT+CGREG=2 are in effect (see fona_commands.enable_urcs), and from the
+answers to AT+CREG? and AT+CGREG?, so that:
+    fona.command and the driver refuse a network command at once with
+    Offline_Error while the FONA is known not to be registered (see
+    check);
+    work which can wait is deferred with submit and run as soon as the
+    FONA is registered again;
+    threads can wait for the registration, or subscribe to its changes,
+    e.g. the outbox thread, which holds the outbox while offline.
+Until the FONA reports its registration (and after it restarts) the
+registration is unknown, and nothing is refused.
+
+Calls to EMERGENCY_NUMBERS are never refused, as the SIM800 places them
+without registration.
+
+Attributes:
+    REGISTERED (tuple): registration statuses (as in +CREG) in which the
+    FONA is registered: home network and roaming
+    STATUS_NAMES (dict): name of each registration status
+    NETWORK_VERBS (tuple): verbs of the commands which need the FONA to
+    be registered on the network
+    GPRS_VERBS (tuple): verbs of the commands which also need the FONA to
+    be attached to GPRS
+    EMERGENCY_NUMBERS (tuple): numbers which can be called without
+    registration
+    registration (Registration_Watcher): registration of the FONA, fed by
+    the URCs the fona library publishes
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+REGISTERED = (1, 5)
+STATUS_NAMES = {0: 'not registered', 1: 'registered', 2: 'searching',
+    3: 'registration denied', 4: 'unknown', 5: 'roaming'}
+NETWORK_VERBS = ('ATD', 'AT+CMGS', 'AT+CMGSEX', 'AT+CMSS', 'AT+CUSD',
+    'AT+CIPGSMLOC', 'AT+CIICR', 'AT+CIPSTART', 'AT+CIPSEND', 'AT+SAPBR',
+    'AT+HTTPACTION')
+GPRS_VERBS = ('AT+CIPGSMLOC', 'AT+CIICR', 'AT+CIPSTART', 'AT+CIPSEND',
+    'AT+SAPBR', 'AT+HTTPACTION')
+EMERGENCY_NUMBERS = ('112', '911')
+
+logger = logging.getLogger(__name__)
+
+class Offline_Error(IOError):
+    """A network command was refused because the FONA is not registered."""
+
+class Registration_Watcher(object):
+    """Registration of the FONA on the network and on GPRS.
+
+    Attribute:
+        status (dict): last registration status (see STATUS_NAMES) of the
+        network ('CREG') and of GPRS ('CGREG'), or None while unknown
+    """
+
+    def __init__(self):
+        self.status = {'CREG': None, 'CGREG': None}
+        self._changed = Condition()
+        self._listeners = []
+        self._deferred = deque()
+        self._flushing = False
+        dispatcher.subscribe(Registration, self._on_registration)
+        dispatcher.subscribe(Modem_Ready, self._on_reset)
+
+    def online(self, gprs=False):
+        """Return whether the FONA is registered (or its registration is
+        unknown).
+
+        Arg:
+            gprs (bool): whether GPRS is needed as well (default is False)
+        """
+        networks = ('CREG', 'CGREG') if gprs else ('CREG',)
+        return all(self.status[network] in (None,) + REGISTERED
+            for network in networks)
+
+    @property
+    def registered(self):
+        """Whether the FONA is registered on the network (or its
+        registration is unknown)."""
+        return self.online()
+
+    def check(self, verb, data):
+        """Refuse a command which needs the network while offline.
+
+        Args:
+            verb (str): verb of the command, e.g. ATD (see fona.get_verb)
+            data (str): string command
+
+        Raises:
+            Offline_Error if the command needs the network (or GPRS) and the
+            FONA is not registered on it
+        """
+        if verb not in NETWORK_VERBS:
+            return
+        if verb == 'ATD' and data[3:].rstrip(';') in EMERGENCY_NUMBERS:
+            return
+        gprs = verb in GPRS_VERBS
+        if not self.online(gprs):
+            network = 'CGREG' if gprs and self.registered else 'CREG'
+            raise Offline_Error('FONA is offline (%s: %s), not writing %s'
+                % (network, STATUS_NAMES.get(self.status[network]), data))
+
+    def observe(self, network, stat):
+        """Record the registration status of the network or of GPRS, e.g.
+        from the answer to AT+CREG?.
+
+        Args:
+            network (str): 'CREG' or 'CGREG'
+            stat (int): registration status, or None if unknown
+        """
+        with self._changed:
+            previous = self.status[network]
+            if stat == previous:
+                return
+            was_online = self.online(gprs=True), self.online()
+            self.status[network] = stat
+            now_online = self.online(gprs=True), self.online()
+            self._changed.notify_all()
+        logger.info('%s registration %s -> %s' % (network,
+            STATUS_NAMES.get(previous), STATUS_NAMES.get(stat)))
+        for callback in self._listeners:
+            try:
+                callback(network, stat)
+            except Exception:
+                logger.exception('Registration listener failed for %s %s'
+                    % (network, stat))
+        if now_online != was_online and any(now_online):
+            self._flush()
+
+    def subscribe(self, callback):
+        """Call callback(network, stat) whenever the registration status of
+        the network ('CREG') or GPRS ('CGREG') changes."""
+        self._listeners.append(callback)
+
+    def wait(self, timeout=None, gprs=False):
+        """Block until the FONA is registered.
+
+        Args:
+            timeout (float): greatest number of seconds to wait (default is
+            None to wait for as long as it takes)
+            gprs (bool): whether to wait for GPRS as well (default is False)
+
+        Returns:
+            True if the FONA is registered, False if the timeout expired
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.online(gprs), timeout)
+
+    def submit(self, callback, gprs=False):
+        """Run a function which needs the network now if the FONA is
+        registered, or as soon as it is registered again.
+
+        Deferred functions run one after the other on a thread of their
+        own, in the order they were submitted.
+
+        Args:
+            callback (callable): function of no arguments, e.g. sending
+            commands to the FONA
+            gprs (bool): whether it needs GPRS as well (default is False)
+
+        Returns:
+            concurrent.futures.Future of the result of the function
+        """
+        future = Future()
+        with self._changed:
+            if not self.online(gprs) or self._deferred:
+                self._deferred.append((future, callback, gprs))
+                logger.info('Deferring %s until the FONA is registered'
+                    % getattr(callback, '__name__', callback))
+                deferred = True
+            else:
+                deferred = False
+        if deferred:
+            self._flush()
+        else:
+            self._run(future, callback)
+        return future
+
+    def pending(self):
+        """Return the number of deferred functions."""
+        return len(self._deferred)
+
+    def _run(self, future, callback):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(callback())
+        except Exception as error:
+            future.set_exception(error)
+
+    def _flush(self):
+        """Start running the deferred functions, unless already running."""
+        with self._changed:
+            if self._flushing or not self._deferred:
+                return
+            self._flushing = True
+        Thread(target=self._flush_deferred, name='Registration_Flush',
+            daemon=True).start()
+
+    def _flush_deferred(self):
+        """Run the deferred functions in order for as long as the FONA is
+        registered for the first of them."""
+        while True:
+            with self._changed:
+                if not self._deferred or not self.online(
+                        self._deferred[0][2]):
+                    self._flushing = False
+                    return
+                future, callback, _ = self._deferred.popleft()
+            self._run(future, callback)
+
+    def _on_registration(self, event):
+        self.observe(event.network, event.stat)
+
+    def _on_reset(self, event):
+        """Forget the registration when the FONA restarts."""
+        self.observe('CREG', None)
+        self.observe('CGREG', None)
+
+registration = Registration_Watcher()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+
+import re
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-10'
+__version__ = '1.0'
+
+"""Parsers of the Information Lines of FONA Responses.
+
+Each parser in this library turns one information line of a SIM800
+response (e.g. +CSQ: 20,0) into a named tuple with a field per
+parameter, using a regular expression compiled once when the library is
+imported. Lines are found in the output of a command by their prefix
+rather than by their position, so the parsers work whether or not echo
+is on and whatever other lines (URCs, blank lines) come before them.
+
+Named tuples are used for the records because they are as compact as
+classes with __slots__, cost a single allocation each and are immutable,
+so a record can be handed to another thread as it is. Numeric parameters
+are converted to int or float; parameters which the FONA leaves empty
+are None.
+
+Attributes:
+    PARSERS (dict): parser of each information prefix, e.g. '+CSQ'
+"""
+
+SMS = namedtuple('SMS', 'index status number timestamp message parts',
+    defaults=((),))
+SMS_Header = namedtuple('SMS_Header',
+    'index status number alpha timestamp length')
+PDU_Header = namedtuple('PDU_Header', 'index status alpha length')
+Storage = namedtuple('Storage', 'memory used total')
+Signal = namedtuple('Signal', 'rssi ber')
+Battery = namedtuple('Battery', 'charging percent millivolts')
+Call = namedtuple('Call', 'index direction state mode multiparty number type')
+Caller = namedtuple('Caller', 'number type alpha')
+Network = namedtuple('Network', 'mode stat lac ci')
+Location = namedtuple('Location', 'code longitude latitude date time')
+Bearer = namedtuple('Bearer', 'cid status ip')
+Receive_Header = namedtuple('Receive_Header', 'mode link length remaining')
+Phonebook_Entry = namedtuple('Phonebook_Entry', 'index number type name')
+Phonebook_Range = namedtuple('Phonebook_Range',
+    'first last number_length name_length')
+
+_CMGL = re.compile(r'\+CMGL: *(\d+),"([^"]*)","([^"]*)",(?:"([^"]*)")?,'
+    r'(?:"([^"]*)")?(?:,\d*,(\d+))?')
+_CMGR = re.compile(r'\+CMGR: *"([^"]*)","([^"]*)",(?:"([^"]*)")?'
+    r'(?:,"([^"]*)")?(?:,.*,(\d+))?$')
+_CMGL_PDU = re.compile(r'\+CMGL: *(\d+),(\d+),(?:"([^"]*)")?,(\d+)')
+_CMGR_PDU = re.compile(r'\+CMGR: *(\d+),(?:"([^"]*)")?,(\d+)')
+_CMGS = re.compile(r'\+CMGS(?:EX)?: *(\d+)')
+_CPMS = re.compile(r'(?:"(\w+)",)?(\d+),(\d+)')
+_CSQ = re.compile(r'\+CSQ: *(\d+),(\d+)')
+_CBC = re.compile(r'\+CBC: *(\d+),(\d+),(\d+)')
+_CLCC = re.compile(r'\+CLCC: *(\d+),(\d+),(\d+),(\d+),(\d+)'
+    r'(?:,"([^"]*)",(\d+))?')
+_CLIP = re.compile(r'\+CLIP: *"([^"]*)",(\d+)(?:,"[^"]*",\d*,"([^"]*)")?')
+_CCLK = re.compile(r'\+CCLK: *"([^"]*)"')
+_CREG = re.compile(r'\+CG?REG: *(\d+),(\d+)(?:,"(\w*)","(\w*)")?')
+_CPBR = re.compile(r'\+CPBR: *(\d+),"([^"]*)",(\d+),"(.*)"$')
+_CPBR_RANGE = re.compile(r'\+CPBR: *\((\d+)-(\d+)\),(\d+),(\d+)')
+_CIPGSMLOC = re.compile(r'\+CIPGSMLOC: *(\d+)(?:,(-?[\d.]+),(-?[\d.]+))?'
+    r'(?:,([\d/]+),([\d:]+))?')
+_CIPRXGET = re.compile(r'\+CIPRXGET: *(\d+)((?:,\d+)*)$')
+_CIPRXGET_FIELDS = {1: 0, 2: 2, 3: 2, 4: 1}
+_SAPBR = re.compile(r'\+SAPBR: *(\d+),(\d+),"([^"]*)"')
+
+def _int(text):
+    """Convert a parameter to an int, or None if it is empty."""
+    return int(text) if text else None
+
+def find_line(output, prefix):
+    """Return the first line of output which begins with prefix and a
+    colon, or None if there is none.
+
+    Args:
+        output (str list): string array of FONA output
+        prefix (str): information prefix, e.g. +CSQ
+    """
+    prefix += ':'
+    for line in output:
+        if line.startswith(prefix):
+            return line
+    return None
+
+def parse_cmgl(line):
+    """Parse a +CMGL: header of a text mode SMS listing.
+
+    The length is only present with AT+CSDH=1 in effect.
+
+    Returns:
+        SMS_Header named tuple, or None if the line is not a header
+    """
+    match = _CMGL.match(line)
+    if match is None:
+        return None
+    index, status, number, alpha, timestamp, length = match.groups()
+    return SMS_Header(int(index), status, number, alpha, timestamp,
+        _int(length))
+
+def parse_cmgr(line):
+    """Parse the +CMGR: header of a text mode SMS read.
+
+    Returns:
+        SMS_Header named tuple whose index is None, or None if the line
+        is not a header
+    """
+    match = _CMGR.match(line)
+    if match is None:
+        return None
+    status, number, alpha, timestamp, length = match.groups()
+    return SMS_Header(None, status, number, alpha, timestamp, _int(length))
+
+def parse_cmgl_pdu(line):
+    """Parse a +CMGL: header of a PDU mode SMS listing.
+
+    Returns:
+        PDU_Header named tuple of the index, the status as an int (0 REC
+        UNREAD to 3 STO SENT) and the length of the TPDU which follows in
+        octets, or None if the line is not a header
+    """
+    match = _CMGL_PDU.match(line)
+    if match is None:
+        return None
+    index, status, alpha, length = match.groups()
+    return PDU_Header(int(index), int(status), alpha, int(length))
+
+def parse_cmgr_pdu(line):
+    """Parse the +CMGR: header of a PDU mode SMS read.
+
+    Returns:
+        PDU_Header named tuple whose index is None, or None if the line
+        is not a header
+    """
+    match = _CMGR_PDU.match(line)
+    if match is None:
+        return None
+    status, alpha, length = match.groups()
+    return PDU_Header(None, int(status), alpha, int(length))
+
+def parse_cmgs(line):
+    """Parse the +CMGS: (or +CMGSEX:) line of a sent SMS.
+
+    Returns:
+        Int of the message reference the network gave the SMS, which
+        its status report will carry
+    """
+    match = _CMGS.match(line)
+    return int(match.group(1)) if match else None
+
+def parse_cpms(line):
+    """Parse the +CPMS: line of AT+CPMS? or AT+CPMS=<mem>.
+
+    Returns:
+        Tuple of a Storage named tuple for each of the read, write and
+        receive memories; the memory name is None in the answer to a
+        write, which does not include it
+    """
+    if not line.startswith('+CPMS:'):
+        return None
+    return tuple(Storage(memory or None, int(used), int(total))
+        for memory, used, total in _CPMS.findall(line, 6))
+
+def parse_csq(line):
+    """Parse the +CSQ: line of AT+CSQ.
+
+    Returns:
+        Signal named tuple of the received signal strength indication
+        (0 to 31, 99 for unknown) and the bit error rate
+    """
+    match = _CSQ.match(line)
+    return Signal(*map(int, match.groups())) if match else None
+
+def parse_cbc(line):
+    """Parse the +CBC: line of AT+CBC.
+
+    Returns:
+        Battery named tuple of the charge status (0 not charging, 1
+        charging, 2 finished), the percentage and the voltage in mV
+    """
+    match = _CBC.match(line)
+    return Battery(*map(int, match.groups())) if match else None
+
+def parse_clcc(line):
+    """Parse a +CLCC: line, from AT+CLCC or the URC.
+
+    Returns:
+        Call named tuple of the call index, direction (0 outgoing, 1
+        incoming), state (0 active, 1 held, 2 dialing, 3 alerting, 4
+        incoming, 5 waiting, 6 disconnected), mode (0 voice), multiparty
+        flag, number and number type
+    """
+    match = _CLCC.match(line)
+    if match is None:
+        return None
+    groups = match.groups()
+    return Call(*(list(map(int, groups[:5])) + [groups[5], _int(groups[6])]))
+
+def parse_clip(line):
+    """Parse a +CLIP: line of caller identification.
+
+    Returns:
+        Caller named tuple of the number, its type and the name of the
+        caller from the phonebook, if any
+    """
+    match = _CLIP.match(line)
+    if match is None:
+        return None
+    number, number_type, alpha = match.groups()
+    return Caller(number, int(number_type), alpha)
+
+def parse_cclk(line):
+    """Parse the +CCLK: line of AT+CCLK?.
+
+    Returns:
+        String of the clock of the FONA as yy/MM/dd,hh:mm:ss+zz, where zz
+        is the offset from UTC in quarters of an hour, or None if the
+        line could not be parsed
+    """
+    match = _CCLK.match(line)
+    return match.group(1) if match else None
+
+def parse_creg(line):
+    """Parse the +CREG: (or +CGREG:) line of AT+CREG?.
+
+    Returns:
+        Network named tuple of the URC mode, the registration status (1
+        registered, home network, 5 registered, roaming) and the location
+        area code and cell id if AT+CREG=2 is in effect
+    """
+    match = _CREG.match(line)
+    if match is None:
+        return None
+    mode, stat, lac, ci = match.groups()
+    return Network(int(mode), int(stat), lac, ci)
+
+def parse_cipgsmloc(line):
+    """Parse the +CIPGSMLOC: line of AT+CIPGSMLOC=1 or =2.
+
+    Returns:
+        Location named tuple of the location code (0 for success), the
+        longitude and latitude (None for AT+CIPGSMLOC=2 or an error) and
+        the date and time
+    """
+    match = _CIPGSMLOC.match(line)
+    if match is None:
+        return None
+    code, longitude, latitude, date, time = match.groups()
+    return Location(int(code), float(longitude) if longitude else None,
+        float(latitude) if latitude else None, date, time)
+
+def parse_sapbr(line):
+    """Parse the +SAPBR: line of AT+SAPBR=2,<cid>.
+
+    Returns:
+        Bearer named tuple of the bearer profile, its status (0 connecting,
+        1 connected, 2 closing, 3 closed) and its IP address
+    """
+    match = _SAPBR.match(line)
+    if match is None:
+        return None
+    cid, status, ip = match.groups()
+    return Bearer(int(cid), int(status), ip)
+
+def parse_ciprxget(line):
+    """Parse a +CIPRXGET: line, the header of the data read with
+    AT+CIPRXGET=2 or =3, the answer to AT+CIPRXGET=4 or the URC of mode
+    1. The link number is only present in multi-connection mode, which
+    is told from the number of parameters.
+
+    Returns:
+        Receive_Header named tuple of the mode, the link (None without
+        multi-connection mode), the length read (None for modes 1 and 4)
+        and the length left to read (None for mode 1)
+    """
+    match = _CIPRXGET.match(line)
+    if match is None:
+        return None
+    mode = int(match.group(1))
+    fields = [int(field) for field in match.group(2).split(',')[1:]]
+    if mode not in _CIPRXGET_FIELDS:
+        return None
+    link = fields.pop(0) if len(fields) > _CIPRXGET_FIELDS[mode] else None
+    if len(fields) != _CIPRXGET_FIELDS[mode]:
+        return None
+    length = fields[0] if mode in (2, 3) else None
+    remaining = fields[-1] if fields else None
+    return Receive_Header(mode, link, length, remaining)
+
+def parse_cpbr(line):
+    """Parse a +CPBR: line of a SIM phonebook read.
+
+    Returns:
+        Phonebook_Entry named tuple of the index, number, number type
+        (145 international, 129 national) and name, or None if the line
+        is not an entry
+    """
+    match = _CPBR.match(line)
+    if match is None:
+        return None
+    index, number, number_type, name = match.groups()
+    return Phonebook_Entry(int(index), number, int(number_type), name)
+
+def parse_cpbr_range(line):
+    """Parse the +CPBR: line of AT+CPBR=?.
+
+    Returns:
+        Phonebook_Range named tuple of the first and last index of the
+        phonebook and the greatest lengths of a number and of a name
+    """
+    match = _CPBR_RANGE.match(line)
+    return Phonebook_Range(*map(int, match.groups())) if match else None
+
+PARSERS = {
+    '+CMGL': parse_cmgl,
+    '+CMGR': parse_cmgr,
+    '+CMGS': parse_cmgs,
+    '+CMGSEX': parse_cmgs,
+    '+CPMS': parse_cpms,
+    '+CSQ': parse_csq,
+    '+CBC': parse_cbc,
+    '+CLCC': parse_clcc,
+    '+CLIP': parse_clip,
+    '+CCLK': parse_cclk,
+    '+CREG': parse_creg,
+    '+CGREG': parse_creg,
+    '+CIPGSMLOC': parse_cipgsmloc,
+    '+SAPBR': parse_sapbr,
+    '+CIPRXGET': parse_ciprxget,
+    '+CPBR': parse_cpbr,
+}
+
+def parse(output, prefix):
+    """Parse the first information line of output with a prefix.
+
+    Args:
+        output (str list): string array of FONA output
+        prefix (str): one of the prefixes in PARSERS, e.g. +CSQ
+
+    Returns:
+        Named tuple of the line (see the parse_* methods), or None if
+        there is no such line or it could not be parsed
+    """
+    line = find_line(output, prefix)
+    return None if line is None else PARSERS[prefix](line)
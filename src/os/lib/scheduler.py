@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from math import floor, log2
+from threading import Event, Lock
+from time import monotonic
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-31'
+__version__ = '1.0'
+
+"""Power-Aware Scheduler of the Periodic Jobs of the OS.
+
+Every wakeup of the Raspberry Pi (and every command it writes to the
+FONA, which wakes the modem) costs battery, so the periodic work of the
+OS, e.g. sampling the telemetry of the FONA or checking the outbox, is
+not done by threads which each sleep a fixed delay, but by jobs of one
+scheduler, run by the scheduler thread (see inc/scheduler_thread.py).
+
+Wakeups are coalesced: each job runs at the earliest when it is due and
+at the latest SLACK of its interval later, like the timer slack of
+Linux. The scheduler sleeps until the first moment some job can no longer
+wait, rounded down to a TICK so jobs of different intervals meet on the
+same ticks, and then runs every job which is due. A job which would be
+due shortly after a wakeup is therefore run with the jobs of that wakeup
+instead of waking the Raspberry Pi again, as long as its slack allows.
+
+The intervals of adaptive jobs are multiplied by the backoff, which
+depends on the power state:
+    the user is active (see activity): 1;
+    the screen is off or the user has been idle for IDLE_AFTER seconds:
+    2, doubling every time the idle time doubles, up to MAX_BACKOFF;
+    the battery is low (LOW_BATTERY) or critical (CRITICAL_BATTERY) and
+    not charging: a further 2 or 4, still up to MAX_BACKOFF.
+The backoff is applied whenever a job is rescheduled, so an idle phone
+slows down gradually, and activity brings every adaptive job whose next
+run was backed off back to its delay without the backoff at once. The
+UI hands its Kivy window to watch, so that every touch and key press is
+activity and hiding or minimizing the window turns the screen off, and
+the signal thread records an incoming call or SMS as activity.
+
+Every wakeup is counted, so the standby cost of the jobs can be measured
+as wakeups per hour (see wakeups_per_hour and scheduler_bench.py).
+
+Attributes:
+    TICK (float): seconds of the grid wakeups are aligned to
+    SLACK (float): default fraction of its interval a job may run late
+    IDLE_AFTER (float): seconds without activity after which the user is
+    idle
+    MAX_BACKOFF (int): greatest multiplier of the intervals of adaptive
+    jobs
+    LOW_BATTERY, CRITICAL_BATTERY (int): battery percentages below which
+    the intervals are backed off further
+    HOUR (float): seconds over which wakeups are counted
+    scheduler (Scheduler): scheduler of the OS, run by the scheduler
+    thread
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+TICK = 1.0
+SLACK = 0.25
+IDLE_AFTER = 30.0
+MAX_BACKOFF = 16
+LOW_BATTERY = 20
+CRITICAL_BATTERY = 10
+HOUR = 3600.0
+
+logger = logging.getLogger(__name__)
+
+class _Job(object):
+    """Periodic job of a scheduler.
+
+    Attributes:
+        name (str): name of the job
+        callback (callable): function run when the job is due, which may
+        return the number of seconds until it is due again instead of its
+        interval
+        interval (float): seconds between runs before the backoff
+        slack (float): fraction of the interval the job may run late
+        longest (float): greatest number of seconds between runs, or None
+        adaptive (bool): whether the backoff applies to the interval
+        delay (float): seconds between its last run and its next one,
+        before the backoff
+        deadline (float): time.monotonic value at which the job is due
+        latest (float): time.monotonic value by which the job must run
+        runs (int): number of times the job has run
+    """
+
+    __slots__ = ('name', 'callback', 'interval', 'slack', 'longest',
+        'adaptive', 'delay', 'deadline', 'latest', 'runs')
+
+    def __init__(self, name, callback, interval, slack, longest, adaptive):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.slack = slack
+        self.longest = longest
+        self.adaptive = adaptive
+        self.delay = interval
+        self.deadline = self.latest = 0.0
+        self.runs = 0
+
+    def plan(self, now, delay, backoff):
+        """Make the job due after delay seconds, backed off."""
+        self.delay = delay
+        if self.adaptive:
+            delay *= backoff
+        if self.longest is not None:
+            delay = min(delay, self.longest)
+        self.deadline = now + delay
+        self.latest = self.deadline + self.slack * delay
+
+class Scheduler(object):
+    """Periodic jobs, run in one thread on coalesced wakeups.
+
+    Jobs may be scheduled and the power state changed from any thread;
+    run (or run_due) must only be called from one thread.
+    """
+
+    def __init__(self, clock=monotonic):
+        """Constructor for Scheduler object.
+
+        Arg:
+            clock (callable): function returning the current time in seconds
+            (default is time.monotonic; scheduler_bench.py passes a
+            simulated clock)
+        """
+        self.clock = clock
+        self._lock = Lock()
+        self._jobs = {}
+        self._wake = Event()
+        self._started = clock()
+        self._activity = self._started
+        self._screen = True
+        self._battery = None
+        self._wakeups = deque()
+        self.wakeups = 0
+
+    def schedule(self, name, callback, interval, slack=SLACK, longest=None,
+            adaptive=True, delay=None):
+        """Run a function periodically, replacing any job of the same name.
+
+        Args:
+            name (str): name of the job
+            callback (callable): function of no arguments to run; if it
+            returns a number, the job is due again that many seconds later
+            (before the backoff) instead of after interval
+            interval (float): seconds between runs while the user is active
+            slack (float): fraction of the interval the job may run late
+            (default is SLACK)
+            longest (float): greatest number of seconds between runs, however
+            far the interval is backed off (default is None for no limit)
+            adaptive (bool): whether to back the interval off while idle or
+            on low battery (default is True)
+            delay (float): seconds until the first run (default is None for
+            one interval)
+        """
+        job = _Job(name, callback, interval, slack, longest, adaptive)
+        with self._lock:
+            now = self.clock()
+            job.plan(now, interval if delay is None else delay,
+                1 if delay is not None else self.backoff(now))
+            self._jobs[name] = job
+        self._wake.set()
+
+    def cancel(self, name):
+        """Stop running a job, if it is scheduled."""
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def trigger(self, name):
+        """Run a job at the next wakeup, which is right away."""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return
+            job.deadline = job.latest = self.clock()
+        self._wake.set()
+
+    def activity(self):
+        """Record activity of the user, e.g. a touch, and tighten the
+        adaptive jobs to their delay without the backoff."""
+        with self._lock:
+            now = self._activity = self.clock()
+            self._screen = True
+            tightened = False
+            for job in self._jobs.values():
+                if job.adaptive and job.deadline > now + job.delay:
+                    job.plan(now, job.delay, 1)
+                    tightened = True
+        if tightened:
+            self._wake.set()
+
+    def screen(self, on):
+        """Record the screen being turned on (which is activity) or off."""
+        if on:
+            self.activity()
+        else:
+            with self._lock:
+                self._screen = False
+
+    def watch(self, window):
+        """Follow the input and visibility of a Kivy window: a touch or
+        key press is activity, hiding or minimizing the window turns the
+        screen off and showing or restoring it turns the screen on.
+
+        The handlers return None, so the window still dispatches the
+        events to its widgets.
+
+        Arg:
+            window (kivy.core.window.WindowBase): window of the UI, e.g.
+            kivy.core.window.Window
+        """
+        window.bind(on_touch_down=self._on_input, on_key_down=self._on_input,
+            on_show=self._on_screen_on, on_restore=self._on_screen_on,
+            on_hide=self._on_screen_off, on_minimize=self._on_screen_off)
+
+    def _on_input(self, *args):
+        """Record a touch or key press of the watched window."""
+        self.activity()
+
+    def _on_screen_on(self, *args):
+        """Record the watched window being shown or restored."""
+        self.screen(True)
+
+    def _on_screen_off(self, *args):
+        """Record the watched window being hidden or minimized."""
+        self.screen(False)
+
+    def battery(self, percent, charging):
+        """Record the charge of the battery.
+
+        Args:
+            percent (int): charge in percent
+            charging (bool): whether the battery is charging (or full)
+        """
+        with self._lock:
+            self._battery = (percent, bool(charging))
+
+    def backoff(self, now=None):
+        """Return the multiplier of the intervals of adaptive jobs in the
+        current power state."""
+        now = self.clock() if now is None else now
+        level = 0
+        idle = now - self._activity
+        if not self._screen or idle >= IDLE_AFTER:
+            level = 1 + int(log2(max(idle, IDLE_AFTER) / IDLE_AFTER))
+        if self._battery is not None and not self._battery[1]:
+            if self._battery[0] < CRITICAL_BATTERY:
+                level += 2
+            elif self._battery[0] < LOW_BATTERY:
+                level += 1
+        return min(2 ** level, MAX_BACKOFF)
+
+    def next_wake(self):
+        """Return the time.monotonic value of the next wakeup, or None if
+        no job is scheduled."""
+        with self._lock:
+            if not self._jobs:
+                return None
+            deadline = min(job.deadline for job in self._jobs.values())
+            latest = min(job.latest for job in self._jobs.values())
+        return max(deadline, floor(latest / TICK) * TICK)
+
+    def run_due(self):
+        """Count a wakeup and run every job which is due.
+
+        Returns:
+            List of the names of the jobs which ran
+        """
+        now = self.clock()
+        self.wakeups += 1
+        self._wakeups.append(now)
+        while self._wakeups[0] <= now - HOUR:
+            self._wakeups.popleft()
+        with self._lock:
+            due = [job for job in self._jobs.values() if job.deadline <= now]
+        for job in due:
+            try:
+                delay = job.callback()
+            except Exception:
+                logger.exception('Scheduled job %s failed' % job.name)
+                delay = None
+            job.runs += 1
+            with self._lock:
+                job.plan(self.clock(), job.interval if delay is None
+                    else delay, self.backoff())
+        return [job.name for job in due]
+
+    def run(self):
+        """Sleep until the next wakeup and run the jobs which are due, for
+        as long as the OS is running."""
+        while True:
+            self._wake.clear()
+            wake = self.next_wake()
+            if wake is None:
+                self._wake.wait()
+                continue
+            wait = wake - self.clock()
+            if wait > 0 and self._wake.wait(wait):
+                continue
+            self.run_due()
+
+    def wakeups_per_hour(self):
+        """Return the number of wakeups in the last hour, extrapolated if
+        the scheduler has run for less than an hour."""
+        now = self.clock()
+        elapsed = min(now - self._started, HOUR)
+        recent = sum(1 for wakeup in self._wakeups if wakeup > now - HOUR)
+        return recent * HOUR / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        """Return a dict of the state of the scheduler: the backoff, the
+        wakeups per hour and the interval, runs and next run (in seconds
+        from now) of each job."""
+        now = self.clock()
+        with self._lock:
+            jobs = {job.name: {'interval': job.interval, 'runs': job.runs,
+                'due': job.deadline - now} for job in self._jobs.values()}
+        return {'backoff': self.backoff(now),
+            'wakeups_per_hour': self.wakeups_per_hour(), 'jobs': jobs}
+
+scheduler = Scheduler()
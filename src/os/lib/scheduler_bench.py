@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from scheduler import HOUR, SLACK, Scheduler
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-31'
+__version__ = '1.0'
+
+"""Benchmark of the Standby Cost of the Periodic Jobs of the OS.
+
+Runs the jobs the signal thread schedules (see inc/signal_thread.py) on
+a simulated clock for an hour in several power states and prints the
+wakeups per hour and the runs of each job, e.g.
+    python3 scheduler_bench.py --hours 8
+The jobs are:
+    telemetry: due every 10 s, then less often as the values hold still
+    (as telemetry.Telemetry adapts its TTLs), up to every 120 s
+    outbox: every 60 s
+    signal: every 5 s
+The baseline runs them as fixed timers, without slack or backoff, as the
+threads of the OS did when each slept its own fixed delay. The power
+states are: active (the user touches the screen every --touch seconds),
+idle with the screen off, and idle on low and on critical battery.
+"""
+
+def _telemetry():
+    """Return a job behaving like the telemetry job: the delay until the
+    next sample doubles from 10 s up to 120 s as values hold still."""
+    delay = [5.0]
+    def job():
+        delay[0] = min(delay[0] * 2, 120.0)
+        return delay[0]
+    return job
+
+def simulate(hours, fixed=False, touch=None, battery=None):
+    """Run the jobs for a number of simulated hours.
+
+    Args:
+        hours (float): simulated hours
+        fixed (bool): whether to run the jobs as fixed timers (default is
+        False)
+        touch (float): seconds between touches of the user, or None for an
+        idle phone with its screen off (default is None)
+        battery (int): charge of the battery in percent, not charging, or
+        None for a charging battery (default is None)
+
+    Returns:
+        Scheduler which ran the jobs
+    """
+    now = [0.0]
+    scheduler = Scheduler(clock=lambda: now[0])
+    slack = 0 if fixed else SLACK
+    scheduler.schedule('telemetry', _telemetry(), 10, slack=slack,
+        adaptive=not fixed, delay=0)
+    scheduler.schedule('outbox', lambda: None, 60, slack=slack,
+        longest=900, adaptive=not fixed)
+    scheduler.schedule('signal', lambda: None, 5, slack=slack,
+        longest=300, adaptive=not fixed)
+    if touch is None:
+        scheduler.screen(False)
+    if battery is not None:
+        scheduler.battery(battery, False)
+    end = hours * HOUR
+    touched = 0.0
+    while now[0] < end:
+        wake = scheduler.next_wake()
+        if touch is not None and touched + touch < wake:
+            now[0] = touched = touched + touch
+            scheduler.activity()
+            continue
+        now[0] = wake
+        scheduler.run_due()
+    return scheduler
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the scheduler')
+    parser.add_argument('--hours', type=float, default=1,
+        help='simulated hours of each run')
+    parser.add_argument('--touch', type=float, default=10,
+        help='seconds between touches while active')
+    arguments = parser.parse_args()
+    runs = (('baseline (fixed timers)', dict(fixed=True)),
+        ('active', dict(touch=arguments.touch)),
+        ('idle, screen off', dict()),
+        ('idle, battery 15%', dict(battery=15)),
+        ('idle, battery 5%', dict(battery=5)))
+    for label, options in runs:
+        scheduler = simulate(arguments.hours, **options)
+        jobs = scheduler.summary()['jobs']
+        print('%-24s %7.0f wakeups/h  %s' % (label,
+            scheduler.wakeups / arguments.hours, '  '.join('%s %d'
+            % (name, jobs[name]['runs']) for name in sorted(jobs))))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+from scheduler import IDLE_AFTER, MAX_BACKOFF, Scheduler
+
+import unittest
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-31'
+__version__ = '1.0'
+
+"""Test of the Backoff of the Scheduler Following the UI.
+
+Runs a scheduler on a simulated clock with a window standing in for the
+Kivy window of the UI, which dispatches its events to the handlers bound
+by Scheduler.watch the way kivy.event.EventDispatcher does, e.g.
+    python3 scheduler_test.py
+"""
+
+class _Clock(object):
+    """Simulated clock, advanced by the test."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class _Window(object):
+    """Window with the events of kivy.core.window.Window which
+    Scheduler.watch binds to."""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def bind(self, **handlers):
+        self.handlers.update(handlers)
+
+    def dispatch(self, event, *args):
+        """Call the handler of an event; True if it consumed the event, as
+        a Kivy handler returning True stops the event from reaching the
+        widgets."""
+        return bool(self.handlers[event](self, *args))
+
+class Scheduler_Test(unittest.TestCase):
+    """Touches, key presses and the screen state of the watched window
+    drive the backoff of the adaptive jobs."""
+
+    def setUp(self):
+        self.clock = _Clock()
+        self.scheduler = Scheduler(self.clock)
+        self.window = _Window()
+        self.scheduler.watch(self.window)
+        self.scheduler.schedule('signal', lambda: None, 5)
+
+    def idle(self, seconds):
+        """Run the due jobs every second for a number of seconds."""
+        for _ in range(int(seconds)):
+            self.clock.now += 1
+            if self.scheduler.next_wake() <= self.clock.now:
+                self.scheduler.run_due()
+
+    def due(self):
+        """Return the seconds until the signal job is due."""
+        return self.scheduler.summary()['jobs']['signal']['due']
+
+    def test_touch_cancels_backoff(self):
+        self.idle(16 * IDLE_AFTER)
+        self.assertEqual(self.scheduler.backoff(), MAX_BACKOFF)
+        self.assertGreater(self.due(), 5)
+        self.assertFalse(self.window.dispatch('on_touch_down', object()))
+        self.assertEqual(self.scheduler.backoff(), 1)
+        self.assertLessEqual(self.due(), 5)
+
+    def test_key_press_cancels_backoff(self):
+        self.idle(16 * IDLE_AFTER)
+        self.assertFalse(self.window.dispatch('on_key_down', 32, 44, ' ',
+            []))
+        self.assertEqual(self.scheduler.backoff(), 1)
+        self.assertLessEqual(self.due(), 5)
+
+    def test_screen_off_backs_off(self):
+        self.window.dispatch('on_hide')
+        self.assertEqual(self.scheduler.backoff(), 2)
+        self.window.dispatch('on_show')
+        self.assertEqual(self.scheduler.backoff(), 1)
+        self.window.dispatch('on_minimize')
+        self.assertEqual(self.scheduler.backoff(), 2)
+        self.window.dispatch('on_restore')
+        self.assertEqual(self.scheduler.backoff(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+import os
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-21'
+__version__ = '1.0'
+
+"""Benchmark of Full-Text Search Over the Message History.
+
+Fills a message database in a temporary directory with a synthetic
+history, then times SMS_Store.search for a set of queries, e.g.
+    python3 search_bench.py --messages 50000
+The words of the messages follow a Zipf distribution over a generated
+vocabulary, like the words of real conversations, and each conversation
+has a contact name (see SMS_Store.set_name). The queries are one and two
+common and rare words, a name and the beginning of a word as typed.
+The inbox is also timed, from the summary of the conversations and by
+grouping the whole history.
+With --terms the inverted index which replaces FTS5 where SQLite lacks it
+is measured instead.
+"""
+
+_SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'de', 'pa',
+    'zu', 'be', 'ho', 'ji', 'fe', 'go', 'la', 'ma', 'no', 'ri')
+_FIRST_NAMES = ('Ana', 'Boris', 'Carla', 'Dario', 'Ema', 'Filip', 'Goran',
+    'Hana', 'Ivan', 'Jelena', 'Katarina', 'Luka', 'Marko', 'Nina', 'Petar')
+_LAST_NAMES = ('Horvat', 'Kovac', 'Babic', 'Maric', 'Juric', 'Novak',
+    'Knezevic', 'Vukovic', 'Markovic', 'Petrovic')
+
+def corpus(messages, contacts=200, vocabulary=20000, seed=1):
+    """Generate a synthetic message history.
+
+    Args:
+        messages (int): number of messages
+        contacts (int): number of conversations (default is 200)
+        vocabulary (int): number of distinct words (default is 20000)
+        seed (int): seed of the random generator (default is 1)
+
+    Returns:
+        Tuple of the list of (number, name) tuples of the contacts, the
+        list of words by decreasing frequency and the list of (number,
+        body, timestamp, direction) tuples of the messages
+    """
+    random = Random(seed)
+    words = set()
+    while len(words) < vocabulary:
+        words.add(''.join(random.choice(_SYLLABLES)
+            for _ in range(random.randint(1, 4))))
+    words = sorted(words, key=len)
+    weights = [1 / rank for rank in range(1, vocabulary + 1)]
+    people = [('+1555%07d' % random.randrange(10 ** 7), '%s %s'
+        % (random.choice(_FIRST_NAMES), random.choice(_LAST_NAMES)))
+        for _ in range(contacts)]
+    start = 1.4e9
+    history = []
+    for index in range(messages):
+        body = ' '.join(random.choices(words, weights,
+            k=random.randint(3, 30)))
+        history.append((random.choice(people)[0], body.capitalize() + '.',
+            start + index * 60, random.randint(0, 1)))
+    return people, words, history
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark SMS_Store.search')
+    parser.add_argument('--messages', type=int, default=50000,
+        help='number of messages in the history')
+    parser.add_argument('--repeat', type=int, default=20,
+        help='number of times each query is timed')
+    parser.add_argument('--terms', action='store_true',
+        help='measure the inverted index instead of FTS5')
+    arguments = parser.parse_args()
+
+    import sms_store
+    sms_store.FTS5 = not arguments.terms
+    path = os.path.join(mkdtemp(), 'messages.db')
+    store = sms_store.SMS_Store(path)
+    print('Index: %s' % ('FTS5' if store.fts5 else 'terms'))
+
+    people, words, history = corpus(arguments.messages)
+    start = perf_counter()
+    for number, body, timestamp, direction in history:
+        store.add(number, body, timestamp, direction)
+    elapsed = perf_counter() - start
+    print('%d messages added in %.1f s (%.2f ms each)'
+        % (len(history), elapsed, elapsed / len(history) * 1000))
+    start = perf_counter()
+    for number, name in people:
+        store.set_name(number, name)
+    print('%d names set in %.1f s' % (len(people), perf_counter() - start))
+    store.close()
+    print('Database size: %.1f MB' % (os.path.getsize(path) / 2 ** 20))
+
+    store = sms_store.SMS_Store(path)
+    rare = history[len(history) // 2][1].rstrip('.').lower().split()
+    queries = [words[0], words[5], words[5000], '%s %s' % (words[10],
+        words[200]), ' '.join(sorted(rare, key=words.index)[-2:]),
+        people[0][1].split()[0], people[1][1], words[40][:3], words[2][:2]]
+    print('%-28s %8s %8s %8s' % ('query', 'results', 'mean ms', 'max ms'))
+    for query in queries:
+        times = []
+        for _ in range(arguments.repeat):
+            start = perf_counter()
+            results = store.search(query)
+            times.append(perf_counter() - start)
+        print('%-28s %8d %8.2f %8.2f' % (query, len(results),
+            sum(times) / len(times) * 1000, max(times) * 1000))
+    print('Example: %s' % (store.search(queries[4])[:1],))
+    for label, inbox in (('conversations', store.conversations),
+            ('grouping', lambda: store.connection.execute('SELECT thread, '
+            'MAX(timestamp), body, SUM(read = 0), COUNT(*) FROM messages '
+            'GROUP BY thread ORDER BY MAX(timestamp) DESC LIMIT 50'
+            ).fetchall())):
+        start = perf_counter()
+        for _ in range(arguments.repeat):
+            inbox()
+        print('Inbox by %s: %.2f ms' % (label, (perf_counter() - start)
+            / arguments.repeat * 1000))
@@ -0,0 +1,995 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from csv import reader
+from datetime import datetime
+from pdu import GSM, decode, decode_gsm, encode_deliver, split_text
+from select import select
+from threading import Lock, Thread, Timer
+from time import monotonic, sleep
+
+import logging
+import os
+import pty
+import re
+import termios
+import tty
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-26'
+__version__ = '1.0'
+
+"""SIM800 Emulator for Testing the FONA Libraries Without Hardware.
+
+The emulator opens a pseudo-terminal and answers the AT commands written
+to it the way a 2G FONA (SIM800) does, so that fona.py, fona_commands.py
+and everything built on them can run and be benchmarked on any Linux
+machine. Point the fona library at the emulator's port with the
+FONA_PORT environment variable, e.g.
+    python3 sim800_emulator.py --latency 0.02 --messages 30
+prints the name of the port (/dev/pts/N) and serves it until killed.
+
+Implemented is the subset of the SIM800 Series AT Command Manual used by
+fona_commands: identification and status (ATI, CCID, CSPN, CSQ, CBC,
+CREG, CGREG, CCLK, CPIN, CPAS), SMS in text and PDU mode (CMGF, CSDH,
+CNMI, CPMS, CMGR, CMGL, CMGS, CMGD, CMMS), calls (ATD, ATA, ATH, CLCC,
+CLIP), GSM location (CIPGSMLOC), the SIM phonebook (CPBS, CPBR), the
+TCP stack (CIP*) with a loopback echo server, HTTP (HTTP*) and the flash
+file system (FS*). Several commands may be concatenated on one line,
+e.g. AT+CSQ;+CBC, as on the real device.
+
+The SIM message store, phonebook and calls can be scripted: add_sms
+stores an SMS and writes +CMTI, add_contact stores a phonebook entry,
+incoming_call writes RING and +CLIP, remote_answer and remote_hangup
+change the state of an outgoing or active call, server_send and
+server_close play the server of a TCP connection, and schedule runs any
+of these after a delay.
+
+To make measurements meaningful, every response is delayed by latency
+seconds and every byte written to the port costs 10 / baud seconds,
+like the 8N1 UART between the Raspberry Pi and the FONA. Bytes written
+while the port is set to another baud rate are dropped, as the FONA
+would read them as noise, and AT+IPR changes the rate.
+
+With slow clock mode 2 (AT+CSCLK=2) the emulator falls asleep once the
+port has been silent for sleep_delay seconds outside of a call, like the
+SIM800: the bytes which wake it up are dropped, and a URC wakes it up
+too.
+
+Attribute:
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+OK = 'OK'
+ERROR = 'ERROR'
+EOT = b'\x1a'
+ESC = b'\x1b'
+
+STATUS_NAMES = {0: 'REC UNREAD', 1: 'REC READ', 2: 'STO UNSENT',
+    3: 'STO SENT', 4: 'ALL'}
+
+_COMMAND = re.compile(r'([+#$%&*][A-Z]+|[A-Z])(=\?|\?|=)?(.*)',
+    re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+def _args(text):
+    """Split comma separated command arguments and remove quotes."""
+    if not text:
+        return []
+    return next(reader([text], skipinitialspace=True), [])
+
+def _timestamp(when=None):
+    """Format a datetime as the SIM800 does: yy/MM/dd,hh:mm:ss+zz."""
+    return (when or datetime.now()).strftime('%y/%m/%d,%H:%M:%S') + '+00'
+
+def _block(lines):
+    """Frame the information lines of one command as the SIM800 does:
+    <CR><LF>line<CR><LF>line...<CR><LF>, or nothing if there are none."""
+    return '\r\n%s\r\n' % '\r\n'.join(lines) if lines else ''
+
+class SMS(object):
+    """An SMS stored in the emulated SIM message store."""
+
+    __slots__ = ('status', 'number', 'timestamp', 'text', 'concatenation')
+
+    def __init__(self, status, number, timestamp, text, concatenation=None):
+        self.status = status
+        self.number = number
+        self.timestamp = timestamp
+        self.text = text
+        self.concatenation = concatenation or (0, 1, 1)
+
+    def pdu(self):
+        """Return the SMS-DELIVER PDU of the SMS in hex."""
+        return encode_deliver(self.number, self.timestamp, self.text,
+            *self.concatenation)
+
+class SIM800_Emulator(object):
+    """Emulated SIM800 behind a pseudo-terminal.
+
+    Attributes:
+        port_name (str): device path of the pseudo-terminal to open with
+        serial.Serial
+        latency (float): seconds between receiving a command and writing
+        its response
+        baud (int): baud rate of the emulated UART, whose byte time is
+        charged for every byte written, or 0 to accept any rate and
+        write as fast as possible
+        sim_capacity (int): number of slots of the SIM message store
+        messages (dict): SIM message store, SMS objects by index
+        phonebook (dict): SIM phonebook, (number, name) tuples by index
+        phonebook_capacity (int): number of slots of the SIM phonebook
+        sent (list): (number, text) tuples of every SMS (or part of a
+        concatenated SMS) sent
+        commands (list): every command received, in order
+        files (dict): contents of the emulated flash file system by path
+        sleep_delay (float): seconds of silence on the port after which
+        the emulator sleeps in slow clock mode 2
+        wakeups (int): number of times the emulator was woken up by bytes
+        written to it while asleep
+        cell (tuple): location area code and cell ID of the serving cell,
+        in hex as in +CREG
+        location (tuple): longitude and latitude answered to AT+CIPGSMLOC
+        location_delay (float): seconds the emulator takes to answer
+        AT+CIPGSMLOC, as the SIM800 asks a server for the location
+        max_send (int): greatest number of bytes of one AT+CIPSEND
+    """
+
+    def __init__(self, latency=0, baud=0, sim_capacity=30):
+        """Constructor for SIM800_Emulator object.
+
+        Args:
+            latency (float): seconds before each response (default is 0)
+            baud (int): baud rate to throttle output to, or 0 for no
+            throttling (default is 0)
+            sim_capacity (int): slots in the SIM message store (default
+            is 30, the capacity of a typical SIM)
+        """
+        self.latency = latency
+        self.baud = baud
+        self.sim_capacity = sim_capacity
+        self.messages = {}
+        self.phonebook = {}
+        self.phonebook_capacity = 250
+        self.sent = []
+        self.commands = []
+        self.files = {}
+        self.sleep_delay = 5.0
+        self.wakeups = 0
+        self._last_io = monotonic()
+        self.registers = {'E': 1, '+CMGF': 0, '+CSDH': 0, '+CLIP': 0,
+            '+CMEE': 0, '+CMMS': 0, '+CREG': 0, '+CGREG': 0,
+            '+CNMI': [0, 0, 0, 0, 0], '+CLCC': 0, '+CMUT': 0, '+CSCLK': 0,
+            '+IPR': 0, '+CIPMUX': 0, '+CIPRXGET': 0}
+        self.registration = 1
+        self.cell = ('1A2B', '3C4D')
+        self.location = (-122.335167, 47.608013)
+        self.location_delay = 0
+        self.signal = 20
+        self.battery = 87
+        self.call = None
+        self.message_reference = 0
+        self.connections = {}
+        self.max_send = 1460
+        self.http = {}
+        self._prompt = None
+        self._deferred = []
+        self._input = bytearray()
+        self._write_lock = Lock()
+        self._running = False
+        self._thread = None
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        tty.setraw(self._master)
+        self.port_name = os.ttyname(self._slave)
+
+    ####################################################################
+    #                       SCRIPTING INTERFACE                        #
+    ####################################################################
+    def start(self):
+        """Serve the pseudo-terminal from a daemon thread."""
+        self._running = True
+        self._thread = Thread(target=self.serve_forever,
+            name='SIM800_Emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the pseudo-terminal."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def schedule(self, delay, function, *args):
+        """Call function(*args) after delay seconds, e.g.
+            emulator.schedule(2, emulator.incoming_call, '+15551234567')
+
+        Returns:
+            threading.Timer which may be cancelled
+        """
+        timer = Timer(delay, function, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def add_sms(self, number, text, timestamp=None, read=False, notify=True):
+        """Store a received SMS in the first free slots of the SIM.
+
+        A text too long for one SMS is stored as the parts of a
+        concatenated SMS, each in its own slot, as the network delivers
+        it.
+
+        Args:
+            number (str): phone number of the sender
+            text (str): message contents
+            timestamp (str): SIM800 formatted timestamp (default is now)
+            read (bool): whether the SMS is already read (default False)
+            notify (bool): whether to write +CMTI for each part if
+            AT+CNMI asks for it (default is True)
+
+        Returns:
+            Int of the index the SMS (its first part) was stored at, or
+            None if the SIM does not have room for it
+        """
+        alphabet, parts = split_text(text)
+        if alphabet == GSM:
+            texts = [decode_gsm(part) for part in parts]
+        else:
+            texts = [part.decode('utf-16-be') for part in parts]
+        free = [i for i in range(1, self.sim_capacity + 1)
+            if i not in self.messages][:len(texts)]
+        if len(free) < len(texts):
+            return None
+        for part, (index, part_text) in enumerate(zip(free, texts), 1):
+            self.messages[index] = SMS(1 if read else 0, number,
+                timestamp or _timestamp(), part_text,
+                (free[0] % 256, part, len(texts)))
+            if notify and self.registers['+CNMI'][1] in (1, 2):
+                self.urc('+CMTI: "SM",%d' % index)
+        return free[0]
+
+    def add_contact(self, number, name, index=None):
+        """Store an entry in the SIM phonebook.
+
+        Returns:
+            Int of the index the entry was stored at (the first free one
+            unless index is given), or None if the phonebook is full
+        """
+        if index is None:
+            free = [i for i in range(1, self.phonebook_capacity + 1)
+                if i not in self.phonebook]
+            if not free:
+                return None
+            index = free[0]
+        self.phonebook[index] = (number, name)
+        return index
+
+    def incoming_call(self, number):
+        """Start ringing with a call from number."""
+        self.call = {'index': 1, 'direction': 1, 'state': 4, 'number': number}
+        self._report_call()
+        self.ring()
+
+    def ring(self):
+        """Write RING (and +CLIP if enabled) for the ringing call."""
+        if self.call is None or self.call['state'] != 4:
+            return
+        self.urc('RING')
+        if self.registers['+CLIP']:
+            self.urc('+CLIP: "%s",145,"",0,"",0' % self.call['number'])
+
+    def remote_answer(self):
+        """The called party answers the outgoing call."""
+        if self.call is not None:
+            self._set_call_state(0)
+
+    def remote_hangup(self, result='NO CARRIER'):
+        """The other party ends the call, or the network ends an outgoing
+        one with result (e.g. BUSY or NO ANSWER)."""
+        if self.call is not None:
+            self._set_call_state(6)
+            self.call = None
+            self.urc(result)
+
+    def server_send(self, link, data):
+        """The server of a TCP connection sends data, which is buffered
+        for AT+CIPRXGET or written with +RECEIVE."""
+        self._received(link, bytes(data))
+
+    def server_close(self, link):
+        """The server closes a TCP connection."""
+        if self.connections.pop(link, None) is not None:
+            self.urc(('%d, ' % link if self.registers['+CIPMUX'] else '')
+                + 'CLOSED')
+
+    def set_registration(self, stat, lac=None, ci=None):
+        """Change the network (and GPRS) registration status, and the
+        serving cell if lac and ci are given, and write +CREG and +CGREG."""
+        self.registration = stat
+        if lac is not None and ci is not None:
+            self.cell = (lac, ci)
+        lac, ci = self.cell
+        for name in ('+CREG', '+CGREG'):
+            if self.registers[name] == 1:
+                self.urc('%s: %d' % (name, stat))
+            elif self.registers[name] == 2:
+                self.urc('%s: %d,"%s","%s"' % (name, stat, lac, ci))
+
+    def _report_call(self, defer=False):
+        """Write +CLCC for the call if AT+CLCC=1 is in effect."""
+        if self.call is None or not self.registers['+CLCC']:
+            return
+        line = '+CLCC: %d,%d,%d,0,0,"%s",145,""' % (self.call['index'],
+            self.call['direction'], self.call['state'], self.call['number'])
+        if defer:
+            self._defer(line)
+        else:
+            self.urc(line)
+
+    def _set_call_state(self, state, defer=False):
+        """Change the state of the call and report it."""
+        self.call['state'] = state
+        self._report_call(defer)
+
+    def urc(self, line):
+        """Write an unsolicited result code to the port."""
+        self._write('\r\n%s\r\n' % line)
+
+    def _defer(self, line):
+        """Write a URC right after the response to the current command,
+        like CONNECT OK after the OK of AT+CIPSTART."""
+        self._deferred.append(line)
+
+    def _respond(self, text):
+        """Write a response followed by the URCs it deferred."""
+        self._write(text + ''.join('\r\n%s\r\n' % line
+            for line in self._deferred))
+        del self._deferred[:]
+
+    ####################################################################
+    #                          SERIAL SERVING                          #
+    ####################################################################
+    def serve_forever(self):
+        """Read and answer commands until stop is called."""
+        self._running = True
+        while self._running:
+            if not select([self._master], [], [], 0.1)[0]:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self._receive(data)
+
+    @property
+    def asleep(self):
+        """Whether the emulator sleeps in slow clock mode 2."""
+        return (self.registers['+CSCLK'] == 2 and self.call is None and
+            monotonic() - self._last_io >= self.sleep_delay)
+
+    def _write(self, text):
+        """Write to the port, charging the byte time of the baud rate."""
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        with self._write_lock:
+            if self.baud:
+                sleep(len(data) * 10.0 / self.baud)
+            os.write(self._master, data)
+            self._last_io = monotonic()
+
+    def _receive(self, data):
+        """Split received bytes into command lines and prompted input."""
+        if (self.baud and termios.tcgetattr(self._slave)[4] !=
+                getattr(termios, 'B%d' % self.baud, None)):
+            logger.debug('Dropping %d bytes sent at the wrong baud rate'
+                % len(data))
+            return
+        if self.asleep:
+            logger.debug('Waking up, dropping %d bytes' % len(data))
+            self.wakeups += 1
+            self._last_io = monotonic()
+            return
+        self._last_io = monotonic()
+        self._input.extend(data)
+        while self._input:
+            if self._prompt is not None:
+                if not self._receive_prompted():
+                    return
+                continue
+            index = self._input.find(b'\r')
+            if index < 0:
+                return
+            line = self._input[:index].decode('utf-8', 'replace')
+            del self._input[:index + 1]
+            line = line.strip('\n')
+            if not line:
+                continue
+            if self.registers['E']:
+                self._write(line + '\r')
+            self._execute(line)
+
+    def _receive_prompted(self):
+        """Collect the body written after a > prompt.
+
+        Returns:
+            True if the body was complete and has been handled
+        """
+        handler, length = self._prompt
+        if length is None:
+            end = min([i for i in (self._input.find(EOT),
+                self._input.find(ESC)) if i >= 0], default=-1)
+            if end < 0:
+                return False
+            body = bytes(self._input[:end])
+            cancelled = self._input[end:end + 1] == ESC
+            del self._input[:end + 1]
+        else:
+            if len(self._input) < length:
+                return False
+            body = bytes(self._input[:length])
+            cancelled = False
+            del self._input[:length]
+        self._prompt = None
+        if self.latency:
+            sleep(self.latency)
+        if cancelled:
+            self._respond('\r\n%s\r\n' % OK)
+        else:
+            self._respond(handler(body))
+        return True
+
+    def _execute(self, line):
+        """Answer one line of concatenated commands."""
+        self.commands.append(line)
+        if self.latency:
+            sleep(self.latency)
+        if not line.upper().startswith('AT'):
+            self._write('\r\n%s\r\n' % ERROR)
+            return
+        rest = line[2:]
+        output = ''
+        while rest:
+            match = _COMMAND.match(rest)
+            if match is None:
+                self._respond(self._error(output, 4))
+                return
+            verb = match.group(1).upper()
+            mode = match.group(2) or ''
+            argument = match.group(3)
+            if verb in ('D', '+CMGS', '+CMGSEX', '+CIPSEND', '+FSWRITE',
+                    '+HTTPDATA'):
+                argument, rest = argument, ''
+            elif verb.startswith('+'):
+                argument, _, rest = argument.partition(';')
+            else:
+                digits = re.match(r'\d*', argument).group(0)
+                argument, rest = digits, argument[len(digits):].lstrip(';')
+            handler = getattr(self, '_at_' + re.sub(r'\W', '_', verb.lstrip(
+                '+')).lower(), None)
+            try:
+                result = handler(mode, argument) if handler else None
+            except (IndexError, KeyError, ValueError):
+                result = None
+            if result is None:
+                self._respond(self._error(output, 4))
+                return
+            if isinstance(result, tuple):
+                # command which prompts for a body; the response is written
+                # once the body has been received
+                lines, self._prompt = result[0], result[1:]
+                self._write(output + _block(lines) + '\r\n> ')
+                return
+            output += _block(result)
+        self._respond(output + _block([OK]))
+
+    def _error(self, output, code):
+        """Format information lines so far followed by an error result."""
+        error = '+CME ERROR: %d' % code if self.registers['+CMEE'] else ERROR
+        return output + _block([error])
+
+    def _register(self, name, mode, argument, limit=1):
+        """Handle an AT+<name>[=<n>|?] command for a simple register."""
+        if mode == '?':
+            return ['%s: %s' % (name, self.registers[name])]
+        if mode == '=?':
+            return ['%s: (0-%d)' % (name, limit)]
+        value = int(argument or 0)
+        if value > limit:
+            raise ValueError(value)
+        self.registers[name] = value
+        return []
+
+    ####################################################################
+    #                      GENERAL AND STATUS                          #
+    ####################################################################
+    def _at_e(self, mode, argument):
+        self.registers['E'] = int(argument or 0)
+        return []
+
+    def _at_i(self, mode, argument):
+        return ['SIM800 R14.18']
+
+    def _at_z(self, mode, argument):
+        self.registers.update({'E': 1, '+CMGF': 0, '+CSDH': 0, '+CLIP': 0,
+            '+CMEE': 0})
+        return []
+
+    def _at__f(self, mode, argument):
+        return self._at_z(mode, argument)
+
+    def _at_cmee(self, mode, argument):
+        return self._register('+CMEE', mode, argument, 2)
+
+    def _at_ccid(self, mode, argument):
+        return ['89014104279452013452']
+
+    def _at_cspn(self, mode, argument):
+        return ['+CSPN: "EMULATED",0']
+
+    def _at_cpin(self, mode, argument):
+        return ['+CPIN: READY']
+
+    def _at_cfun(self, mode, argument):
+        if mode == '?':
+            return ['+CFUN: 1']
+        return []
+
+    def _at_csq(self, mode, argument):
+        return ['+CSQ: %d,0' % self.signal]
+
+    def _at_cbc(self, mode, argument):
+        millivolts = 3500 + 7 * self.battery
+        return ['+CBC: 0,%d,%d' % (self.battery, millivolts)]
+
+    def _at_creg(self, mode, argument):
+        if mode == '?':
+            if self.registers['+CREG'] == 2:
+                return ['+CREG: 2,%d,"%s","%s"' % ((self.registration,)
+                    + self.cell)]
+            return ['+CREG: %d,%d' % (self.registers['+CREG'],
+                self.registration)]
+        return self._register('+CREG', mode, argument, 2)
+
+    def _at_cgreg(self, mode, argument):
+        if mode == '?':
+            return ['+CGREG: %d,%d' % (self.registers['+CGREG'],
+                self.registration)]
+        return self._register('+CGREG', mode, argument, 2)
+
+    def _at_cclk(self, mode, argument):
+        if mode == '?':
+            return ['+CCLK: "%s"' % _timestamp()]
+        return []
+
+    def _at_clts(self, mode, argument):
+        return ['+CLTS: 0'] if mode == '?' else []
+
+    def _at_cpowd(self, mode, argument):
+        return ['NORMAL POWER DOWN']
+
+    def _at_csclk(self, mode, argument):
+        return self._register('+CSCLK', mode, argument, 2)
+
+    def _at_ipr(self, mode, argument):
+        output = self._register('+IPR', mode, argument, 460800)
+        if mode == '=' and self.baud and self.registers['+IPR']:
+            self.baud = self.registers['+IPR']
+        return output
+
+    def _at_l(self, mode, argument):
+        return []
+
+    ####################################################################
+    #                               SMS                                #
+    ####################################################################
+    def _at_cmgf(self, mode, argument):
+        return self._register('+CMGF', mode, argument)
+
+    def _at_cmms(self, mode, argument):
+        return self._register('+CMMS', mode, argument, 2)
+
+    def _at_csdh(self, mode, argument):
+        return self._register('+CSDH', mode, argument)
+
+    def _at_cnmi(self, mode, argument):
+        if mode == '?':
+            return ['+CNMI: %s' % ','.join(map(str,
+                self.registers['+CNMI']))]
+        values = [int(a or 0) for a in _args(argument)]
+        self.registers['+CNMI'] = (values + [0] * 5)[:5]
+        return []
+
+    def _at_cpms(self, mode, argument):
+        used, total = len(self.messages), self.sim_capacity
+        return ['+CPMS: "SM",%d,%d,"SM",%d,%d,"SM",%d,%d'
+            % ((used, total) * 3)]
+
+    def _header(self, index, sms, listing):
+        """Format the +CMGR or +CMGL header of a stored SMS, followed
+        by its text or, in PDU mode, its PDU."""
+        if not self.registers['+CMGF']:
+            pdu = sms.pdu()
+            header = '%d,,%d' % (sms.status, len(pdu) // 2 - 1)
+            if listing:
+                return ['+CMGL: %d,%s' % (index, header), pdu]
+            return ['+CMGR: %s' % header, pdu]
+        header = '"%s","%s","","%s"' % (STATUS_NAMES[sms.status], sms.number,
+            sms.timestamp)
+        if listing:
+            if self.registers['+CSDH']:
+                header += ',145,%d' % len(sms.text)
+            return ['+CMGL: %d,%s' % (index, header), sms.text]
+        if self.registers['+CSDH']:
+            header += ',145,4,0,0,"+12063130055",145,%d' % len(sms.text)
+        return ['+CMGR: %s' % header, sms.text]
+
+    def _at_cmgr(self, mode, argument):
+        index = int(_args(argument)[0])
+        sms = self.messages.get(index)
+        if sms is None:
+            return []
+        lines = self._header(index, sms, False)
+        if sms.status == 0:
+            sms.status = 1
+        return lines
+
+    def _at_cmgl(self, mode, argument):
+        if mode == '=?':
+            if not self.registers['+CMGF']:
+                return ['+CMGL: (0-4)']
+            return ['+CMGL: ("REC UNREAD","REC READ","STO UNSENT","STO SENT",'
+                '"ALL")']
+        if self.registers['+CMGF']:
+            wanted = _args(argument)[0] if argument else 'REC UNREAD'
+        else:
+            wanted = STATUS_NAMES[int(argument or 0)]
+        lines = []
+        for index in sorted(self.messages):
+            sms = self.messages[index]
+            if wanted != 'ALL' and STATUS_NAMES[sms.status] != wanted:
+                continue
+            lines.extend(self._header(index, sms, True))
+            if sms.status == 0:
+                sms.status = 1
+        return lines
+
+    def _at_cmgd(self, mode, argument):
+        args = [int(a) for a in _args(argument)]
+        flag = args[1] if len(args) > 1 else 0
+        if flag == 0:
+            self.messages.pop(args[0], None)
+        else:
+            # 1 read, 2 read and sent, 3 read, sent and unsent, 4 all
+            statuses = {1: (1,), 2: (1, 3), 3: (1, 2, 3), 4: (0, 1, 2, 3)}
+            for index in [i for i, sms in self.messages.items()
+                    if sms.status in statuses[flag]]:
+                del self.messages[index]
+        return []
+
+    def _at_cmgs(self, mode, argument):
+        if not self.registers['+CMGF']:
+            return self._at_cmgs_pdu(int(_args(argument)[0]))
+        number = _args(argument)[0]
+
+        def send(body):
+            self.message_reference = (self.message_reference + 1) % 256
+            self.sent.append((number, body.decode('utf-8', 'replace')))
+            return '\r\n+CMGS: %d\r\n\r\n%s\r\n' % (self.message_reference,
+                OK)
+        return ([], send, None)
+
+    def _at_cmgs_pdu(self, length):
+        """Prompt for the hex SMS-SUBMIT PDU of AT+CMGS=<length>."""
+
+        def send(body):
+            try:
+                data = bytes.fromhex(body.decode('ascii'))
+                if len(data) - 1 - data[0] != length:
+                    raise ValueError(length)
+                message = decode(body.decode('ascii'))
+            except (UnicodeDecodeError, IndexError, ValueError):
+                return '\r\n+CMS ERROR: 304\r\n'
+            self.message_reference = (self.message_reference + 1) % 256
+            self.sent.append((message.number, message.text))
+            return '\r\n+CMGS: %d\r\n\r\n%s\r\n' % (self.message_reference,
+                OK)
+        return ([], send, None)
+
+    def _at_cmgsex(self, mode, argument):
+        args = _args(argument)
+        if len(args) < 4 or not 1 <= int(args[2]) <= int(args[3]):
+            return None
+        return self._at_cmgs(mode, argument)
+
+    ####################################################################
+    #                          SIM PHONEBOOK                           #
+    ####################################################################
+    def _at_cpbs(self, mode, argument):
+        if mode == '?':
+            return ['+CPBS: "SM",%d,%d' % (len(self.phonebook),
+                self.phonebook_capacity)]
+        if mode == '=?':
+            return ['+CPBS: ("SM")']
+        if _args(argument)[0] != 'SM':
+            raise ValueError(argument)
+        return []
+
+    def _at_cpbr(self, mode, argument):
+        if mode == '=?':
+            return ['+CPBR: (1-%d),40,14' % self.phonebook_capacity]
+        args = [int(a) for a in _args(argument)]
+        first, last = args[0], args[-1]
+        if not 1 <= first <= last <= self.phonebook_capacity:
+            raise ValueError(argument)
+        return ['+CPBR: %d,"%s",%d,"%s"' % (index, number,
+            145 if number.startswith('+') else 129, name)
+            for index, (number, name) in sorted(self.phonebook.items())
+            if first <= index <= last]
+
+    ####################################################################
+    #                              CALLS                               #
+    ####################################################################
+    def _at_d(self, mode, argument):
+        if self.registration not in (1, 5):
+            return None
+        number = argument.rstrip(';')
+        self.call = {'index': 1, 'direction': 0, 'state': 2, 'number': number}
+        self._report_call(True)
+        self._set_call_state(3, True)
+        return []
+
+    def _at_a(self, mode, argument):
+        if self.call is None or self.call['state'] != 4:
+            return None
+        self._set_call_state(0, True)
+        return []
+
+    def _at_h(self, mode, argument):
+        if self.call is not None:
+            self._set_call_state(6, True)
+        self.call = None
+        return []
+
+    def _at_cpas(self, mode, argument):
+        if self.call is None:
+            return ['+CPAS: 0']
+        return ['+CPAS: %d' % (3 if self.call['state'] == 4 else 4)]
+
+    def _at_clcc(self, mode, argument):
+        if mode == '=':
+            return self._register('+CLCC', mode, argument)
+        if self.call is None:
+            return []
+        return ['+CLCC: %d,%d,%d,0,0,"%s",145,""' % (self.call['index'],
+            self.call['direction'], self.call['state'], self.call['number'])]
+
+    def _at_clip(self, mode, argument):
+        return self._register('+CLIP', mode, argument)
+
+    def _at_cmut(self, mode, argument):
+        return self._register('+CMUT', mode, argument)
+
+    ####################################################################
+    #                         GPRS AND LOCATION                        #
+    ####################################################################
+    def _at_sapbr(self, mode, argument):
+        args = _args(argument)
+        if args[0] == '2':
+            return ['+SAPBR: 1,%d,"10.0.0.2"' % (1 if self.registers.get(
+                'bearer') else 3)]
+        if args[0] == '1':
+            self.registers['bearer'] = 1
+        elif args[0] == '0':
+            self.registers['bearer'] = 0
+        return []
+
+    def _at_cipgsmloc(self, mode, argument):
+        if not self.registers.get('bearer'):
+            return ['+CIPGSMLOC: 601']
+        if self.location_delay:
+            sleep(self.location_delay)
+        now = datetime.now().strftime('%Y/%m/%d,%H:%M:%S')
+        if _args(argument)[0] == '2':
+            return ['+CIPGSMLOC: 0,%s' % now]
+        return ['+CIPGSMLOC: 0,%f,%f,%s' % (self.location + (now,))]
+
+    def _at_cstt(self, mode, argument):
+        return []
+
+    def _at_ciicr(self, mode, argument):
+        self.registers['gprs'] = 1
+        return []
+
+    def _at_cifsr(self, mode, argument):
+        return ['10.0.0.2']
+
+    def _at_cifsrex(self, mode, argument):
+        return ['+CIFSREX: 10.0.0.2']
+
+    def _at_cipmux(self, mode, argument):
+        return self._register('+CIPMUX', mode, argument)
+
+    def _at_ciprxget(self, mode, argument):
+        if mode != '=' or _args(argument)[0] in ('0', '1'):
+            return self._register('+CIPRXGET', mode, argument)
+        args = [int(a) for a in _args(argument)]
+        rx_mode, args = args[0], args[1:]
+        link = args.pop(0) if self.registers['+CIPMUX'] else 0
+        if link not in self.connections:
+            return None
+        buffered = self.connections[link]['rx']
+        prefix = '%d,' % link if self.registers['+CIPMUX'] else ''
+        if rx_mode == 4:
+            return ['+CIPRXGET: 4,%s%d' % (prefix, len(buffered))]
+        limit = 730 if rx_mode == 3 else 1460
+        length = args[0] if args else limit
+        if length > limit:
+            return None
+        chunk = bytes(buffered[:length])
+        del buffered[:length]
+        data = chunk.hex().upper() if rx_mode == 3 else chunk.decode(
+            'latin-1')
+        return ['+CIPRXGET: %d,%s%d,%d' % (rx_mode, prefix, len(chunk),
+            len(buffered)), data]
+
+    def _at_cipstatus(self, mode, argument):
+        if not self.connections:
+            return ['STATE: IP GPRSACT' if self.registers.get('gprs')
+                else 'STATE: IP INITIAL']
+        return ['STATE: CONNECT OK']
+
+    def _at_cipstart(self, mode, argument):
+        args = _args(argument)
+        link = int(args.pop(0)) if self.registers['+CIPMUX'] else 0
+        if link in self.connections:
+            return None
+        self.connections[link] = {'address': tuple(args), 'rx': bytearray()}
+        prefix = '%d, ' % link if self.registers['+CIPMUX'] else ''
+        self._defer(prefix + 'CONNECT OK')
+        return []
+
+    def _at_cipsend(self, mode, argument):
+        if mode == '?':
+            if not self.registers['+CIPMUX']:
+                return ['+CIPSEND: %d' % self.max_send]
+            return ['+CIPSEND: %d,%d' % (link, self.max_send)
+                for link in sorted(self.connections)]
+        args = [int(a) for a in _args(argument)]
+        if self.registers['+CIPMUX']:
+            link = args[0]
+            length = args[1] if len(args) > 1 else None
+        else:
+            link = 0
+            length = args[0] if args else None
+        if link not in self.connections or (length or 0) > self.max_send:
+            return None
+
+        def send(body):
+            # the emulated server echoes everything back
+            prefix = '%d, ' % link if self.registers['+CIPMUX'] else ''
+            self._defer_received(link, body)
+            return '\r\n%sSEND OK\r\n' % prefix
+        return ([], send, length)
+
+    def _received(self, link, body, write=None):
+        """Buffer data from the server of a connection and report it with
+        +CIPRXGET: 1 when the buffer was empty (or +RECEIVE without
+        AT+CIPRXGET=1)."""
+        write = write or self.urc
+        connection = self.connections.get(link)
+        if connection is None:
+            return
+        was_empty = not connection['rx']
+        connection['rx'].extend(body)
+        if not self.registers['+CIPRXGET']:
+            write('+RECEIVE,%d,%d:\r\n%s' % (link, len(body),
+                body.decode('latin-1')))
+            connection['rx'] = bytearray()
+        elif was_empty:
+            write('+CIPRXGET: 1' + (',%d' % link
+                if self.registers['+CIPMUX'] else ''))
+
+    def _defer_received(self, link, body):
+        """Receive the echo of a segment right after its SEND OK."""
+        self._received(link, body, self._defer)
+
+    def _at_cipclose(self, mode, argument):
+        args = _args(argument)
+        link = int(args[0]) if self.registers['+CIPMUX'] and args else 0
+        if self.connections.pop(link, None) is None:
+            return None
+        prefix = '%d, ' % link if self.registers['+CIPMUX'] else ''
+        return [prefix + 'CLOSE OK']
+
+    def _at_cipshut(self, mode, argument):
+        self.connections.clear()
+        self.registers['gprs'] = 0
+        return ['SHUT OK']
+
+    ####################################################################
+    #                               HTTP                               #
+    ####################################################################
+    def _at_httpinit(self, mode, argument):
+        self.http = {}
+        return []
+
+    def _at_httppara(self, mode, argument):
+        key, value = _args(argument)[:2]
+        self.http[key] = value
+        return []
+
+    def _at_httpaction(self, mode, argument):
+        body = 'EMULATED %s' % self.http.get('URL', '')
+        self.http['response'] = body
+        self._defer('+HTTPACTION: %s,200,%d' % (_args(argument)[0],
+            len(body)))
+        return []
+
+    def _at_httpread(self, mode, argument):
+        body = self.http.get('response', '')
+        return ['+HTTPREAD: %d' % len(body), body]
+
+    def _at_httpterm(self, mode, argument):
+        self.http = {}
+        return []
+
+    ####################################################################
+    #                           FILE SYSTEM                            #
+    ####################################################################
+    def _at_fscreate(self, mode, argument):
+        self.files.setdefault(_args(argument)[0], '')
+        return []
+
+    def _at_fsdel(self, mode, argument):
+        del self.files[_args(argument)[0]]
+        return []
+
+    def _at_fsflsize(self, mode, argument):
+        return ['+FSFLSIZE: %d' % len(self.files[_args(argument)[0]])]
+
+    def _at_fsls(self, mode, argument):
+        prefix = _args(argument)[0]
+        return [path[len(prefix):] for path in sorted(self.files)
+            if path.startswith(prefix)]
+
+    def _at_fsmem(self, mode, argument):
+        return ['+FSMEM: C:%d bytes' % (262144 - sum(map(len,
+            self.files.values())))]
+
+    def _at_fsread(self, mode, argument):
+        path, _, size, position = (_args(argument) + ['0', '0'])[:4]
+        return [self.files[path][int(position):int(position) + int(size)]]
+
+    def _at_fswrite(self, mode, argument):
+        path, flag, size = _args(argument)[:3]
+
+        def write(body):
+            text = body.decode('utf-8', 'replace')
+            self.files[path] = (self.files[path] + text if flag == '1'
+                else text)
+            return '\r\n%s\r\n' % OK
+        if path not in self.files:
+            return None
+        return ([], write, int(size))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Emulate a SIM800 on a pty')
+    parser.add_argument('--latency', type=float, default=0,
+        help='seconds before each response')
+    parser.add_argument('--baud', type=int, default=0,
+        help='baud rate to throttle output to (0 for no throttling)')
+    parser.add_argument('--messages', type=int, default=0,
+        help='number of SMSs to store on the SIM at startup')
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG,
+        format='%(asctime)s %(levelname)s %(module)s::%(funcName)s: '
+        '%(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
+    emulator = SIM800_Emulator(arguments.latency, arguments.baud)
+    for i in range(arguments.messages):
+        emulator.add_sms('+1555000%04d' % i, 'Message number %d' % i,
+            read=True, notify=False)
+    logger.info('Emulating SIM800 on %s' % emulator.port_name)
+    emulator.serve_forever()
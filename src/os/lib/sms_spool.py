@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+from fona import command
+from fona_commands import send_sms
+from sms_store import DATABASE
+from threading import Event
+from time import monotonic, sleep, time
+
+import logging
+import os
+import re
+import sqlite3
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-19'
+__version__ = '1.0'
+
+"""Persistent Outbound Queue for SMSs.
+
+Sending an SMS takes a round trip to the network of a second or more per
+part, and fails whenever the FONA is busy, not registered or answers
++CMS ERROR. Instead of calling fona_commands.send_sms from the UI, an SMS
+is put into the outbox with enqueue, which only writes a row to the
+message database and returns at once. The outbox thread (see
+inc/outbox_thread.py) sends what is due in the background.
+
+Every message in the outbox is in one of the states QUEUED (waiting to
+be sent, possibly after an earlier failure), SENDING, SENT or FAILED,
+and every change of state is recorded in the outbox_events table with
+its time and a detail (the message references once sent, the error
+otherwise), so the UI can show where each message stands. Because the
+outbox is on the SD card, messages survive a reboot: one which was being
+sent when the OS stopped is put back in the queue when the outbox is
+next opened.
+
+Messages are sent in batches of at most BATCH, with AT+CMMS=1 keeping
+the link to the SMS centre open between them, and at most one message
+every INTERVAL seconds. A message which fails with a transient error
+(no network service, the FONA not answering, network congestion) is
+tried again after a delay doubling from RETRY_DELAY up to
+MAX_RETRY_DELAY; one which fails with a permanent error (see PERMANENT)
+or MAX_ATTEMPTS times is FAILED.
+
+Each SMS_Spool object has its own connection and must only be used from
+the thread which created it.
+
+Attributes:
+    QUEUED, SENDING, SENT, FAILED (str): states of a message
+    BATCH (int): greatest number of messages sent back to back
+    INTERVAL (float): least number of seconds between two messages
+    RETRY_DELAY, MAX_RETRY_DELAY (float): first and greatest number of
+    seconds before a failed message is tried again
+    MAX_ATTEMPTS (int): number of attempts before a message is FAILED
+    PERMANENT (frozenset): +CMS ERROR codes which are not worth retrying
+    pending (threading.Event): set whenever a message is enqueued, to
+    wake up the outbox thread
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+QUEUED = 'QUEUED'
+SENDING = 'SENDING'
+SENT = 'SENT'
+FAILED = 'FAILED'
+
+BATCH = 5
+INTERVAL = 1.0
+RETRY_DELAY = 30.0
+MAX_RETRY_DELAY = 3600.0
+MAX_ATTEMPTS = 8
+# unassigned number, operator determined barring, call barred, short
+# message transfer rejected, destination out of service, unidentified
+# subscriber, facility rejected, unknown subscriber, requested facility
+# not subscribed, invalid mandatory information, invalid PDU or text mode
+# parameter
+PERMANENT = frozenset((1, 8, 10, 21, 27, 28, 29, 30, 50, 96, 304, 305))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    number TEXT NOT NULL,
+    body TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    due REAL NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, due);
+CREATE TABLE IF NOT EXISTS outbox_events (
+    message INTEGER NOT NULL REFERENCES outbox (id),
+    state TEXT NOT NULL,
+    time REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_events_message ON outbox_events (message);
+'''
+_CMS_ERROR = re.compile(r'\+CMS ERROR: *(\d+)')
+
+pending = Event()
+logger = logging.getLogger(__name__)
+
+def is_permanent(error):
+    """Determine if a failure to send an SMS is not worth retrying.
+
+    Arg:
+        error (Exception): what fona_commands.send_sms raised
+
+    Returns:
+        True if the FONA answered with one of the PERMANENT +CMS ERROR
+        codes; False for anything else, e.g. no network service or the
+        FONA not answering at all
+    """
+    match = _CMS_ERROR.search(str(error))
+    return match is not None and int(match.group(1)) in PERMANENT
+
+def retry_delay(attempts):
+    """Return the seconds to wait before the next attempt to send a
+    message which failed attempts times."""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+class SMS_Spool(object):
+    """Connection to the outbox in the message database.
+
+    Attribute:
+        connection (sqlite3.Connection): connection to the database
+    """
+
+    def __init__(self, path=DATABASE):
+        """Constructor for SMS_Spool object.
+
+        Opens (creating if necessary) the outbox in the database at path
+        in WAL mode, and puts back in the queue every message which was
+        being sent when the outbox was last closed.
+
+        Arg:
+            path (str): path of the database file (default is the message
+            database of sms_store)
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+        self._last_send = float('-inf')
+        for (message,) in self.connection.execute('SELECT id FROM outbox '
+                'WHERE state = ?', (SENDING,)).fetchall():
+            self._transition(message, QUEUED, 'interrupted')
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def _transition(self, message, state, detail=None, **columns):
+        """Change the state of a message and record the change."""
+        now = time()
+        assignments = ''.join(', %s = ?' % name for name in columns)
+        with self.connection:
+            self.connection.execute('UPDATE outbox SET state = ?, '
+                'updated = ?, detail = ?' + assignments + ' WHERE id = ?',
+                [state, now, detail] + list(columns.values()) + [message])
+            self.connection.execute('INSERT INTO outbox_events (message, '
+                'state, time, detail) VALUES (?, ?, ?, ?)',
+                (message, state, now, detail))
+
+    def enqueue(self, number, body):
+        """Put an SMS into the outbox and wake up the outbox thread.
+
+        Args:
+            number (str): phone number of the recipient, with its
+            international code
+            body (str): message contents
+
+        Returns:
+            Int of the id of the message in the outbox
+        """
+        now = time()
+        with self.connection:
+            message = self.connection.execute('INSERT INTO outbox (number, '
+                'body, state, due, created, updated) VALUES '
+                '(?, ?, ?, ?, ?, ?)', (number, body, QUEUED, now, now,
+                now)).lastrowid
+            self.connection.execute('INSERT INTO outbox_events (message, '
+                'state, time) VALUES (?, ?, ?)', (message, QUEUED, now))
+        pending.set()
+        return message
+
+    def due(self, limit=BATCH, now=None):
+        """Return the queued messages which are due, oldest first.
+
+        Args:
+            limit (int): greatest number of messages (default is BATCH)
+            now (float): seconds since the epoch (default is now)
+
+        Returns:
+            List of (id, number, body, attempts) tuples
+        """
+        if now is None:
+            now = time()
+        return self.connection.execute('SELECT id, number, body, attempts '
+            'FROM outbox WHERE state = ? AND due <= ? ORDER BY due, id '
+            'LIMIT ?', (QUEUED, now, limit)).fetchall()
+
+    def next_due(self):
+        """Return the time the next queued message is due, or None if
+        the queue is empty."""
+        return self.connection.execute('SELECT MIN(due) FROM outbox WHERE '
+            'state = ?', (QUEUED,)).fetchone()[0]
+
+    def send(self, message, number, body, attempts):
+        """Send one message of the outbox and record the outcome.
+
+        Args:
+            message (int): id of the message
+            number (str): phone number of the recipient
+            body (str): message contents
+            attempts (int): number of earlier attempts
+
+        Returns:
+            True if the message was sent; False otherwise
+        """
+        self._transition(message, SENDING, attempts=attempts + 1)
+        try:
+            sent = send_sms(number, body)
+        except IOError as error:
+            attempts += 1
+            if is_permanent(error) or attempts >= MAX_ATTEMPTS:
+                logger.warning('Giving up on SMS %d to %s: %s'
+                    % (message, number, error))
+                self._transition(message, FAILED, str(error))
+            else:
+                delay = retry_delay(attempts)
+                logger.info('Retrying SMS %d in %d seconds: %s'
+                    % (message, delay, error))
+                self._transition(message, QUEUED, str(error),
+                    due=time() + delay)
+            return False
+        self._transition(message, SENT, ' '.join(map(str, sent.references)))
+        return True
+
+    def send_batch(self, limit=BATCH):
+        """Send the messages which are due, at most limit of them and one
+        every INTERVAL seconds, keeping the link to the SMS centre open
+        between them.
+
+        Arg:
+            limit (int): greatest number of messages (default is BATCH)
+
+        Returns:
+            List of the (id, number, body) tuples of the messages sent
+        """
+        messages = self.due(limit)
+        if len(messages) > 1:
+            command('AT+CMMS=1')
+        sent = []
+        for message, number, body, attempts in messages:
+            wait = self._last_send + INTERVAL - monotonic()
+            if wait > 0:
+                sleep(wait)
+            self._last_send = monotonic()
+            if self.send(message, number, body, attempts):
+                sent.append((message, number, body))
+        return sent
+
+    def cancel(self, message):
+        """Remove a message which has not been sent yet from the queue.
+
+        Returns:
+            True if the message was queued; False otherwise
+        """
+        row = self.connection.execute('SELECT state FROM outbox WHERE id = ?',
+            (message,)).fetchone()
+        if row is None or row[0] != QUEUED:
+            return False
+        self._transition(message, FAILED, 'cancelled')
+        return True
+
+    def state(self, message):
+        """Return the (state, attempts, detail) tuple of a message, or
+        None if there is no message with that id."""
+        return self.connection.execute('SELECT state, attempts, detail FROM '
+            'outbox WHERE id = ?', (message,)).fetchone()
+
+    def history(self, message):
+        """Return the (state, time, detail) tuples of every change of
+        state of a message, oldest first."""
+        return self.connection.execute('SELECT state, time, detail FROM '
+            'outbox_events WHERE message = ? ORDER BY rowid',
+            (message,)).fetchall()
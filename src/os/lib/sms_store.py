@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+from math import log
+from time import time
+
+import logging
+import os
+import re
+import sqlite3
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-03'
+__version__ = '1.0'
+
+"""Persistent Message Store for SMSs.
+
+The SIM card holds only a few dozen SMSs and is slow to read over the
+serial port, so the message history of the phone lives in an SQLite
+database on the SD card instead. The SMS store copies SMSs from the SIM
+card into the database (a sync) and then deletes them from the SIM, so
+that the SIM never fills up and every SMS still on it is new.
+
+A sync is incremental: when the FONA reports a new SMS with +CMTI (see
+urc.New_SMS) only the SMS at that index is read with sync(index), and a
+full sync, which lists the whole SIM in one AT+CMGL, is only needed at
+boot and when a part of a concatenated SMS arrives. Rows are unique on
+sender, timestamp and contents, so an SMS whose deletion from the SIM
+failed is not stored twice by the next sync.
+
+The database is in WAL mode so that the message application can read
+conversations while the SMS thread writes new messages, and is indexed
+by conversation thread, timestamp and SIM index. Reading a conversation
+never touches the serial port, and this library does not import the
+FONA libraries at all: sync is handed the SMS commands of the SIM card
+by the SMS thread.
+
+Every conversation is keyed by the phone number of the other party in
+E.164 form (see normalize_number), so that (555) 123-4567, 15551234567
+and +1 555 123 4567 are the same conversation. The conversations table
+holds a summary of each one: its last message, its number of unread
+messages and of messages. Triggers on the messages table update the
+summary of a single conversation whenever a message is added, read or
+deleted, so the inbox of the message application is one query of the
+conversations table instead of a grouping of the whole history.
+
+Message bodies, numbers and the names of the senders (see set_name) are
+indexed for full-text search with an SQLite FTS5 table, kept up to date
+by triggers as messages are added, so search returns the best matches
+with highlighted snippets without scanning the history. Where SQLite is
+built without FTS5, a plain inverted index of terms (the terms table) is
+kept by SMS_Store instead, with the same search method.
+
+Each SMS_Store object has its own connection and must only be used from
+the thread which created it.
+
+Attributes:
+    DATABASE (str): default path of the message database
+    COUNTRY_CODE (str): country calling code of the SIM card, added to
+    numbers written without one
+    TRUNK_PREFIX (str): prefix of national numbers dialled within the
+    country, replaced by COUNTRY_CODE
+    INTERNATIONAL_PREFIX (str): prefix of international numbers dialled
+    without a +
+    NATIONAL_LENGTH (int): number of digits of a national number without
+    its trunk prefix
+    FTS5 (bool): whether to use FTS5 for search when SQLite supports it
+    SEARCH_WINDOW (int): number of the newest messages FTS5 ranks first
+    RECEIVED (int): direction of a received SMS
+    SENT (int): direction of a sent SMS
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'data', 'messages.db')
+RECEIVED = 0
+SENT = 1
+COUNTRY_CODE = '1'
+TRUNK_PREFIX = '1'
+INTERNATIONAL_PREFIX = '011'
+NATIONAL_LENGTH = 10
+FTS5 = True
+SEARCH_WINDOW = 4096
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    thread TEXT NOT NULL,
+    number TEXT NOT NULL,
+    direction INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    body TEXT NOT NULL,
+    read INTEGER NOT NULL DEFAULT 0,
+    sim_index INTEGER,
+    name TEXT,
+    UNIQUE (number, timestamp, body)
+);
+CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread, timestamp);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE INDEX IF NOT EXISTS messages_sim_index ON messages (sim_index);
+'''
+_CONVERSATIONS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS conversations (
+    thread TEXT PRIMARY KEY,
+    name TEXT,
+    message INTEGER NOT NULL,
+    direction INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    body TEXT NOT NULL,
+    unread INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_timestamp
+    ON conversations (timestamp);
+CREATE TRIGGER IF NOT EXISTS conversations_insert AFTER INSERT ON messages
+BEGIN
+    INSERT OR IGNORE INTO conversations (thread, name, message, direction,
+        timestamp, body)
+    VALUES (new.thread, new.name, new.id, new.direction, new.timestamp,
+        new.body);
+    UPDATE conversations SET unread = unread + (new.read = 0),
+        count = count + 1 WHERE thread = new.thread;
+    UPDATE conversations SET message = new.id, direction = new.direction,
+        timestamp = new.timestamp, body = new.body
+    WHERE thread = new.thread AND timestamp <= new.timestamp;
+END;
+CREATE TRIGGER IF NOT EXISTS conversations_read AFTER UPDATE OF read
+        ON messages WHEN old.read != new.read BEGIN
+    UPDATE conversations SET unread = unread + old.read - new.read
+    WHERE thread = new.thread;
+END;
+CREATE TRIGGER IF NOT EXISTS conversations_name AFTER UPDATE OF name
+        ON messages WHEN new.name IS NOT old.name BEGIN
+    UPDATE conversations SET name = new.name
+    WHERE thread = new.thread AND name IS NOT new.name;
+END;
+CREATE TRIGGER IF NOT EXISTS conversations_delete AFTER DELETE ON messages
+BEGIN
+    UPDATE conversations SET unread = unread - (old.read = 0),
+        count = count - 1 WHERE thread = old.thread;
+    DELETE FROM conversations WHERE thread = old.thread AND count = 0;
+    UPDATE conversations SET (message, direction, timestamp, body) = (
+        SELECT id, direction, timestamp, body FROM messages
+        WHERE thread = old.thread ORDER BY timestamp DESC, id DESC LIMIT 1)
+    WHERE thread = old.thread AND message = old.id;
+END;
+'''
+_FTS5_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, number, name,
+    content='messages', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body, number, name)
+    VALUES (new.id, new.body, new.number, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body, number, name)
+    VALUES ('delete', old.id, old.body, old.number, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF body, number,
+        name ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, body, number, name)
+    VALUES ('delete', old.id, old.body, old.number, old.name);
+    INSERT INTO messages_fts (rowid, body, number, name)
+    VALUES (new.id, new.body, new.number, new.name);
+END;
+'''
+_TERMS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT NOT NULL,
+    message INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (term, message)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS terms_message ON terms (message);
+'''
+_TERM = re.compile(r'\w+')
+_SIM_TIMESTAMP = re.compile(
+    r'(\d\d)/(\d\d)/(\d\d),(\d\d):(\d\d):(\d\d)([+-]\d+)?')
+
+Conversation = namedtuple('Conversation',
+    'thread name message direction timestamp body unread count')
+
+logger = logging.getLogger(__name__)
+
+def normalize_number(number):
+    """Return the key of the conversation thread of a phone number.
+
+    The key is the number in E.164 form, + and the country code followed
+    by the national number, with the formatting characters removed, so
+    that +1 (555) 123-4567, 1-555-123-4567 and 555 123 4567 belong to
+    the same conversation. A number written without a + is completed
+    with COUNTRY_CODE when it has the length of a national number (with
+    or without TRUNK_PREFIX), and with just the + when it is longer.
+    Shorter numbers, e.g. the short codes of operators, are only
+    stripped of their formatting.
+
+    Arg:
+        number (str): phone number as written by the FONA or the user
+
+    Returns:
+        String of the E.164 number, or of the digits of a short code
+    """
+    digits = re.sub(r'\D', '', number)
+    if number.lstrip().startswith('+'):
+        return '+' + digits
+    if digits.startswith(INTERNATIONAL_PREFIX):
+        return '+' + digits[len(INTERNATIONAL_PREFIX):]
+    if len(digits) == len(TRUNK_PREFIX) + NATIONAL_LENGTH and \
+            digits.startswith(TRUNK_PREFIX):
+        return '+' + COUNTRY_CODE + digits[len(TRUNK_PREFIX):]
+    if len(digits) == NATIONAL_LENGTH:
+        return '+' + COUNTRY_CODE + digits
+    if len(digits) > NATIONAL_LENGTH:
+        return '+' + digits
+    return digits
+
+def parse_sim_timestamp(timestamp):
+    """Convert a SIM800 timestamp to seconds since the epoch.
+
+    The FONA writes timestamps as yy/MM/dd,hh:mm:ss+zz where zz is the
+    offset from UTC in quarters of an hour.
+
+    Arg:
+        timestamp (str): timestamp from a +CMGR or +CMGL header
+
+    Returns:
+        Float of seconds since the epoch, or the current time if the
+        timestamp cannot be parsed
+    """
+    match = _SIM_TIMESTAMP.match(timestamp)
+    if match is None:
+        return time()
+    year, month, day, hour, minute, second = map(int, match.groups()[:6])
+    seconds = timegm(datetime(2000 + year, month, day, hour, minute,
+        second).timetuple())
+    return seconds - int(match.group(7) or 0) * 15 * 60
+
+def _snippet(body, terms, width=60):
+    """Return the part of a body around its first match of the search
+    terms, with the terms in [brackets], as FTS5 snippet does."""
+    pattern = re.compile(r'\b(?:%s)\w*' % '|'.join(map(re.escape, terms)),
+        re.IGNORECASE)
+    match = pattern.search(body)
+    start = max(0, match.start() - width // 3) if match else 0
+    end = start + width
+    text = pattern.sub(lambda match: '[%s]' % match.group(0), body[start:end])
+    return ('...' if start else '') + text + ('...' if end < len(body) else '')
+
+def query_terms(query):
+    """Split a search query into lower case terms."""
+    return _TERM.findall(query.lower())
+
+class SMS_Store(object):
+    """Connection to the message database.
+
+    Attributes:
+        connection (sqlite3.Connection): connection to the database
+        fts5 (bool): whether search uses FTS5 rather than the terms table
+    """
+
+    def __init__(self, path=DATABASE):
+        """Constructor for SMS_Store object.
+
+        Opens (creating if necessary) the database at path in WAL mode.
+
+        Arg:
+            path (str): path of the database file (default is DATABASE)
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(_SCHEMA)
+        columns = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info(messages)')]
+        if 'name' not in columns:
+            self.connection.execute('ALTER TABLE messages ADD COLUMN '
+                'name TEXT')
+        self._create_conversations()
+        self.fts5 = FTS5 and self._create_fts5()
+        if not self.fts5:
+            self._create_terms()
+
+    def _create_conversations(self):
+        """Create the summary of the conversations, filling it from the
+        messages already stored if it is new.
+
+        The threads of those messages are keyed again by normalize_number
+        first, since databases created before the summary keyed them by
+        the digits of the number alone.
+        """
+        exists = self.connection.execute('SELECT 1 FROM sqlite_master WHERE '
+            'name = ?', ('conversations',)).fetchone()
+        self.connection.executescript(_CONVERSATIONS_SCHEMA)
+        if exists:
+            return
+        self.connection.create_function('normalize_number', 1,
+            normalize_number)
+        with self.connection:
+            self.connection.execute('UPDATE messages SET thread = '
+                'normalize_number(number)')
+            self.connection.execute('INSERT INTO conversations (thread, '
+                'name, message, direction, timestamp, body, unread, count) '
+                'SELECT thread, NULL, id, direction, MAX(timestamp), body, '
+                'SUM(read = 0), COUNT(*) FROM messages GROUP BY thread')
+            self.connection.execute('UPDATE conversations SET name = '
+                '(SELECT name FROM messages WHERE messages.thread = '
+                'conversations.thread AND name IS NOT NULL LIMIT 1)')
+
+    def _create_fts5(self):
+        """Create the FTS5 index, filling it from the messages already
+        stored if it is new.
+
+        Returns:
+            False if SQLite does not support FTS5
+        """
+        exists = self.connection.execute('SELECT 1 FROM sqlite_master WHERE '
+            'name = ?', ('messages_fts',)).fetchone()
+        try:
+            self.connection.executescript(_FTS5_SCHEMA)
+        except sqlite3.OperationalError as error:
+            logger.warning('Full-text search without FTS5: %s' % error)
+            return False
+        if not exists:
+            with self.connection:
+                self.connection.execute('INSERT INTO messages_fts '
+                    '(messages_fts) VALUES (?)', ('rebuild',))
+                self.connection.execute('INSERT INTO messages_fts '
+                    '(messages_fts, rank) VALUES (?, ?)',
+                    ('rank', 'bm25(1.0, 0.5, 2.0)'))
+        return True
+
+    def _create_terms(self):
+        """Create the inverted index, filling it from the messages
+        already stored if it is new."""
+        exists = self.connection.execute('SELECT 1 FROM sqlite_master WHERE '
+            'name = ?', ('terms',)).fetchone()
+        self.connection.executescript(_TERMS_SCHEMA)
+        if not exists:
+            with self.connection:
+                for row in self.connection.execute('SELECT id, body, number, '
+                        'name FROM messages').fetchall():
+                    self._index(*row)
+
+    def _index(self, row, body, number, name):
+        """Add the terms of a message to the inverted index."""
+        counts = {}
+        for term in query_terms(' '.join(filter(None, (body, number, name)))):
+            counts[term] = counts.get(term, 0) + 1
+        self.connection.executemany('INSERT OR REPLACE INTO terms (term, '
+            'message, count) VALUES (?, ?, ?)',
+            [(term, row, count) for term, count in counts.items()])
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def add(self, number, body, timestamp=None, direction=RECEIVED,
+            read=False, sim_index=None):
+        """Store an SMS unless an identical one is already stored.
+
+        Args:
+            number (str): phone number of the sender or recipient
+            body (str): message contents
+            timestamp (float): seconds since the epoch (default is now)
+            direction (int): RECEIVED or SENT (default is RECEIVED)
+            read (bool): whether the user has seen the SMS (default is
+            False)
+            sim_index (int): index the SMS was synced from, if any
+
+        Returns:
+            Int of the row id of the new SMS, or None if it was already
+            stored
+        """
+        with self.connection:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO messages '
+                '(thread, number, direction, timestamp, body, read, '
+                'sim_index, name) VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT name '
+                'FROM conversations WHERE thread = ?))',
+                (normalize_number(number), number, direction,
+                time() if timestamp is None else timestamp, body, int(read),
+                sim_index, normalize_number(number)))
+            if cursor.rowcount and not self.fts5:
+                self._index(*self.connection.execute('SELECT id, body, '
+                    'number, name FROM messages WHERE id = ?',
+                    (cursor.lastrowid,)).fetchone())
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def _add_sim(self, sms):
+        return self.add(sms.number, sms.message,
+            parse_sim_timestamp(sms.timestamp), RECEIVED,
+            sms.status == 'REC READ', sms.index)
+
+    def sync(self, sim, index=None, delete=True):
+        """Copy SMSs from the SIM card into the database.
+
+        Args:
+            sim: SMS commands of the SIM card, an object with the
+            list_sms, read_sms and delete_sms functions of the
+            fona_commands library (normally that library itself)
+            index (int): SIM index of the single SMS to copy, as reported
+            by +CMTI, or None to copy every SMS on the SIM card (default
+            is None); if the index holds one part of a concatenated SMS,
+            the whole SIM card is listed so that the SMS is copied once
+            all of its parts have arrived
+            delete (bool): whether to delete each SMS (every part of a
+            concatenated one) from the SIM card once it is stored
+            (default is True)
+
+        Returns:
+            List of the row ids of the SMSs which were not stored before
+        """
+        messages = []
+        if index is not None:
+            messages = [sms for sms in [sim.read_sms(index)]
+                if sms is not None]
+        if not messages:
+            messages = list(sim.list_sms())
+        added = []
+        for sms in messages:
+            row = self._add_sim(sms)
+            if row is not None:
+                added.append(row)
+            if not delete:
+                continue
+            for part in sms.parts or (sms.index,):
+                if not sim.delete_sms(part):
+                    logger.warning('Could not delete SMS %d from the SIM'
+                        % part)
+        logger.info('Synced %d SMSs from the SIM, %d new'
+            % (len(messages), len(added)))
+        return added
+
+    def conversation(self, number, limit=50, before=None):
+        """Return the newest SMSs exchanged with a phone number.
+
+        Args:
+            number (str): phone number of the conversation
+            limit (int): greatest number of SMSs to return (default 50)
+            before (float): only return SMSs older than this timestamp,
+            for paging back through the history (default is None)
+
+        Returns:
+            List of (id, number, direction, timestamp, body, read) tuples,
+            newest first
+        """
+        query = ('SELECT id, number, direction, timestamp, body, read FROM '
+            'messages WHERE thread = ?')
+        parameters = [normalize_number(number)]
+        if before is not None:
+            query += ' AND timestamp < ?'
+            parameters.append(before)
+        query += ' ORDER BY timestamp DESC LIMIT ?'
+        parameters.append(limit)
+        return self.connection.execute(query, parameters).fetchall()
+
+    def conversations(self, limit=50, before=None):
+        """Return the summaries of the conversations with the newest
+        messages, as shown in the inbox.
+
+        Args:
+            limit (int): greatest number of conversations to return
+            (default 50)
+            before (float): only return conversations whose last message
+            is older than this timestamp, for paging (default is None)
+
+        Returns:
+            List of Conversation named tuples (thread, name, message,
+            direction, timestamp, body, unread, count) where thread is the
+            E.164 number of the conversation, message, direction,
+            timestamp and body describe its last message, unread is its
+            number of unread messages and count its number of messages,
+            newest first
+        """
+        query = ('SELECT thread, name, message, direction, timestamp, body, '
+            'unread, count FROM conversations')
+        parameters = []
+        if before is not None:
+            query += ' WHERE timestamp < ?'
+            parameters.append(before)
+        query += ' ORDER BY timestamp DESC LIMIT ?'
+        parameters.append(limit)
+        return [Conversation(*row) for row in self.connection.execute(query,
+            parameters)]
+
+    def unread(self):
+        """Return the number of unread SMSs in every conversation."""
+        return self.connection.execute('SELECT COALESCE(SUM(unread), 0) '
+            'FROM conversations').fetchone()[0]
+
+    def mark_read(self, number):
+        """Mark every SMS of the conversation with a number as read."""
+        with self.connection:
+            self.connection.execute('UPDATE messages SET read = 1 WHERE '
+                'thread = ? AND read = 0', (normalize_number(number),))
+
+    def message(self, row):
+        """Return the (id, number, direction, timestamp, body, read) tuple
+        of a stored SMS, or None if there is no SMS with that id."""
+        return self.connection.execute('SELECT id, number, direction, '
+            'timestamp, body, read FROM messages WHERE id = ?',
+            (row,)).fetchone()
+
+    def set_name(self, number, name):
+        """Set the name of the contact of a conversation, by which its
+        messages can also be searched.
+
+        Args:
+            number (str): phone number of the conversation
+            name (str): name of the contact, or None to remove it
+        """
+        thread = normalize_number(number)
+        with self.connection:
+            self.connection.execute('UPDATE messages SET name = ? WHERE '
+                'thread = ?', (name, thread))
+            if not self.fts5:
+                rows = self.connection.execute('SELECT id, body, number, name '
+                    'FROM messages WHERE thread = ?', (thread,)).fetchall()
+                self.connection.executemany('DELETE FROM terms WHERE '
+                    'message = ?', [(row[0],) for row in rows])
+                for row in rows:
+                    self._index(*row)
+
+    def search(self, query, limit=20):
+        """Find the messages which best match a search query.
+
+        Every term of the query must appear in the body, number or name of
+        a message; the last term may be the beginning of a word, so the
+        results can be updated as the user types (messages where it is a
+        whole word come first). Matches in the name count most and matches
+        in the number least; among many equally good matches the newest
+        are returned.
+
+        Args:
+            query (str): words to search for
+            limit (int): greatest number of messages to return (default 20)
+
+        Returns:
+            List of (id, number, direction, timestamp, snippet) tuples, best
+            match first, where snippet is the part of the body around the
+            match with the matching terms in [brackets]
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        if not self.fts5:
+            return self._search_terms(terms, limit)
+        # ranking every message which begins with a short prefix is what
+        # makes a search slow, so whole words are looked up first and the
+        # prefix only when they do not make enough results
+        match = ' '.join('"%s"' % term for term in terms)
+        results = self._search_fts5(match, limit)
+        if len(results) < limit:
+            found = set(result[0] for result in results)
+            results += [result for result in self._search_fts5(match + '*',
+                limit) if result[0] not in found][:limit - len(results)]
+        return results
+
+    def _search_fts5(self, match, limit):
+        """Search with FTS5, ranking the newest SEARCH_WINDOW messages
+        first and widening the window until limit of them match.
+
+        Ranking every match of a word found in most messages takes longer
+        than the user waits for, and tells little anyway, since such a
+        word barely weighs in bm25; the newest matches are what the user
+        looks for then. A rare word matches few messages in any window,
+        so its search soon covers the whole history.
+        """
+        newest = self.connection.execute('SELECT MAX(id) FROM messages'
+            ).fetchone()[0] or 0
+        window = SEARCH_WINDOW
+        while True:
+            results = self.connection.execute('SELECT messages.id, '
+                'messages.number, messages.direction, messages.timestamp, '
+                "snippet(messages_fts, 0, '[', ']', '...', 10) FROM "
+                'messages_fts JOIN messages ON messages.id = '
+                'messages_fts.rowid WHERE messages_fts MATCH ? AND '
+                'messages_fts.rowid > ? ORDER BY rank LIMIT ?',
+                (match, newest - window, limit)).fetchall()
+            if len(results) >= limit or window >= newest:
+                return results
+            window *= 8
+
+    def _search_terms(self, terms, limit):
+        """Search with the inverted index, ranking by the frequency of each
+        term in a message weighted by its inverse document frequency."""
+        total = self.connection.execute('SELECT COUNT(*) FROM messages'
+            ).fetchone()[0]
+        scores = None
+        for position, term in enumerate(terms):
+            if position == len(terms) - 1:
+                postings = self.connection.execute('SELECT message, count '
+                    'FROM terms WHERE term >= ? AND term < ?',
+                    (term, term + '\uffff')).fetchall()
+            else:
+                postings = self.connection.execute('SELECT message, count '
+                    'FROM terms WHERE term = ?', (term,)).fetchall()
+            weight = log(1 + total / (1 + len(postings)))
+            found = {}
+            for message, count in postings:
+                found[message] = found.get(message, 0) + count * weight
+            if scores is None:
+                scores = found
+            else:
+                scores = {message: score + found[message]
+                    for message, score in scores.items() if message in found}
+            if not scores:
+                return []
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        results = []
+        for row in best:
+            message, number, direction, timestamp, body = (
+                self.connection.execute('SELECT id, number, direction, '
+                'timestamp, body FROM messages WHERE id = ?',
+                (row,)).fetchone())
+            results.append((message, number, direction, timestamp,
+                _snippet(body, terms)))
+        return results
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+from fona import driver_attached, read_unsolicited
+from fona_commands import (APN, MAX_SEND, RX_CHUNK, close_connection,
+    initiate_tcp_connection, max_send_size, receive_from_tcp, shut_gprs,
+    send_through_tcp, start_gprs)
+from threading import Condition, Lock
+from time import monotonic
+from urc import Connection, Data_Available, Modem_Ready, dispatcher
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-08-07'
+__version__ = '1.0'
+
+"""Socket-Like TCP Connections over the GPRS Stack of the FONA Device.
+
+The SIM800 has a TCP stack of its own, driven with AT commands (see the
+networking section of fona_commands.py): AT+CIPSTART opens a
+connection, AT+CIPSEND sends one segment of at most the size the FONA
+reports for it (usually 1460 bytes) after a > prompt, AT+CIPRXGET reads
+what the FONA received and AT+CIPCLOSE closes the connection. Every
+command is a round trip over the serial port, so the cost of a
+connection is counted in commands rather than bytes.
+
+This library wraps them in sockets which behave like those of the socket
+module:
+    sock = tcp.create_connection(('example.com', 80))
+    sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+    reply = sock.recv(4096)
+    sock.close()
+Writes are buffered: send only adds to the send buffer of the socket,
+and the buffer is sent in segments of the largest size the FONA takes,
+whenever it holds a whole segment and on flush, sendall, recv and close,
+so many small writes cost one AT+CIPSEND instead of one each. Reads are
+done in bulk: the FONA keeps what it receives (AT+CIPRXGET=1) and
+reports it with one +CIPRXGET: 1 URC when its buffer was empty, and recv
+then reads everything the FONA holds, RX_CHUNK bytes per AT+CIPRXGET,
+into the receive buffer of the socket, answering the recv calls which
+follow from memory until it is empty again.
+
+The stack is brought up (see fona_commands.start_gprs) by the first
+connection, in multi-connection mode (AT+CIPMUX=1), so up to MAX_LINKS
+sockets may be open at once, each on a link of its own, and used from
+different threads. The URCs of the stack (see urc.Connection and
+urc.Data_Available) are routed to the socket of their link. Commands
+are refused at once while the FONA is not attached to GPRS (see
+registration.py).
+
+Attributes:
+    MAX_LINKS (int): number of connections the SIM800 can have open at
+    once in multi-connection mode
+    CONNECT_TIMEOUT (float): default seconds to wait for a connection to
+    open
+    POLL_INTERVAL (float): seconds the serial port is read for at a time
+    while waiting for a URC without the asyncio driver
+    tcp (TCP_Stack): TCP stack of the FONA
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+MAX_LINKS = 6
+CONNECT_TIMEOUT = 75.0
+POLL_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+class TCP_Socket(object):
+    """TCP connection on a link of the TCP stack of the FONA.
+
+    A socket may be used by one thread at a time; the URCs of its link
+    update it from the dispatcher thread.
+
+    Attributes:
+        link (int): link number of the connection, or None while it is
+        not open (0 without multi-connection mode)
+        max_send (int): greatest number of bytes of one AT+CIPSEND on the
+        connection
+        bytes_sent, bytes_received (int): bytes sent and received
+        segments_sent, reads (int): number of AT+CIPSEND and AT+CIPRXGET
+        written
+    """
+
+    def __init__(self, stack, timeout=None):
+        """Constructor for TCP_Socket object.
+
+        Args:
+            stack (TCP_Stack): TCP stack the connection is opened on
+            timeout (float): seconds connect and recv wait, or None to wait
+            for as long as it takes (default is None)
+        """
+        self.stack = stack
+        self.link = None
+        self.max_send = MAX_SEND
+        self.bytes_sent = self.bytes_received = 0
+        self.segments_sent = self.reads = 0
+        self._timeout = timeout
+        self._changed = Condition()
+        self._state = None
+        self._readable = False
+        self._tx = bytearray()
+        self._rx = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def settimeout(self, timeout):
+        """Set the seconds connect and recv wait, or None to wait for as
+        long as it takes."""
+        self._timeout = timeout
+
+    def gettimeout(self):
+        """Return the seconds connect and recv wait, or None."""
+        return self._timeout
+
+    @property
+    def connected(self):
+        """Whether the connection is open."""
+        return self._state == 'CONNECT OK'
+
+    def connect(self, address):
+        """Open the connection, bringing the TCP stack up if needed.
+
+        Arg:
+            address (tuple): host name or IP address and port of the server
+
+        Raises:
+            OSError if every link is in use
+            ConnectionRefusedError if the FONA could not connect
+            TimeoutError if the connection did not open within the timeout
+            (or CONNECT_TIMEOUT)
+        """
+        host, port = address
+        self.link = self.stack._allocate(self)
+        try:
+            with self._changed:
+                self._state = None
+            initiate_tcp_connection(host, port, self.stack._link(self.link))
+            opened = self._wait(lambda: self._state is not None,
+                self._timeout or CONNECT_TIMEOUT)
+            if not opened:
+                raise TimeoutError('Connecting to %s:%d timed out'
+                    % (host, port))
+            if not self.connected:
+                raise ConnectionRefusedError('Could not connect to %s:%d (%s)'
+                    % (host, port, self._state))
+            self.max_send = max_send_size(self.stack._link(self.link))
+        except Exception:
+            self.stack._release(self)
+            raise
+        logger.info('Connected to %s:%d on link %d' % (host, port, self.link))
+
+    def send(self, data):
+        """Add data to the send buffer, sending every whole segment.
+
+        Raises:
+            ConnectionError if the connection is not open or the FONA could
+            not send a segment (which then stays in the buffer)
+
+        Returns:
+            Integer of the number of bytes taken, always all of them
+        """
+        self._check_open()
+        self._tx.extend(data)
+        while len(self._tx) >= self.max_send:
+            self._send_segment(self.max_send)
+        return len(data)
+
+    def flush(self):
+        """Send the whole send buffer."""
+        while self._tx:
+            self._check_open()
+            self._send_segment(min(len(self._tx), self.max_send))
+
+    def sendall(self, data):
+        """Send data and the rest of the send buffer."""
+        self.send(data)
+        self.flush()
+
+    def recv(self, bufsize):
+        """Return up to bufsize bytes received, once there are any.
+
+        The send buffer is flushed first, as the answer to it may be what
+        is waited for.
+
+        Raises:
+            TimeoutError if nothing was received within the timeout
+
+        Returns:
+            Bytes received, or b'' once the server closed the connection
+            and everything it sent was read
+        """
+        if self._tx and self.connected:
+            self.flush()
+        while not self._rx:
+            ready = self._wait(lambda: self._readable or not self.connected,
+                self._timeout)
+            if not ready:
+                raise TimeoutError('Nothing received on link %s within %s '
+                    'seconds' % (self.link, self._timeout))
+            if not self._readable or self.link is None:
+                break
+            self._pull()
+        data = bytes(self._rx[:bufsize])
+        del self._rx[:bufsize]
+        return data
+
+    def pending(self):
+        """Return the number of bytes in the receive buffer."""
+        return len(self._rx)
+
+    def close(self):
+        """Send the rest of the send buffer and close the connection."""
+        if self.link is None:
+            return
+        try:
+            if self.connected:
+                self.flush()
+                close_connection(self.stack._link(self.link))
+        finally:
+            with self._changed:
+                self._state = 'CLOSED'
+                self._changed.notify_all()
+            self.stack._release(self)
+
+    def _wait(self, predicate, timeout):
+        """Wait for a URC of the link to make predicate true.
+
+        Without the asyncio driver nobody reads the serial port between
+        commands, so the port is read here while waiting, POLL_INTERVAL
+        seconds at a time.
+
+        Returns:
+            True if predicate is true, False if the timeout expired
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self._changed:
+                remaining = None if deadline is None else max(
+                    deadline - monotonic(), 0)
+                if driver_attached():
+                    return self._changed.wait_for(predicate, remaining)
+                if predicate() or remaining == 0:
+                    return predicate()
+            read_unsolicited(POLL_INTERVAL if remaining is None else min(
+                remaining, POLL_INTERVAL))
+            with self._changed:
+                self._changed.wait_for(predicate, POLL_INTERVAL)
+
+    def _check_open(self):
+        if not self.connected:
+            raise ConnectionError('Connection on link %s is not open (%s)'
+                % (self.link, self._state))
+
+    def _send_segment(self, length):
+        """Send the first length bytes of the send buffer with one
+        AT+CIPSEND."""
+        try:
+            send_through_tcp(bytes(self._tx[:length]),
+                self.stack._link(self.link))
+        except IOError as error:
+            raise ConnectionError(str(error))
+        del self._tx[:length]
+        self.bytes_sent += length
+        self.segments_sent += 1
+
+    def _pull(self):
+        """Read everything the FONA holds for the connection into the
+        receive buffer."""
+        with self._changed:
+            self._readable = False
+        remaining = True
+        while remaining:
+            try:
+                data, remaining = receive_from_tcp(RX_CHUNK,
+                    self.stack._link(self.link))
+            except IOError:
+                if self.connected:
+                    raise
+                return
+            self.reads += 1
+            self.bytes_received += len(data)
+            self._rx.extend(data)
+
+    def _on_event(self, state):
+        """Take the state of the connection or the news of data to read
+        from a URC."""
+        with self._changed:
+            if state is None:
+                self._readable = True
+            else:
+                self._state = state
+            self._changed.notify_all()
+
+class TCP_Stack(object):
+    """TCP stack of the FONA and the sockets on its links.
+
+    Attributes:
+        apn (str): access point name the stack is brought up with
+        mux (bool): whether the stack runs in multi-connection mode
+        ip (str): local IP address, or None while the stack is down
+    """
+
+    def __init__(self, apn=APN, mux=True):
+        """Constructor for TCP_Stack object.
+
+        Args:
+            apn (str): access point name of the carrier (default is
+            fona_commands.APN)
+            mux (bool): whether to use multi-connection mode (default is
+            True); without it only one connection can be open
+        """
+        self.apn = apn
+        self.mux = mux
+        self.ip = None
+        self._lock = Lock()
+        self._sockets = {}
+        dispatcher.subscribe(Connection, self._on_connection)
+        dispatcher.subscribe(Data_Available, self._on_data)
+        dispatcher.subscribe(Modem_Ready, self._on_reset)
+
+    def socket(self, timeout=None):
+        """Return a new TCP_Socket on the stack."""
+        return TCP_Socket(self, timeout)
+
+    def create_connection(self, address, timeout=None):
+        """Return a TCP_Socket connected to address (see
+        TCP_Socket.connect)."""
+        sock = self.socket(timeout)
+        sock.connect(address)
+        return sock
+
+    def start(self):
+        """Bring the stack up, unless it is up.
+
+        Returns:
+            String of the local IP address
+        """
+        with self._lock:
+            if self.ip is None:
+                self.ip = start_gprs(self.apn, self.mux)
+                logger.info('GPRS up with IP address %s' % self.ip)
+            return self.ip
+
+    def stop(self):
+        """Close every connection and bring the stack down."""
+        with self._lock:
+            sockets = list(self._sockets.values())
+            self._sockets.clear()
+            self.ip = None
+        shut_gprs()
+        for sock in sockets:
+            sock._on_event('CLOSED')
+            sock.link = None
+
+    def _link(self, link):
+        """Return the link parameter of a command on a link (see
+        fona_commands._link)."""
+        return link if self.mux else None
+
+    def _allocate(self, sock):
+        """Bring the stack up and give a socket the first free link.
+
+        Raises:
+            OSError if every link is in use
+        """
+        self.start()
+        with self._lock:
+            links = range(MAX_LINKS if self.mux else 1)
+            free = [link for link in links if link not in self._sockets]
+            if not free:
+                raise OSError('All %d TCP links are in use' % len(links))
+            self._sockets[free[0]] = sock
+            return free[0]
+
+    def _release(self, sock):
+        """Free the link of a socket."""
+        with self._lock:
+            if self._sockets.get(sock.link) is sock:
+                del self._sockets[sock.link]
+        sock.link = None
+
+    def _socket(self, link):
+        return self._sockets.get(0 if link is None else link)
+
+    def _on_connection(self, event):
+        """Route a connection URC to the socket of its link, or close
+        every socket when the GPRS context is lost."""
+        if event.state.startswith('PDP'):
+            logger.warning('GPRS context lost (%s)' % event.state)
+            with self._lock:
+                self.ip = None
+                sockets = list(self._sockets.values())
+            for sock in sockets:
+                sock._on_event('CLOSED')
+            return
+        sock = self._socket(event.link)
+        if sock is not None:
+            sock._on_event(event.state)
+
+    def _on_data(self, event):
+        sock = self._socket(event.link)
+        if sock is not None:
+            sock._on_event(None)
+
+    def _on_reset(self, event):
+        """Forget the stack when the FONA restarts."""
+        self._on_connection(Connection(None, 'PDP DEACT', event.time))
+
+tcp = TCP_Stack()
+
+def create_connection(address, timeout=None):
+    """Return a TCP_Socket of the TCP stack of the FONA connected to
+    address, like socket.create_connection."""
+    return tcp.create_connection(address, timeout)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from sim800_emulator import SIM800_Emulator
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+import asyncio
+import logging
+import os
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-08-07'
+__version__ = '1.0'
+
+"""Benchmark of the Throughput of the TCP Sockets Against the Emulator.
+
+Starts a SIM800_Emulator, whose TCP stack echoes everything sent to it,
+opens --links connections with tcp.py and sends --size bytes on each in
+writes of --write bytes, reading the echo back, e.g.
+    python3 tcp_bench.py --latency 0.02 --baud 115200 --links 3
+Each run is timed twice: unbuffered, with every write sent with its own
+AT+CIPSEND (sendall) and every read asking for --write bytes, as the
+networking stubs of fona_commands would have had to, and buffered, with
+the writes batched into segments of the largest size the FONA takes
+(send, then flush) and the echo read in bulk. The throughput counts the
+bytes sent and received over all links, and the commands the AT+CIPSEND
+and AT+CIPRXGET written. With --driver the commands go through the
+asyncio FONA_Driver.
+"""
+
+def _exchange(sock, size, write, buffered):
+    """Send size bytes in writes of write bytes and read the echo back."""
+    payload = bytes(range(256)) * (write // 256 + 1)
+    received = 0
+    for start in range(0, size, write):
+        chunk = payload[:min(write, size - start)]
+        if buffered:
+            sock.send(chunk)
+        else:
+            sock.sendall(chunk)
+            received += len(sock.recv(write))
+    sock.flush()
+    while received < size:
+        received += len(sock.recv(size if buffered else write))
+
+def run(tcp, links, size, write, buffered):
+    """Exchange size bytes on each of links connections at once.
+
+    Returns:
+        Tuple of the seconds taken and the number of AT+CIPSEND and
+        AT+CIPRXGET written
+    """
+    sockets = [tcp.create_connection(('echo.example.com', 7), timeout=30)
+        for _ in range(links)]
+    threads = [Thread(target=_exchange, args=(sock, size, write, buffered))
+        for sock in sockets]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = perf_counter() - start
+    commands = sum(sock.segments_sent + sock.reads for sock in sockets)
+    for sock in sockets:
+        sock.close()
+    return seconds, commands
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the TCP sockets')
+    parser.add_argument('--latency', type=float, default=0.02,
+        help='seconds the emulated SIM800 takes to answer')
+    parser.add_argument('--baud', type=int, default=115200,
+        help='baud rate of the emulated UART (0 for no throttling)')
+    parser.add_argument('--links', type=int, default=1,
+        help='number of connections open at once')
+    parser.add_argument('--size', type=int, default=16384,
+        help='bytes sent on each connection')
+    parser.add_argument('--write', type=int, default=128,
+        help='bytes of each write')
+    parser.add_argument('--driver', action='store_true',
+        help='send the commands through the asyncio FONA_Driver')
+    arguments = parser.parse_args()
+
+    emulator = SIM800_Emulator(arguments.latency, arguments.baud).start()
+    os.environ['FONA_PORT'] = emulator.port_name
+    os.environ['FONA_SETTINGS'] = os.path.join(mkdtemp(), 'fona.json')
+    logging.disable(logging.INFO)
+    import fona
+    fona.TARGET_BAUD = arguments.baud or fona.TARGET_BAUD
+    fona.connect()
+    if arguments.driver:
+        from fona_async import FONA_Driver
+        loop = asyncio.new_event_loop()
+        Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(FONA_Driver().start(), loop).result()
+    from tcp import tcp
+
+    total = 2 * arguments.links * arguments.size
+    for label, buffered in (('unbuffered', False), ('buffered', True)):
+        seconds, commands = run(tcp, arguments.links, arguments.size,
+            arguments.write, buffered)
+        print('%-12s %8.1f KB/s %6d commands %7.2f s' % (label,
+            total / seconds / 1024, commands, seconds))
+    tcp.stop()
+    emulator.stop()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from fona import command_batch
+from registration import registration
+from responses import Network, parse
+from sms_store import parse_sim_timestamp
+from threading import Lock
+from time import monotonic, time
+from urc import Registration, dispatcher
+
+import logging
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-07-28'
+__version__ = '1.0'
+
+"""Cached Telemetry of the FONA Device for the Status Bar.
+
+The status bar shows the signal, the battery, the network and the time,
+and any number of UI elements may want them at any moment. Instead of
+each of them asking the FONA (a round trip over the serial port each),
+the telemetry service samples the FONA in the background and keeps the
+last value of each field in memory, so reading it costs no serial
+traffic at all.
+
+The fields are sampled with these queries:
+    signal: AT+CSQ, a responses.Signal of the RSSI and bit error rate
+    battery: AT+CBC, a responses.Battery of the charge status,
+    percentage and voltage
+    registration: AT+CREG?, a responses.Network of the registration
+    status and cell
+    clock: AT+CCLK?, the offset in seconds of the FONA's (network) clock
+    from the clock of the Raspberry Pi, so that time() gives the network
+    time without asking the FONA
+Each field has a time to live (TTL) after which it is due to be sampled
+again. Whenever a field is due, every field which would be due within
+the next COALESCE of its TTL is sampled with it, on one command line
+(see fona.command_batch), so the FONA is asked at most once per TTL of
+the fastest field. The TTLs adapt to the values: a field whose value did
+not move is sampled half as often, up to its longest TTL, and a field
+whose value moved is sampled again at its shortest TTL. +CREG URCs
+update the registration for free between samples, and every sampled
+registration is handed to the registration watcher (see
+registration.py).
+
+Subscribers are called only when a value moves, i.e. a change the status
+bar would show: the RSSI (not the bit error rate), the charge status and
+percentage (not the voltage, which wanders by a few mV at every sample),
+the registration and cell, and the clock offset once it is
+CLOCK_TOLERANCE or more away from the last one published (AT+CCLK has a
+resolution of a second, and the sampling jitters by fractions of one).
+
+Attributes:
+    FIELDS (dict): (query, shortest TTL, longest TTL) of each field, the
+    TTLs in seconds
+    COALESCE (float): fraction of its TTL within which a field which is
+    not yet due is sampled with one which is
+    RETRY_DELAY (float): seconds before sampling again after the FONA did
+    not answer
+    CLOCK_TOLERANCE (float): seconds the clock offset must move by from
+    the last one published to count as moved
+    telemetry (Telemetry): telemetry of the FONA, sampled by a job of the
+    scheduler (see scheduler.py) and read by the UI
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+FIELDS = {
+    'signal': ('AT+CSQ', 10.0, 120.0),
+    'battery': ('AT+CBC', 30.0, 600.0),
+    'registration': ('AT+CREG?', 30.0, 600.0),
+    'clock': ('AT+CCLK?', 600.0, 3600.0),
+}
+COALESCE = 0.5
+RETRY_DELAY = 5.0
+CLOCK_TOLERANCE = 2.0
+
+Reading = namedtuple('Reading', 'value time ttl deadline')
+
+logger = logging.getLogger(__name__)
+
+def _key(name, value):
+    """Return what of a value the status bar shows, which is compared to
+    decide if the value moved."""
+    if name == 'signal':
+        return value.rssi
+    if name == 'battery':
+        return (value.charging, value.percent)
+    if name == 'registration':
+        return (value.stat, value.lac, value.ci)
+    return value
+
+def _moved(name, value, published):
+    """Determine if a value moved from the one last published."""
+    if published is None:
+        return True
+    if name == 'clock':
+        return abs(value - published) >= CLOCK_TOLERANCE
+    return _key(name, value) != _key(name, published)
+
+def _parse(name, output):
+    """Return the value of a field from the output of its query, or None
+    if the FONA did not answer it."""
+    if name == 'signal':
+        return parse(output, '+CSQ')
+    if name == 'battery':
+        return parse(output, '+CBC')
+    if name == 'registration':
+        return parse(output, '+CREG')
+    clock = parse(output, '+CCLK')
+    return None if clock is None else parse_sim_timestamp(clock) - time()
+
+class Telemetry(object):
+    """Last sampled value of each field and when to sample it again.
+
+    Values may be read from any thread; sample must only be called from
+    one thread at a time (the scheduler thread).
+    """
+
+    def __init__(self, fields=FIELDS):
+        """Constructor for Telemetry object.
+
+        Arg:
+            fields (dict): (query, shortest TTL, longest TTL) of each field
+            (default is FIELDS)
+        """
+        self.fields = dict(fields)
+        self._lock = Lock()
+        self._listeners = []
+        self._published = {}
+        self._readings = {name: Reading(None, None, shortest, 0.0)
+            for name, (_, shortest, _) in self.fields.items()}
+        dispatcher.subscribe(Registration, self._on_registration)
+
+    def subscribe(self, callback):
+        """Call callback(name, value) whenever the value of a field moves.
+
+        Callbacks run on the thread which sampled the value (the scheduler
+        thread, or the URC dispatcher for registration), so they should
+        hand the value to the UI rather than draw it themselves.
+        """
+        self._listeners.append(callback)
+
+    def get(self, name):
+        """Return the last value of a field, or None if it was never
+        sampled. Never talks to the FONA."""
+        return self._readings[name].value
+
+    def age(self, name):
+        """Return the seconds since a field was last sampled, or None if it
+        never was."""
+        sampled = self._readings[name].time
+        return None if sampled is None else monotonic() - sampled
+
+    def snapshot(self):
+        """Return a dict of the last value of every field."""
+        with self._lock:
+            return {name: reading.value
+                for name, reading in self._readings.items()}
+
+    def time(self):
+        """Return the network time in seconds since the epoch, from the
+        clock of the Raspberry Pi and the last offset of the FONA's clock
+        (or the clock of the Raspberry Pi alone if it was never
+        sampled)."""
+        return time() + (self._readings['clock'].value or 0)
+
+    def next_due(self):
+        """Return the time.monotonic value at which the next field is due."""
+        with self._lock:
+            return min(reading.deadline for reading in self._readings.values())
+
+    def due(self, now=None):
+        """Return the names of the fields to sample now: those which are
+        due and, if any is, those due within COALESCE of their TTL.
+
+        Arg:
+            now (float): time.monotonic value (default is now)
+        """
+        now = monotonic() if now is None else now
+        with self._lock:
+            readings = dict(self._readings)
+        if not any(reading.deadline <= now for reading in readings.values()):
+            return []
+        return [name for name, reading in readings.items()
+            if reading.deadline - COALESCE * reading.ttl <= now]
+
+    def sample(self, names=None):
+        """Sample fields from the FONA on one command line and publish the
+        values which moved.
+
+        Arg:
+            names (str list): fields to sample (default is those which are
+            due, see due)
+
+        Raises:
+            IOError or ConnectionError if the FONA did not answer; the
+            fields are then due again after RETRY_DELAY
+
+        Returns:
+            List of the names of the fields whose value moved
+        """
+        names = self.due() if names is None else list(names)
+        if not names:
+            return []
+        try:
+            outputs = command_batch([self.fields[name][0] for name in names])
+        except IOError:
+            with self._lock:
+                for name in names:
+                    self._readings[name] = self._readings[name]._replace(
+                        deadline=monotonic() + RETRY_DELAY)
+            raise
+        now = monotonic()
+        values = {name: _parse(name, output)
+            for name, output in zip(names, outputs)}
+        if values.get('registration') is not None:
+            registration.observe('CREG', values['registration'].stat)
+        return [name for name in names
+            if self._update(name, values[name], now)]
+
+    def _update(self, name, value, now):
+        """Record a sampled value, adapt the TTL of its field and publish
+        the value if it moved.
+
+        Returns:
+            True if the value moved
+        """
+        _, shortest, longest = self.fields[name]
+        with self._lock:
+            previous = self._readings[name]
+            if value is None:
+                self._readings[name] = previous._replace(ttl=shortest,
+                    deadline=now + shortest)
+                return False
+            moved = _moved(name, value, self._published.get(name))
+            ttl = shortest if moved else min(previous.ttl * 2, longest)
+            self._readings[name] = Reading(value, now, ttl, now + ttl)
+            if moved:
+                self._published[name] = value
+        if moved:
+            for callback in self._listeners:
+                try:
+                    callback(name, value)
+                except Exception:
+                    logger.exception('Telemetry listener failed for %s'
+                        % name)
+        return moved
+
+    def _on_registration(self, event):
+        """Take the registration from a +CREG URC."""
+        if event.network != 'CREG':
+            return
+        previous = self._readings['registration'].value
+        mode = previous.mode if previous is not None else 2
+        self._update('registration', Network(mode, event.stat, event.lac,
+            event.ci), event.time)
+
+telemetry = Telemetry()
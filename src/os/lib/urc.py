@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+from csv import reader
+from queue import Queue
+from responses import parse_ciprxget, parse_clcc, parse_clip
+from threading import Lock, Thread
+from time import monotonic
+
+import logging
+import re
+
+__author__ = 'Nikola Istvanic'
+__date__ = '2017-06-12'
+__version__ = '1.0'
+
+"""Unsolicited Result Codes of the 2G FONA Device.
+
+Besides answering commands, the SIM800 writes lines to the serial port
+on its own whenever something happens on the network: RING and +CLIP
+for an incoming call, +CMTI for a new SMS stored on the SIM, NO CARRIER
+when the other side hangs up, +CREG when registration changes, CONNECT
+OK, CLOSED and +CIPRXGET: 1 when a TCP connection opens, closes or has
+data to read, and so on (see section 'Summary of Unsolicited Result
+Codes' of the SIM800 Series AT Command Manual). These unsolicited result
+codes (URCs) can arrive at any point in the byte stream, including in
+the middle of the response to a command.
+
+This library recognizes URC lines and turns them into typed events
+(named tuples, one type per URC) which are delivered to subscribers by
+the dispatcher. Every event carries the time.monotonic value at which
+its line was read so that the latency of handling it can be measured.
+
+Callbacks run on the dispatcher's delivery thread, never on the thread
+reading the serial port, so a callback may itself send commands to the
+FONA device.
+
+Attributes:
+    dispatcher (Dispatcher): dispatcher which the fona library
+    publishes every URC it reads to
+    logger (logging.logger): logging object to display diagnostic
+    information
+"""
+
+Ring = namedtuple('Ring', 'time')
+Caller_ID = namedtuple('Caller_ID', 'number type alpha time')
+New_SMS = namedtuple('New_SMS', 'storage index time')
+Status_Report = namedtuple('Status_Report', 'storage index fields time')
+Call_Ended = namedtuple('Call_Ended', 'reason time')
+Call_Status = namedtuple('Call_Status',
+    'index direction state mode number time')
+Registration = namedtuple('Registration', 'network stat lac ci time')
+Power = namedtuple('Power', 'event time')
+Modem_Ready = namedtuple('Modem_Ready', 'event time')
+Connection = namedtuple('Connection', 'link state time')
+Data_Available = namedtuple('Data_Available', 'link time')
+
+CALL_ENDED = ('NO CARRIER', 'BUSY', 'NO ANSWER')
+POWER_EVENTS = ('UNDER-VOLTAGE WARNNING', 'UNDER-VOLTAGE POWER DOWN',
+    'OVER-VOLTAGE WARNNING', 'OVER-VOLTAGE POWER DOWN', 'NORMAL POWER DOWN')
+READY_EVENTS = ('RDY', 'Call Ready', 'SMS Ready')
+CONNECTION_EVENTS = ('CONNECT OK', 'CONNECT FAIL', 'ALREADY CONNECT',
+    'CLOSED')
+
+_CONNECTION = re.compile(r'(?:(\d), )?(%s)$' % '|'.join(CONNECTION_EVENTS))
+
+logger = logging.getLogger(__name__)
+
+def _fields(line):
+    """Split the comma separated parameters of a URC, honouring quotes.
+
+    Arg:
+        line (str): URC line
+
+    Returns:
+        String array of the parameters after the colon with quotes
+        removed
+    """
+    return next(reader([line.partition(':')[2].strip()],
+        skipinitialspace=True), [])
+
+def _optional(fields, index):
+    """Return the parameter at index, or None if there are fewer."""
+    return fields[index] if len(fields) > index else None
+
+def _caller_id(line, time):
+    """Parse +CLIP: into a Caller_ID event."""
+    caller = parse_clip(line)
+    if caller is None:
+        raise ValueError(line)
+    return Caller_ID(caller.number, caller.type, caller.alpha, time)
+
+def _new_sms(line, time):
+    """Parse +CMTI: into a New_SMS event."""
+    fields = _fields(line)
+    return New_SMS(fields[0], int(fields[1]), time)
+
+def _status_report_index(line, time):
+    """Parse +CDSI: into a Status_Report event of a stored report."""
+    fields = _fields(line)
+    return Status_Report(fields[0], int(fields[1]), fields, time)
+
+def _status_report(line, time):
+    """Parse +CDS: into a Status_Report event of a routed report."""
+    return Status_Report(None, None, _fields(line), time)
+
+def _call_status(line, time):
+    """Parse +CLCC: into a Call_Status event."""
+    call = parse_clcc(line)
+    if call is None:
+        raise ValueError(line)
+    return Call_Status(call.index, call.direction, call.state, call.mode,
+        call.number, time)
+
+def _registration(network):
+    """Return the parser of +CREG: or +CGREG: for network."""
+    def parse(line, time):
+        """Parse the line into a Registration event."""
+        fields = _fields(line)
+        stat = int(fields[0])
+        return Registration(network, stat, _optional(fields, 1),
+            _optional(fields, 2), time)
+    return parse
+
+def _data_available(line, time):
+    """Parse +CIPRXGET: 1 into a Data_Available event."""
+    header = parse_ciprxget(line)
+    if header is None or header.mode != 1:
+        return None
+    return Data_Available(header.link, time)
+
+def _pdp(line, time):
+    """Parse +PDP: into a Connection event for every link."""
+    return Connection(None, 'PDP ' + _fields(line)[0], time)
+
+def _cpin(line, time):
+    """Parse +CPIN: into a Modem_Ready event."""
+    return Modem_Ready('+CPIN: ' + _fields(line)[0], time)
+
+def _cfun(line, time):
+    """Parse +CFUN: into a Modem_Ready event."""
+    return Modem_Ready('+CFUN: ' + _fields(line)[0], time)
+
+_PREFIXES = {
+    '+CLIP': _caller_id,
+    '+CMTI': _new_sms,
+    '+CDSI': _status_report_index,
+    '+CDS': _status_report,
+    '+CLCC': _call_status,
+    '+CREG': _registration('CREG'),
+    '+CGREG': _registration('CGREG'),
+    '+CPIN': _cpin,
+    '+CFUN': _cfun,
+    '+CIPRXGET': _data_available,
+    '+PDP': _pdp,
+}
+
+def parse_urc(line, time=None):
+    """Turn a line of FONA output into the event for its URC.
+
+    Args:
+        line (str): line of output with its line terminator removed
+        time (float): time.monotonic value at which the line was read
+        (default is now)
+
+    Returns:
+        The event named tuple for the URC, or None if the line is not a
+        URC (or is a URC whose parameters could not be parsed)
+    """
+    if time is None:
+        time = monotonic()
+    if line == 'RING':
+        return Ring(time)
+    if line in CALL_ENDED:
+        return Call_Ended(line, time)
+    if line in POWER_EVENTS:
+        return Power(line, time)
+    if line in READY_EVENTS:
+        return Modem_Ready(line, time)
+    connection = _CONNECTION.match(line)
+    if connection is not None:
+        link, state = connection.groups()
+        return Connection(int(link) if link else None, state, time)
+    prefix, colon, _ = line.partition(':')
+    if not colon or prefix not in _PREFIXES:
+        return None
+    try:
+        return _PREFIXES[prefix](line, time)
+    except (IndexError, ValueError):
+        logger.warning('Malformed URC %s' % line)
+        return None
+
+class Dispatcher(object):
+    """Publish URC events to the callbacks subscribed to their type.
+
+    Events are put on a queue by publish and delivered, in the order
+    they were read, by a daemon thread which is started on the first
+    publish. Because delivery happens off the serial reading thread,
+    callbacks may block or send commands to the FONA device; an
+    exception raised by a callback is logged and does not stop delivery
+    to the others.
+    """
+
+    def __init__(self):
+        """Constructor for Dispatcher object."""
+        self._subscribers = {}
+        self._lock = Lock()
+        self._queue = Queue()
+        self._thread = None
+
+    def subscribe(self, event_type, callback):
+        """Call callback(event) for every event of the given type.
+
+        Args:
+            event_type (type): one of the event named tuple types of
+            this library, or None to receive every event
+            callback (callable): function of one argument, the event
+        """
+        with self._lock:
+            self._subscribers.setdefault(event_type, []).append(callback)
+
+    def unsubscribe(self, event_type, callback):
+        """Stop calling callback for events of the given type."""
+        with self._lock:
+            callbacks = self._subscribers.get(event_type, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def publish(self, event):
+        """Queue an event for delivery to its subscribers."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._deliver,
+                    name='URC_Dispatcher', daemon=True)
+                self._thread.start()
+        self._queue.put(event)
+
+    def _deliver(self):
+        """Deliver queued events to their subscribers, forever."""
+        while True:
+            event = self._queue.get()
+            with self._lock:
+                callbacks = (self._subscribers.get(type(event), []) +
+                    self._subscribers.get(None, []))
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception('URC callback failed for %s' % (event,))
+
+dispatcher = Dispatcher()